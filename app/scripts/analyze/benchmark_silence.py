@@ -0,0 +1,89 @@
+###無音区間検出のベンチマーク（従来のループ実装とベクトル化実装の比較）
+
+import sys
+import time
+import numpy as np
+from .silence import FRAME_LENGTH, HOP_LENGTH, compute_frame_energy, group_silent_sections
+
+SAMPLE_RATE = 44100
+
+
+def legacy_silent_sections(y, sr, silence_threshold, min_silence_duration):
+    """変更前のdetect_silent_sectionsと同じ計算（比較用）"""
+    energy = np.array([
+        sum(abs(y[i:i+FRAME_LENGTH]**2)) for i in range(0, len(y), HOP_LENGTH)
+    ])
+    energy_db = 10 * np.log10(energy + 1e-6)
+    silence_frames = energy_db < silence_threshold
+
+    silence_times = []
+    silence_start = None
+    current_silence_duration = 0
+    for i, is_silent in enumerate(silence_frames):
+        time_sec = i * HOP_LENGTH / sr
+        if is_silent:
+            if silence_start is None:
+                silence_start = time_sec
+            current_silence_duration += HOP_LENGTH / sr
+        else:
+            if silence_start is not None:
+                if current_silence_duration >= min_silence_duration:
+                    silence_times.append([silence_start, time_sec])
+                silence_start = None
+                current_silence_duration = 0
+    if silence_start is not None and current_silence_duration >= min_silence_duration:
+        silence_times.append([silence_start, len(y) / sr])
+    return silence_times
+
+
+def vectorized_silent_sections(y, sr, silence_threshold, min_silence_duration):
+    energy_db = 10 * np.log10(compute_frame_energy(y) + 1e-6)
+    return group_silent_sections(energy_db < silence_threshold, sr, len(y), min_silence_duration)
+
+
+def synthesize_vocals(minutes, sr=SAMPLE_RATE, seed=0):
+    """ボーカル区間と無音区間が交互に現れる疑似ボーカルトラックを生成"""
+    rng = np.random.default_rng(seed)
+    y = np.zeros(int(minutes * 60 * sr), dtype=np.float32)
+    position = 0
+    voiced = True
+    while position < len(y):
+        length = int(rng.uniform(3, 20) * sr)
+        if voiced:
+            y[position:position + length] = rng.normal(0, 0.3, len(y[position:position + length]))
+        position += length
+        voiced = not voiced
+    return y
+
+
+def sections_match(expected, actual, tolerance):
+    if len(expected) != len(actual):
+        return False
+    return all(
+        abs(e_start - a_start) <= tolerance and abs(e_end - a_end) <= tolerance
+        for (e_start, e_end), (a_start, a_end) in zip(expected, actual)
+    )
+
+
+def main(minutes=1.0, silence_threshold=0, min_silence_duration=5):
+    y = synthesize_vocals(minutes)
+    sr = SAMPLE_RATE
+
+    start = time.perf_counter()
+    expected = legacy_silent_sections(y, sr, silence_threshold, min_silence_duration)
+    legacy_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = vectorized_silent_sections(y, sr, silence_threshold, min_silence_duration)
+    vectorized_elapsed = time.perf_counter() - start
+
+    matched = sections_match(expected, actual, HOP_LENGTH / sr)
+    print(f"音声長: {minutes:.1f}分 / 検出区間数: {len(actual)} / 一致(1hop以内): {matched}")
+    print(f"従来実装:       {legacy_elapsed / minutes:.3f}秒/分")
+    print(f"ベクトル化実装: {vectorized_elapsed / minutes:.4f}秒/分")
+    print(f"高速化倍率:     {legacy_elapsed / vectorized_elapsed:.1f}倍")
+    return 0 if matched else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(float(sys.argv[1]) if len(sys.argv) > 1 else 1.0))
@@ -1,62 +1,64 @@
-import librosa
 import numpy as np
 import os
-import psycopg2
-from ..db.config import DB_CONFIG  # データベース設定をインポート
+from psycopg2.extras import execute_values
+import argparse
+from ..db.pool import SORO_TABLE, get_connection  # プールからDB接続を借りる
+from .silence import compute_frame_energy, group_silent_sections, StreamingSilenceDetector
+from .parallel import run_ordered
+from .stem_cache import DEFAULT_MAX_BYTES, load_stem
+from ..separate.stems import find_stem, iter_stem_blocks, read_stem
 import sys
 
-def detect_silent_sections(file_path, silence_threshold=-30.0, min_silence_duration=5):
+STREAM_BLOCK_SIZE = 65536  # ストリーミング時に一度に読み込むサンプル数
+
+def detect_silent_sections_from_waveform(y, sr, silence_threshold=-30.0, min_silence_duration=5):
     """
-    ボーカルトラックから無音区間（ボーカルがない区間）を検出
+    読み込み済みの波形から無音区間を検出
     """
-    try:
-        print(f"Loading file: {file_path}")
-        y, sr = librosa.load(file_path, sr=None)
-
-        print("Audio loaded. Calculating energy...")
-        frame_length = 2048  # フレームサイズ
-        hop_length = 512     # フレームの間隔
-        energy = np.array([
-            sum(abs(y[i:i+frame_length]**2)) for i in range(0, len(y), hop_length)
-        ])
-
-        # デシベルスケールに変換
-        energy_db = 10 * np.log10(energy + 1e-6)  # 1e-6はゼロ割防止用
-        print("Energy calculated. Converting to dB scale...")
-
-        # 無音フレームの判定
-        print("Detecting silence...")
-        silence_frames = energy_db < silence_threshold
-
-        # 無音フレームを秒単位でグループ化
-        print("Grouping silent sections...")
-        silence_times = []
-        silence_start = None
-        current_silence_duration = 0
-
-        for i, is_silent in enumerate(silence_frames):
-            time = i * hop_length / sr  # フレームを秒に変換
-            if is_silent:
-                if silence_start is None:
-                    silence_start = time
-                current_silence_duration += hop_length / sr
-            else:
-                if silence_start is not None:
-                    # 無音区間が指定された最小継続時間以上の場合のみ記録
-                    if current_silence_duration >= min_silence_duration:
-                        silence_end = time
-                        silence_times.append([silence_start, silence_end])
-                        print(f"Detected silence from {silence_start:.2f}s to {silence_end:.2f}s")
-                    # リセット
-                    silence_start = None
-                    current_silence_duration = 0
-
-        # 最後の無音区間を確認
-        if silence_start is not None and current_silence_duration >= min_silence_duration:
-            silence_end = len(y) / sr
-            silence_times.append([silence_start, silence_end])
-            print(f"Detected silence from {silence_start:.2f}s to {silence_end:.2f}s")
+    print("Calculating energy...")
+    energy = compute_frame_energy(y)
+
+    # デシベルスケールに変換
+    energy_db = 10 * np.log10(energy + 1e-6)  # 1e-6はゼロ割防止用
+    print("Energy calculated. Converting to dB scale...")
+
+    # 無音フレームの判定
+    print("Detecting silence...")
+    silence_frames = energy_db < silence_threshold
+
+    # 無音フレームを秒単位でグループ化
+    print("Grouping silent sections...")
+    silence_times = group_silent_sections(silence_frames, sr, len(y), min_silence_duration)
 
+    print("Silence detection complete.")
+    return silence_times
+
+
+def iter_silent_sections_streaming(file_path, silence_threshold=-30.0, min_silence_duration=5,
+                                   block_size=STREAM_BLOCK_SIZE):
+    """
+    ボーカルトラックをブロック単位で読み込みながら無音区間を検出し、確定した区間から順に返す。
+    メモリ使用量は曲の長さに依存しない。
+    """
+    sr, blocks = iter_stem_blocks(file_path, block_size)
+    detector = StreamingSilenceDetector(sr, silence_threshold, min_silence_duration)
+    for block in blocks:
+        for section in detector.feed(block):
+            yield section
+    for section in detector.finish():
+        yield section
+
+
+def detect_silent_sections_streaming(file_path, silence_threshold=-30.0, min_silence_duration=5,
+                                     block_size=STREAM_BLOCK_SIZE):
+    """
+    ストリーミング読み込みで無音区間を検出（結果はdetect_silent_sectionsと同じ形式）
+    """
+    try:
+        print(f"Streaming file: {file_path} (block_size={block_size})")
+        silence_times = list(iter_silent_sections_streaming(
+            file_path, silence_threshold, min_silence_duration, block_size
+        ))
         print("Silence detection complete.")
         return silence_times
 
@@ -64,48 +66,89 @@ def detect_silent_sections(file_path, silence_threshold=-30.0, min_silence_durat
         print(f"An error occurred: {e}")
         raise
 
-def insert_soro_records(song_id, silence_sections):
+
+def detect_silent_sections(file_path, silence_threshold=-30.0, min_silence_duration=5,
+                           streaming=False, block_size=STREAM_BLOCK_SIZE, stem_cache_max_bytes=None):
     """
-    検出された無音区間をsoroテーブルに挿入する。ただし、既存のレコードと重複しないようにする。
+    ボーカルトラックから無音区間（ボーカルがない区間）を検出
+    streaming=Trueの場合はファイル全体をメモリに載せずにブロック単位で処理する
+    stem_cache_max_bytesを指定した場合はデコード済みステムのキャッシュを使う
+    """
+    if streaming:
+        return detect_silent_sections_streaming(file_path, silence_threshold, min_silence_duration, block_size)
+    try:
+        print(f"Loading file: {file_path}")
+        if stem_cache_max_bytes is not None:
+            y, sr = load_stem(file_path, sr=None, max_bytes=stem_cache_max_bytes)
+        else:
+            y, sr = read_stem(file_path, sr=None)
+        print("Audio loaded.")
+        return detect_silent_sections_from_waveform(y, sr, silence_threshold, min_silence_duration)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        raise
+
+# 既存の区間と重なる区間（端点の一致を含む）はDB側で除外して一括挿入する
+BULK_INSERT_SORO_QUERY = f"""
+    WITH staged (song_id, start_time, end_time) AS (
+        VALUES %s
+    )
+    INSERT INTO {SORO_TABLE} (song_id, start_time, end_time, is_guitar_soro, guitar_score)
+    SELECT staged.song_id, staged.start_time, staged.end_time, FALSE, NULL
+    FROM staged
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {SORO_TABLE} existing
+        WHERE existing.song_id = staged.song_id
+          AND numrange(existing.start_time::numeric, existing.end_time::numeric, '[]')
+              && numrange(staged.start_time::numeric, staged.end_time::numeric, '[]')
+    )
+    RETURNING soro_id, song_id, start_time, end_time
+"""
+BULK_INSERT_SORO_TEMPLATE = "(%s::integer, %s::double precision, %s::double precision)"
+INSERT_BATCH_SONGS = 500  # 1回の一括挿入にまとめる曲数
+
+def insert_soro_records_bulk(sections_by_song, connection=None, page_size=10000):
+    """
+    複数曲の無音区間を1つの接続・少数の文でsoroテーブルに挿入する。
+    既存レコードとの重複判定はnumrangeの&&でDB側で行う。
+    戻り値は挿入された (soro_id, song_id, start_time, end_time) のリスト
     """
+    rows = [
+        (song_id, float(start_time), float(end_time))
+        for song_id, sections in sections_by_song.items()
+        for start_time, end_time in sections
+    ]
+    if not rows:
+        return []
+    if connection is None:
+        with get_connection() as conn:
+            return insert_soro_records_bulk(sections_by_song, conn, page_size)
+
+    conn = connection
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-
-        # 既存の無音区間を取得
-        cursor.execute("""
-            SELECT start_time, end_time FROM "Soro" WHERE song_id = %s
-        """, (song_id,))
-        existing_sections = cursor.fetchall()
-
-        insert_query = """
-            INSERT INTO "Soro" (song_id, start_time, end_time, is_guitar_soro, guitar_score)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        new_records_count = 0
-        for section in silence_sections:
-            start_time, end_time = section
-            # 重複チェック
-            is_duplicate = False
-            for existing_start, existing_end in existing_sections:
-                if (start_time == existing_start and end_time == existing_end) or \
-                   (start_time >= existing_start and start_time <= existing_end) or \
-                   (end_time >= existing_start and end_time <= existing_end):
-                    is_duplicate = True
-                    print(f"重複している区間: {start_time} - {end_time}")
-                    break
-
-            if not is_duplicate:
-                cursor.execute(insert_query, (song_id, start_time, end_time, False, None))
+        with conn.cursor() as cursor:
+            inserted = execute_values(
+                cursor, BULK_INSERT_SORO_QUERY, rows,
+                template=BULK_INSERT_SORO_TEMPLATE, page_size=page_size, fetch=True
+            )
         conn.commit()
-        print(f"soroテーブルに{len(silence_sections)}件のレコードを挿入しました。")
+        print(f"soroテーブルに{len(inserted)}件のレコードを挿入しました"
+              f"（{len(sections_by_song)}曲, 重複除外: {len(rows) - len(inserted)}件）。")
+        return inserted
     except Exception as e:
+        conn.rollback()
         print(f"データベースへの挿入中にエラーが発生しました: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+        raise
+
+def insert_soro_records(song_id, silence_sections):
+    """
+    検出された無音区間をsoroテーブルに挿入する。ただし、既存のレコードと重複しないようにする。
+    """
+    try:
+        insert_soro_records_bulk({song_id: silence_sections})
+    except Exception:
+        pass  # エラー内容はinsert_soro_records_bulkで出力済み
 
 def extract_song_id(folder_name):
     """
@@ -120,43 +163,111 @@ def extract_song_id(folder_name):
         print(f"フォルダ名 '{folder_name}' からsong_idを抽出できませんでした: {e}")
         return None
 
-def process_all_vocal_files():
+def analyze_vocal_folder(job):
+    """
+    1曲分のボーカルステムから無音区間を検出する（プロセスプールのワーカーから呼ばれる）
+    """
+    folder, vocals_file, options = job
+    print(f"\nProcessing vocals in folder: {folder}")
+    return detect_silent_sections(vocals_file, silence_threshold=0, min_silence_duration=5, **options)
+
+def process_all_vocal_files(streaming=False, block_size=STREAM_BLOCK_SIZE, workers=1,
+                            insert_batch_songs=INSERT_BATCH_SONGS, stem_cache_max_bytes=None):
     """
     実行日のYYYYMMDDに基づいてhtdemucs_6s配下の全てのvocals.mp3ファイルを処理
+    workers > 1 の場合は曲ごとにプロセスを分けて並列に分析し、結果は入力順にDBへ書き込む
+    DBへはinsert_batch_songs曲ごとにまとめて挿入する
     """
     from datetime import datetime
     base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'../../music/separated/{datetime.now().strftime("%Y%m%d")}/htdemucs_6s')
     print(f"base_dir: {base_dir}")
     # htdemucs_6s配下のフォルダを走査
+    track_dirs = []
     for folder in os.listdir(base_dir):
         folder_path = os.path.join(base_dir, folder)
         if os.path.isdir(folder_path):
-            vocals_file = os.path.join(folder_path, 'vocals.wav')
-            if os.path.exists(vocals_file):
-                print(f"\nProcessing vocals in folder: {folder}")
-                try:
-                    silent_sections = detect_silent_sections(vocals_file, silence_threshold=0, min_silence_duration=5)
-                    print(f"\nDetected silent sections in {folder}:")
-                    for start, end in silent_sections:
-                        print(f"Start: {start:.2f}s, End: {end:.2f}s")
-                    
-                    # フォルダ名からsong_idを抽出
-                    song_id = extract_song_id(folder)
-                    if song_id is None:
-                        print(f"song_idの取得に失敗したため、{folder}の処理をスキップします。")
-                        continue
-                    
-                    # データベースに挿入
-                    insert_soro_records(song_id, silent_sections)
-                    
-                except Exception as e:
-                    print(f"{folder}の処理に失敗しました: {e}")
+            track_dirs.append(folder_path)
         else:
             print(f"フォルダ {folder} が見つかりません。")
+    analyze_vocal_folders(track_dirs, streaming, block_size, workers, insert_batch_songs, stem_cache_max_bytes)
+
+def analyze_vocal_folders(track_dirs, streaming=False, block_size=STREAM_BLOCK_SIZE, workers=1,
+                          insert_batch_songs=INSERT_BATCH_SONGS, stem_cache_max_bytes=None):
+    """
+    曲フォルダのリストについてボーカルステムの無音区間を検出し、soroテーブルに挿入する
+    戻り値は分析してsoroテーブルへの挿入まで成功した曲のsong_idのリスト
+    """
+    options = {"streaming": streaming, "block_size": block_size, "stem_cache_max_bytes": stem_cache_max_bytes}
+    jobs = []
+    for folder_path in track_dirs:
+        vocals_file = find_stem(folder_path, 'vocals')
+        if vocals_file is not None:
+            jobs.append((os.path.basename(folder_path), vocals_file, options))
+        else:
+            print(f"ボーカルステムが見つかりません: {folder_path}")
+
+    analyzed = []
+    pending_sections = {}
+    for job, silent_sections, error in run_ordered(analyze_vocal_folder, jobs, workers=workers):
+        folder = job[0]
+        if error is not None:
+            print(f"{folder}の処理に失敗しました: {error}")
+            continue
+        print(f"\nDetected silent sections in {folder}:")
+        for start, end in silent_sections:
+            print(f"Start: {start:.2f}s, End: {end:.2f}s")
+
+        # フォルダ名からsong_idを抽出
+        song_id = extract_song_id(folder)
+        if song_id is None:
+            print(f"song_idの取得に失敗したため、{folder}の処理をスキップします。")
+            continue
+        pending_sections[song_id] = silent_sections
+
+        # 一定曲数ごとにまとめてデータベースに挿入
+        if len(pending_sections) >= insert_batch_songs:
+            analyzed.extend(flush_soro_records(pending_sections))
+
+    analyzed.extend(flush_soro_records(pending_sections))
+    return analyzed
+
+def flush_soro_records(pending_sections):
+    """溜まった曲の無音区間を一括挿入してバッファを空にし、挿入できた曲のsong_idのリストを返す"""
+    song_ids = list(pending_sections)
+    if not song_ids:
+        return []
+    try:
+        insert_soro_records_bulk(pending_sections)
+    except Exception as e:
+        print(f"{len(pending_sections)}曲分の挿入に失敗しました: {e}")
+        song_ids = []
+    pending_sections.clear()
+    return song_ids
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ボーカルトラックの間奏区間分析")
+    parser.add_argument("--streaming", action="store_true",
+                        help="ボーカルトラックをブロック単位で読み込み、一定メモリで処理する")
+    parser.add_argument("--block-size", type=int, default=STREAM_BLOCK_SIZE,
+                        help="ストリーミング時に一度に読み込むサンプル数")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="並列に分析するプロセス数")
+    parser.add_argument("--insert-batch-songs", type=int, default=INSERT_BATCH_SONGS,
+                        help="soroテーブルへ一括挿入する曲数")
+    parser.add_argument("--stem-cache", action="store_true",
+                        help="デコード済みのステムをキャッシュし、再実行時はメモリマップで読み込む")
+    parser.add_argument("--stem-cache-max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="ステムキャッシュの上限サイズ（GB）。超えた場合は古いものから削除")
+    return parser.parse_args(argv)
 
-def main():
+def main(argv=None):
+    args = parse_args(argv)
     try:
-        process_all_vocal_files()
+        process_all_vocal_files(
+            streaming=args.streaming, block_size=args.block_size,
+            workers=args.workers, insert_batch_songs=args.insert_batch_songs,
+            stem_cache_max_bytes=int(args.stem_cache_max_gb * 1024 ** 3) if args.stem_cache else None
+        )
         return 0  # 正常終了
     except Exception as e:
         print(f"間奏区間分析でエラーが発生しました: {e}")
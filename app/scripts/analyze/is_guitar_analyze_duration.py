@@ -2,18 +2,25 @@
 
 import os
 from decimal import Decimal
-import tensorflow as tf
-import tensorflow_hub as hub
 import librosa
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 import logging
-import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 from datetime import datetime
 import re
-from ..db.config import DB_CONFIG  # config.pyからDB設定をインポート
+import time
+from ..db.pool import SORO_TABLE, execute_prepared, get_connection  # 共有の接続プール
+from .parallel import run_ordered
+from . import yamnet_model
+from .yamnet_model import (  # 推論デーモンからも使うYAMNetのロードと推論（DBに依存しない）
+    LOCAL_YAMNET_PATH, YAMNET_MODEL_HANDLE, YAMNET_PATCH_HOP_SAMPLES, YAMNET_PATCH_SAMPLES,
+    get_batch_scorer, guitar_score_timeline_local, init_yamnet, load_yamnet_model, yamnet_patch_count
+)
+from .yamnet_daemon import DEFAULT_SOCKET_PATH, connect_daemon
+from .stem_cache import DEFAULT_MAX_BYTES, load_stem
+from ..separate.stems import find_stem, read_stem
+import argparse
 import sys
 
 # ロギングの設定
@@ -22,88 +29,144 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# モデルを保存するローカルパス
-LOCAL_YAMNET_PATH = 'app/models/yamnet'
-YAMNET_MODEL_HANDLE = 'https://tfhub.dev/google/yamnet/1'
+SEGMENT_DURATION = 5  # 推論するセグメントの長さ（秒）
+INFERENCE_BATCH_SIZE = 32  # 1回の推論でまとめるセグメント数
+YAMNET_FRAME_SECONDS = 0.48  # YAMNetのフレーム間隔（秒）
+TIMELINE_SUFFIX = '.yamnet_timeline.npy'  # 曲全体のギタースコアを保存するファイルの接尾辞
+UPDATE_FLUSH_SIZE = 500  # soroテーブルへまとめて書き込む行数
 
-def load_yamnet_model(model_handle, local_path=LOCAL_YAMNET_PATH):
-    """YAMNetモデルをロード（ローカルに存在しない場合はダウンロード）"""
-    
-    # ディレクトリが存在しない場合は作成
-    os.makedirs(local_path, exist_ok=True)
+# 推論デーモンに接続できた場合のクライアント（Noneの場合はプロセス内で推論）
+daemon_client = None
 
-    # `saved_model.pb` の存在をチェック
-    if not os.path.exists(os.path.join(local_path, "saved_model.pb")):
-        logging.info("YAMNetモデルをダウンロード中...")
-        try:
-            yamnet = hub.load(model_handle)
-            # モデルを保存（saved_model.pb を含む形式）
-            tf.saved_model.save(yamnet, local_path)
-            logging.info(f"モデルをローカルに保存しました: {local_path}")
-        except Exception as e:
-            logging.error(f"モデルのダウンロードまたは保存に失敗しました: {e}")
-            raise
+def init_worker(socket_path=None):
+    """
+    推論プロセスの初期化。デーモンが起動していればそれを使い、
+    起動していなければプロセス内でYAMNetをロードする
+    """
+    global daemon_client
+    daemon_client = connect_daemon(socket_path) if socket_path else None
+    if daemon_client is not None:
+        logging.info(f"YAMNet推論デーモンを使用します: {socket_path}")
     else:
-        logging.info(f"ローカルからYAMNetモデルをロードします: {local_path}")
-        try:
-            yamnet = tf.saved_model.load(local_path)
-        except Exception as e:
-            logging.error(f"ローカルモデルのロードに失敗しました: {e}")
-            raise
+        init_yamnet()
 
-    return yamnet
-
-# YAMNetモデルのロード
-yamnet = load_yamnet_model(YAMNET_MODEL_HANDLE)
-# クラスマップのロード
-class_map_path = yamnet.class_map_path().numpy().decode('utf-8')
-class_names = list(pd.read_csv(class_map_path)['display_name'])
-
-# ギター関連カテゴリのインデックスを特定
-guitar_related_indices = []
-try:
-    guitar_related_indices = [
-        class_names.index('Electric guitar'),
-        class_names.index('Guitar'),
-        class_names.index('Plucked string instrument')
-    ]
-    logging.info(f"Guitar-related indices: {guitar_related_indices}")
-except ValueError as e:
-    logging.error(f"ギター関連カテゴリがクラスマップに存在しません: {e}")
-    raise
+def _daemon_failed(e):
+    """デーモンとの通信に失敗した場合はプロセス内推論に切り替える"""
+    global daemon_client
+    logging.warning(f"YAMNet推論デーモンとの通信に失敗したため、プロセス内で推論します: {e}")
+    daemon_client = None
+    init_yamnet()
 
 def load_audio(file_path, target_sr=16000, start_time=None, end_time=None):
     """音声データをロードして16000Hzにリサンプリング。開始時間と終了時間を指定可能"""
     try:
-        waveform, sr = librosa.load(file_path, sr=target_sr, offset=start_time, duration=(end_time - start_time) if end_time else None)
+        if file_path.endswith('.npy'):
+            waveform, sr = read_stem(file_path, sr=target_sr)
+            return slice_interval(waveform, sr, start_time, end_time), sr
+        waveform, sr = librosa.load(file_path, sr=target_sr, offset=start_time or 0.0, duration=(end_time - (start_time or 0.0)) if end_time else None)
         return waveform, sr
     except Exception as e:
         logging.error(f"音声ファイルのロードに失敗しました ({file_path}): {e}")
         raise
 
+def load_song_waveform(audio_file, stem_cache_max_bytes=None):
+    """
+    曲全体を16000Hzで読み込む
+    stem_cache_max_bytesを指定した場合はデコード済みステムのキャッシュ（メモリマップ）を使う
+    """
+    if stem_cache_max_bytes is not None:
+        return load_stem(audio_file, sr=16000, max_bytes=stem_cache_max_bytes)
+    return load_audio(audio_file)
+
 def segment_audio(waveform, segment_duration, sr=16000):
     """音声を短いセグメントに分割"""
     segment_samples = int(segment_duration * sr)
     return [waveform[i:i + segment_samples] for i in range(0, len(waveform), segment_samples)]
 
-def detect_guitar_in_segments(audio_file, segment_duration=5, start_time=None, end_time=None):
-    """セグメントごとにギター関連カテゴリのスコアを検出。指定された時間範囲内で実行"""
-    waveform, sr = load_audio(audio_file, start_time=start_time, end_time=end_time)
+def slice_interval(waveform, sr, start_time=None, end_time=None):
+    """デコード済みの波形から指定した時間範囲を切り出す（コピーは発生しない）"""
+    start = int(round(start_time * sr)) if start_time else 0
+    end = int(round(end_time * sr)) if end_time else len(waveform)
+    return waveform[start:end]
+
+def detect_guitar_in_segments(audio_file, segment_duration=5, start_time=None, end_time=None, waveform=None, sr=16000):
+    """
+    セグメントごとにギター関連カテゴリのスコアを検出。指定された時間範囲内で実行
+    waveformにデコード済みの16000Hz波形を渡した場合はファイルを読み直さずに切り出して使う
+    """
+    if waveform is None:
+        waveform, sr = load_audio(audio_file, start_time=start_time, end_time=end_time)
+    else:
+        waveform = slice_interval(waveform, sr, start_time, end_time)
     segments = segment_audio(waveform, segment_duration, sr)
+    return score_segments_eager(segments, audio_file), segment_duration
+
+def score_segments_eager(segments, audio_file):
+    """セグメントを1つずつYAMNetで推論し、ギター関連スコア合計の最大値を返す"""
+    import tensorflow as tf
+    model = init_yamnet()
     segment_scores = []
     for segment in segments:
         try:
-            scores, embeddings, spectrogram = yamnet(segment)
-            combined_score = tf.reduce_sum(tf.gather(scores, guitar_related_indices, axis=1), axis=1)
+            scores, embeddings, spectrogram = model(segment)
+            combined_score = tf.reduce_sum(tf.gather(scores, yamnet_model.guitar_related_indices, axis=1), axis=1)
             max_score = tf.reduce_max(combined_score).numpy()
             segment_scores.append(max_score)
         except Exception as e:
             logging.error(f"YAMNet推論中にエラーが発生しました ({audio_file}): {e}")
             segment_scores.append(0)
-    return segment_scores, segment_duration
+    return segment_scores
+
+def score_padded_batch(batch, patch_counts):
+    """ゼロ埋め済みのバッチを推論する（デーモンに接続していればデーモンに依頼する）"""
+    if daemon_client is not None:
+        try:
+            return daemon_client.score_batch(batch, patch_counts)
+        except OSError as e:
+            _daemon_failed(e)
+    return get_batch_scorer(batch.shape[1])(batch, patch_counts).numpy()
+
+def score_segments_batched(segments, segment_samples, audio_file, batch_size=INFERENCE_BATCH_SIZE):
+    """
+    セグメントを固定長にゼロ埋めしてバッチ推論し、ギター関連スコア合計の最大値を返す
+    結果はscore_segments_eagerと同じになる
+    """
+    segment_scores = []
+    for i in range(0, len(segments), batch_size):
+        chunk = segments[i:i + batch_size]
+        batch = np.zeros((len(chunk), segment_samples), dtype=np.float32)
+        patch_counts = np.empty(len(chunk), dtype=np.int32)
+        for j, segment in enumerate(chunk):
+            batch[j, :len(segment)] = segment
+            patch_counts[j] = yamnet_patch_count(len(segment))
+        try:
+            segment_scores.extend(score_padded_batch(batch, patch_counts).tolist())
+        except Exception as e:
+            logging.error(f"YAMNetのバッチ推論中にエラーが発生しました ({audio_file}): {e}")
+            segment_scores.extend(score_segments_eager(chunk, audio_file))
+    return segment_scores
+
+def score_intervals_batched(audio_file, waveform, sr, intervals, segment_duration=SEGMENT_DURATION,
+                            batch_size=INFERENCE_BATCH_SIZE):
+    """
+    複数区間のセグメントをまとめてバッチ推論し、区間ごとのセグメントスコアのリストを返す
+    """
+    segment_samples = int(segment_duration * sr)
+    segments = []
+    owners = []
+    for index, (_, start_time, end_time) in enumerate(intervals):
+        for segment in segment_audio(slice_interval(waveform, sr, start_time, end_time), segment_duration, sr):
+            segments.append(segment)
+            owners.append(index)
+
+    interval_scores = [[] for _ in intervals]
+    for owner, score in zip(owners, score_segments_batched(segments, segment_samples, audio_file, batch_size)):
+        interval_scores[owner].append(score)
+    return interval_scores, len(segments)
 
 def visualize_combined_scores(all_segment_scores, segment_duration):
     """セグメントごとの統合スコアをプロット"""
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(15, 5))
     for audio_file, segment_scores in all_segment_scores.items():
         time_bins = np.arange(len(segment_scores)) * segment_duration
@@ -138,12 +201,7 @@ def get_guitar_intervals(song_id, connection):
     """
     try:
         with connection.cursor() as cursor:
-            query = sql.SQL("""
-                SELECT soro_id, start_time, end_time 
-                FROM "Soro" 
-                WHERE song_id = %s 
-            """)
-            cursor.execute(query, (song_id,))
+            execute_prepared(cursor, "select_soro_intervals", (song_id,))
             intervals = cursor.fetchall()
             logging.info(f"song_id {song_id} のギター区間: {intervals}")
             return intervals
@@ -175,42 +233,258 @@ def update_soro_record(soro_id, is_guitar_detected, guitar_score, connection):
         logging.error(f"soro_id {soro_id} のレコード更新中にエラーが発生しました: {e}")
         raise
 
-def main():
-    try:
-        # データベースに接続
-        connection = psycopg2.connect(**DB_CONFIG)
-        connection.autocommit = True  # 自動コミットを有効にする
-        logging.info("データベースに正常に接続しました。")
-    except Exception as e:
-        logging.error(f"データベースへの接続に失敗しました: {e}")
-        raise
+BULK_UPDATE_SORO_QUERY = f"""
+    UPDATE {SORO_TABLE} AS soro
+    SET is_guitar_soro = updates.is_guitar_soro,
+        guitar_score = updates.guitar_score
+    FROM (VALUES %s) AS updates (soro_id, is_guitar_soro, guitar_score)
+    WHERE soro.soro_id = updates.soro_id
+"""
+BULK_UPDATE_SORO_TEMPLATE = "(%s::integer, %s::boolean, %s::double precision)"
+
+class SoroUpdateBuffer:
+    """
+    soroテーブルの判定結果を溜めておき、flush_size行ごとに
+    1つのUPDATE ... FROM (VALUES ...) と1回のコミットでまとめて書き込む
+    """
+
+    def __init__(self, connection, flush_size=UPDATE_FLUSH_SIZE):
+        self.connection = connection
+        self.flush_size = flush_size
+        self.rows = []
+        self.row_song_ids = []  # rowsと同じ順の、行ごとのsong_id（指定された場合）
+        self.written_rows = 0
+        self.failed_rows = 0
+        self.written_songs = {}  # {song_id: 書き込めた行数}
+        self.write_seconds = 0.0
+
+    def add(self, soro_id, is_guitar_detected, guitar_score, song_id=None):
+        guitar_score_value = float(guitar_score) if guitar_score is not None else None
+        self.rows.append((soro_id, bool(is_guitar_detected), guitar_score_value))
+        self.row_song_ids.append(song_id)
+        if len(self.rows) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        started = time.perf_counter()
+        try:
+            with self.connection.cursor() as cursor:
+                execute_values(cursor, BULK_UPDATE_SORO_QUERY, self.rows,
+                               template=BULK_UPDATE_SORO_TEMPLATE, page_size=len(self.rows))
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            logging.error(f"soroテーブルの一括更新中にエラーが発生しました ({len(self.rows)}件): {e}")
+            # 失敗した行を残すと以降のflushも同じ行で失敗し続けるため破棄する
+            self.failed_rows += len(self.rows)
+            self.rows = []
+            self.row_song_ids = []
+            raise
+        finally:
+            self.write_seconds += time.perf_counter() - started
+        logging.info(f"soroテーブルの{len(self.rows)}件のレコードを更新しました。")
+        self.written_rows += len(self.rows)
+        for song_id in self.row_song_ids:
+            if song_id is not None:
+                self.written_songs[song_id] = self.written_songs.get(song_id, 0) + 1
+        self.rows = []
+        self.row_song_ids = []
+
+    @property
+    def rows_per_second(self):
+        return self.written_rows / self.write_seconds if self.write_seconds > 0 else 0.0
+
+def guitar_score_timeline(waveform):
+    """曲全体の波形をYAMNetで1回だけ推論し、フレーム（0.48秒間隔）ごとのギター関連スコア合計を返す"""
+    if daemon_client is not None:
+        try:
+            return daemon_client.timeline(waveform)
+        except OSError as e:
+            _daemon_failed(e)
+    return guitar_score_timeline_local(waveform)
+
+def timeline_path(audio_file):
+    return os.path.splitext(audio_file)[0] + TIMELINE_SUFFIX
+
+def load_or_compute_timeline(audio_file, stem_cache_max_bytes=None):
+    """
+    保存済みのギタースコアの時系列があれば再利用し、なければ推論して保存する
+    音声ファイルの方が新しい場合は再計算する
+    戻り値は (時系列, 推論を実行したかどうか)
+    """
+    path = timeline_path(audio_file)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(audio_file):
+        return np.load(path), False
+
+    waveform, _ = load_song_waveform(audio_file, stem_cache_max_bytes)
+    timeline = guitar_score_timeline(waveform)
+    np.save(path, timeline)
+    return timeline, True
+
+def build_sparse_table(values):
+    """区間最大値を O(1) で求めるためのスパーステーブルを構築"""
+    table = [np.asarray(values, dtype=np.float64)]
+    width = 1
+    while width * 2 <= len(values):
+        previous = table[-1]
+        table.append(np.maximum(previous[:-width], previous[width:]))
+        width *= 2
+    return table
+
+def range_max(table, lo, hi):
+    """スパーステーブルからvalues[lo:hi+1]の最大値を求める"""
+    level = (hi - lo + 1).bit_length() - 1
+    return max(table[level][lo], table[level][hi - (1 << level) + 1])
+
+def timeline_frame_range(num_frames, start_time, end_time):
+    """
+    区間 [start_time, end_time] に中心が入るYAMNetフレームの範囲 (lo, hi) を返す
+    該当するフレームがない短い区間は中心に最も近いフレームを使う
+    """
+    half_window = YAMNET_FRAME_SECONDS  # フレームの窓は0.96秒なので中心は開始から0.48秒後
+    lo = max(0, int(np.ceil((start_time - half_window) / YAMNET_FRAME_SECONDS)))
+    hi = min(num_frames - 1, int(np.floor((end_time - half_window) / YAMNET_FRAME_SECONDS)))
+    if hi < lo:
+        center = (start_time + end_time) / 2
+        nearest = int(round((center - half_window) / YAMNET_FRAME_SECONDS))
+        lo = hi = min(max(nearest, 0), num_frames - 1)
+    return lo, hi
+
+def score_intervals_from_timeline(timeline, intervals):
+    """曲全体のスコア時系列から区間ごとの最大スコアを求める（追加の推論は不要）"""
+    table = build_sparse_table(timeline)
+    interval_scores = []
+    for _, start_time, end_time in intervals:
+        lo, hi = timeline_frame_range(len(timeline), float(start_time), float(end_time))
+        interval_scores.append([float(range_max(table, lo, hi))])
+    return interval_scores
+
+def score_song_intervals(job):
+    """
+    1曲分のギター区間をYAMNetで判定する（プロセスプールのワーカーから呼ばれる）
+    ギターステムは1回だけデコード・リサンプリングし、各区間はメモリ上の波形から切り出す
+    scoring='timeline'の場合は曲全体のスコア時系列から区間ごとの最大値を求める
+    戻り値は (区間ごとの (soro_id, start_time, end_time, segment_scores) のリスト, 統計情報)
+    """
+    audio_file, intervals, options = job
+    batch_size = options["batch_size"]
+    for soro_id, start_time, end_time in intervals:
+        logging.info(f"Processing {audio_file} の時間範囲: {start_time} - {end_time} 秒 (soro_id: {soro_id})")
+
+    started = time.perf_counter()
+    if options["scoring"] == "timeline":
+        timeline, inferred = load_or_compute_timeline(audio_file, options["stem_cache_max_bytes"])
+        interval_scores = score_intervals_from_timeline(timeline, intervals)
+        return _build_song_results(intervals, interval_scores, {
+            "saved_decodes": len(intervals) - 1 if inferred else len(intervals),
+            "segments": len(timeline) if inferred else 0,
+            "inference_seconds": time.perf_counter() - started if inferred else 0.0,
+        })
+
+    waveform, sr = load_song_waveform(audio_file, options["stem_cache_max_bytes"])
+    if batch_size > 0:
+        interval_scores, segment_count = score_intervals_batched(
+            audio_file, waveform, sr, intervals, SEGMENT_DURATION, batch_size
+        )
+    else:
+        interval_scores = [
+            detect_guitar_in_segments(
+                audio_file,
+                segment_duration=SEGMENT_DURATION,
+                start_time=start_time,
+                end_time=end_time,
+                waveform=waveform,
+                sr=sr
+            )[0]
+            for _, start_time, end_time in intervals
+        ]
+        segment_count = sum(len(scores) for scores in interval_scores)
+    return _build_song_results(intervals, interval_scores, {
+        "saved_decodes": len(intervals) - 1,
+        "segments": segment_count,
+        "inference_seconds": time.perf_counter() - started,
+    })
+
+def _build_song_results(intervals, interval_scores, stats):
+    results = [
+        (soro_id, start_time, end_time, segment_scores)
+        for (soro_id, start_time, end_time), segment_scores in zip(intervals, interval_scores)
+    ]
+    return results, stats
 
-    # 音声ファイルのパス（動的）
-    base_dir = os.path.join(
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="YAMNetによるギターソロ判定")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="並列に推論するプロセス数（YAMNetはワーカーごとに1回だけロード）")
+    parser.add_argument("--batch-size", type=int, default=INFERENCE_BATCH_SIZE,
+                        help="1回の推論でまとめるセグメント数（0の場合はセグメントごとに推論）")
+    parser.add_argument("--scoring", choices=["segments", "timeline"], default="segments",
+                        help="segments: 区間ごとに5秒セグメントで推論 / timeline: 曲全体を1回推論して区間ごとに集計")
+    parser.add_argument("--daemon-socket", default=DEFAULT_SOCKET_PATH,
+                        help="YAMNet推論デーモンのソケット（起動していなければプロセス内で推論）")
+    parser.add_argument("--stem-cache", action="store_true",
+                        help="16000Hzにデコード済みのステムをキャッシュし、再実行時はメモリマップで読み込む")
+    parser.add_argument("--stem-cache-max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="ステムキャッシュの上限サイズ（GB）。超えた場合は古いものから削除")
+    parser.add_argument("--flush-size", type=int, default=UPDATE_FLUSH_SIZE,
+                        help="soroテーブルへまとめて書き込む行数")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="推論デーモンを使わずにプロセス内で推論する")
+    return parser.parse_args(argv)
+
+def separated_base_dir():
+    """実行日の分離結果のディレクトリ"""
+    return os.path.join(
         os.path.dirname(os.path.abspath(__file__)),
         f'../../music/separated/{datetime.now().strftime("%Y%m%d")}/htdemucs_6s'
     )
+
+def find_guitar_files(base_dir=None):
+    """分離結果のディレクトリから曲ごとのギターステムを探す"""
+    base_dir = base_dir or separated_base_dir()
+    if not os.path.exists(base_dir):
+        logging.error(f"ベースディレクトリが存在しません: {base_dir}")
+        raise FileNotFoundError(f"ベースディレクトリが存在しません: {base_dir}")
+
     audio_files = []
-    try:
-        if not os.path.exists(base_dir):
-            logging.error(f"ベースディレクトリが存在しません: {base_dir}")
-            raise FileNotFoundError(f"ベースディレクトリが存在しません: {base_dir}")
-
-        for root, dirs, files in os.walk(base_dir):
-            for file in files:
-                if file == 'guitar.wav':
-                    file_path = os.path.join(root, file)
-                    if os.path.isfile(file_path):
-                        audio_files.append(file_path)
-                        logging.info(f"ファイルを追加: {file_path}")
-                    else:
-                        logging.warning(f"ファイルが存在しませんまたはアクセスできません: {file_path}")
+    for folder in sorted(os.listdir(base_dir)):
+        folder_path = os.path.join(base_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        file_path = find_stem(folder_path, 'guitar')
+        if file_path is not None:
+            audio_files.append(file_path)
+            logging.info(f"ファイルを追加: {file_path}")
+        else:
+            logging.warning(f"ギターステムが存在しませんまたはアクセスできません: {folder_path}")
+    if not audio_files:
+        logging.warning(f"ベースディレクトリ内にギターステムが見つかりませんでした: {base_dir}")
+    return audio_files
 
-        if not audio_files:
-            logging.warning(f"ベースディレクトリ内に'guitar.wav'ファイルが見つかりませんでした: {base_dir}")
-            return 0  # 正常終了
+def analyze_guitar_files(audio_files, workers=1, batch_size=INFERENCE_BATCH_SIZE, scoring="segments",
+                         socket_path=DEFAULT_SOCKET_PATH, stem_cache_max_bytes=None,
+                         flush_size=UPDATE_FLUSH_SIZE, visualize=False):
+    """
+    ギターステムのリストについて、DBのギター区間をYAMNetで判定してsoroテーブルを更新する
+    戻り値は全区間の判定結果を書き込めた曲の {song_id: 更新したレコード数}
+    （ギター区間がない曲は0件で含め、読み込み・判定・書き込みに一部でも失敗した曲は含めない）
+    """
+    options = {
+        "batch_size": batch_size,
+        "scoring": scoring,
+        "stem_cache_max_bytes": stem_cache_max_bytes,
+    }
+    all_segment_scores = {}
+    with get_connection() as connection:
+        connection.autocommit = False  # 更新はSoroUpdateBufferでまとめてコミットする
+        logging.info("データベースに正常に接続しました。")
 
-        all_segment_scores = {}
+        # DBからギター区間を取得（DB接続はメインプロセスのみで扱う）
+        jobs = []
+        no_interval_songs = []
+        interval_counts = {}  # {song_id: ギター区間数}
         for audio_file in audio_files:
             try:
                 # song_idを抽出
@@ -219,17 +493,38 @@ def main():
                 intervals = get_guitar_intervals(song_id, connection)
                 if not intervals:
                     logging.info(f"song_id {song_id} に対応するギター区間がDBに存在しません。")
+                    no_interval_songs.append(song_id)
                     continue
+                interval_counts[song_id] = len(intervals)
+                jobs.append((audio_file, intervals, options))
+            except Exception as e:
+                # 中断されたトランザクションのままだと以降の曲の読み込みも全て失敗するためロールバックする
+                connection.rollback()
+                logging.error(f"ファイルの処理中にエラーが発生しました ({audio_file}): {e}")
+
+        connection.commit()  # 区間の読み込みトランザクションを終了
 
-                for interval in intervals:
-                    soro_id, start_time, end_time = interval
-                    logging.info(f"Processing {audio_file} の時間範囲: {start_time} - {end_time} 秒 (soro_id: {soro_id})")
-                    segment_scores, segment_duration = detect_guitar_in_segments(
-                        audio_file, 
-                        segment_duration=5, 
-                        start_time=start_time, 
-                        end_time=end_time
-                    )
+        update_buffer = SoroUpdateBuffer(connection, flush_size=flush_size)
+        decode_count = 0
+        saved_decode_count = 0
+        segment_count = 0
+        inference_seconds = 0.0
+        for job, result, error in run_ordered(score_song_intervals, jobs, workers=workers,
+                                              initializer=init_worker, initargs=(socket_path,)):
+            audio_file = job[0]
+            if error is not None:
+                logging.error(f"ファイルの処理中にエラーが発生しました ({audio_file}): {error}")
+                continue
+            results, stats = result
+            decode_count += 1
+            saved_decode_count += stats["saved_decodes"]
+            segment_count += stats["segments"]
+            inference_seconds += stats["inference_seconds"]
+            song_id = extract_song_id(audio_file)
+            try:
+                # 途中の区間で失敗した曲の結果を書き込まないよう、全区間の判定が終わってからまとめて追加する
+                song_rows = []
+                for soro_id, start_time, end_time, segment_scores in results:
                     key = f"{audio_file} ({start_time}-{end_time}s)"
                     all_segment_scores[key] = segment_scores
 
@@ -241,19 +536,50 @@ def main():
                     else:
                         logging.info(f"指定された時間範囲内でギターは検出されませんでした ({key}) (最大スコア: {max_score:.2f})")
 
-                    # soroレコードを更新
-                    update_soro_record(soro_id, is_guitar_detected, max_score, connection)
+                    song_rows.append((soro_id, is_guitar_detected, max_score))
+
+                # soroレコードを更新
+                for soro_id, is_guitar_detected, max_score in song_rows:
+                    update_buffer.add(soro_id, is_guitar_detected, max_score, song_id)
 
             except Exception as e:
+                connection.rollback()
                 logging.error(f"ファイルの処理中にエラーが発生しました ({audio_file}): {e}")
 
-        # スコアの可視化
-        if all_segment_scores:
-            visualize_combined_scores(all_segment_scores, segment_duration)
+        try:
+            update_buffer.flush()
+        except Exception as e:
+            connection.rollback()
+            logging.error(f"soroテーブルの更新に失敗しました: {e}")
+    logging.info(f"soroテーブルの更新: {update_buffer.written_rows}件 "
+                 f"({update_buffer.rows_per_second:.1f} 行/秒)")
+    logging.info(f"デコード・リサンプリング回数: {decode_count}回 (区間ごとの読み込みと比べて{saved_decode_count}回削減)")
+    if inference_seconds > 0:
+        logging.info(f"推論スループット: {segment_count / inference_seconds:.1f} セグメント/秒 "
+                     f"({segment_count}セグメント, {inference_seconds:.1f}秒)")
+
+    # スコアの可視化
+    if visualize and all_segment_scores:
+        visualize_combined_scores(all_segment_scores, SEGMENT_DURATION)
+    written_songs = dict.fromkeys(no_interval_songs, 0)
+    written_songs.update((song_id, count) for song_id, count in update_buffer.written_songs.items()
+                         if count == interval_counts.get(song_id))
+    return written_songs
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        # 音声ファイルのパス（動的）
+        audio_files = find_guitar_files()
+        if not audio_files:
+            return 0  # 正常終了
 
-        # データベース接続を閉じる
-        connection.close()
-        logging.info("データベース接続を閉じました。")
+        analyze_guitar_files(
+            audio_files, workers=args.workers, batch_size=args.batch_size, scoring=args.scoring,
+            socket_path=None if args.no_daemon else args.daemon_socket,
+            stem_cache_max_bytes=int(args.stem_cache_max_gb * 1024 ** 3) if args.stem_cache else None,
+            flush_size=args.flush_size, visualize=True
+        )
         return 0  # 正常終了
     except Exception as e:
         print(f"ギター分析でエラーが発生しました: {e}")
@@ -0,0 +1,65 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+def run_ordered(func, items, workers=1, initializer=None, initargs=(), spawn=False):
+    """
+    itemsをfuncで処理し、(item, 結果, 例外)を入力順に返すジェネレータ。
+    workers > 1 の場合はプロセスプールで並列に処理する（TensorFlow等のためspawnで起動）。
+    spawn=Trueの場合はworkers=1でも新しいプロセスで処理する（initializerを呼び出し元のプロセスで実行しない）。
+    1件の失敗は例外として返すだけで、他の曲の処理は継続する。
+    """
+    items = list(items)
+    workers = max(1, workers)
+    if workers == 1 and not spawn:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    context = multiprocessing.get_context("spawn")
+    next_index = 0
+    isolate_until = 0  # この位置までは1プロセスで1曲ずつ処理し、プールを落とした曲を特定する
+    finished = {}  # プールが落ちる前に処理が終わっていた曲の結果（再実行しない）
+    while next_index < len(items):
+        isolating = next_index < isolate_until
+        end = isolate_until if isolating else len(items)
+        with ProcessPoolExecutor(max_workers=1 if isolating else workers, mp_context=context,
+                                 initializer=initializer, initargs=initargs) as executor:
+            futures = {index: executor.submit(func, items[index])
+                       for index in range(next_index, end) if index not in finished}
+            while next_index < end:
+                item = items[next_index]
+                if next_index in finished:
+                    yield item, finished.pop(next_index), None
+                    next_index += 1
+                    continue
+                try:
+                    result = futures[next_index].result()
+                except BrokenProcessPool as e:
+                    if isolating or workers == 1:
+                        # 1プロセスで1曲だけ処理している間に落ちたので、この曲が原因
+                        logging.error(f"ワーカープロセスが異常終了しました。原因の曲をスキップします: {item} ({e})")
+                        yield item, None, e
+                        next_index += 1
+                    else:
+                        # 並列実行中はどの曲で落ちたか分からないため、未完了の曲を1曲ずつ処理し直す
+                        for index, future in futures.items():
+                            if index > next_index and future.done() and future.exception() is None:
+                                finished[index] = future.result()
+                        unfinished = [index for index in futures if index >= next_index and index not in finished]
+                        isolate_until = unfinished[-1] + 1
+                        logging.error(f"ワーカープロセスが異常終了しました。原因の曲を特定するため"
+                                      f"{len(unfinished)}曲を1曲ずつ処理し直します: {e}")
+                    break
+                except Exception as e:
+                    yield item, None, e
+                else:
+                    yield item, result, None
+                next_index += 1
@@ -0,0 +1,139 @@
+import numpy as np
+
+FRAME_LENGTH = 2048  # フレームサイズ
+HOP_LENGTH = 512     # フレームの間隔
+
+
+def compute_frame_energy(y, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH):
+    """
+    hop_lengthごとのフレームエネルギー（二乗和）を二乗の累積和から一括で計算する。
+    末尾の短いフレームも従来どおり含める。
+    """
+    y = np.asarray(y, dtype=np.float64)
+    cumulative = np.concatenate(([0.0], np.cumsum(y * y)))
+    starts = np.arange(0, len(y), hop_length)
+    ends = np.minimum(starts + frame_length, len(y))
+    return cumulative[ends] - cumulative[starts]
+
+
+def find_silent_runs(silence_frames):
+    """
+    無音フレームの真偽値配列から連続区間を求め、(開始フレーム, 終了フレーム)の配列を返す。
+    終了フレームは区間の直後（最初の有音フレーム）を指す。
+    """
+    padded = np.concatenate(([0], np.asarray(silence_frames, dtype=np.int8), [0]))
+    edges = np.diff(padded)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def group_silent_sections(silence_frames, sr, total_samples, min_silence_duration, hop_length=HOP_LENGTH):
+    """
+    無音フレームを秒単位の[開始, 終了]リストにまとめる。
+    最後まで続く無音区間の終了時間は音声の長さとする。
+    """
+    starts, ends = find_silent_runs(silence_frames)
+    durations = (ends - starts) * hop_length / sr
+    keep = durations >= min_silence_duration
+
+    silence_times = []
+    for start, end in zip(starts[keep], ends[keep]):
+        silence_start = start * hop_length / sr
+        if end >= len(silence_frames):
+            silence_end = total_samples / sr
+        else:
+            silence_end = end * hop_length / sr
+        silence_times.append([float(silence_start), float(silence_end)])
+        print(f"Detected silence from {silence_start:.2f}s to {silence_end:.2f}s")
+    return silence_times
+
+
+class StreamingSilenceDetector:
+    """
+    ブロック単位で音声を受け取り、一定メモリで無音区間を検出する。
+    フレームの重なり部分と未確定の無音区間はブロックをまたいで持ち越す。
+    """
+
+    def __init__(self, sr, silence_threshold=-30.0, min_silence_duration=5,
+                 frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH):
+        self.sr = sr
+        self.silence_threshold = silence_threshold
+        self.min_silence_duration = min_silence_duration
+        self.frame_length = frame_length
+        self.hop_length = hop_length
+        self._buffer = np.zeros(0, dtype=np.float64)
+        self._buffer_start = 0  # バッファ先頭のサンプル位置
+        self._next_frame_start = 0  # 次に計算するフレームの開始サンプル位置
+        self._frame_index = 0
+        self._open_start = None  # ブロック末尾まで続いている無音区間の開始フレーム
+
+    def feed(self, block):
+        """ブロックを追加し、確定した無音区間のリストを返す"""
+        self._buffer = np.concatenate((self._buffer, np.asarray(block, dtype=np.float64)))
+        buffer_end = self._buffer_start + len(self._buffer)
+        last_start = buffer_end - self.frame_length
+        if last_start < self._next_frame_start:
+            return []
+
+        starts = np.arange(self._next_frame_start, last_start + 1, self.hop_length)
+        energy = self._energy(starts, starts + self.frame_length)
+        self._next_frame_start = int(starts[-1]) + self.hop_length
+
+        drop = min(self._next_frame_start - self._buffer_start, len(self._buffer))
+        self._buffer = self._buffer[drop:]
+        self._buffer_start += drop
+        return self._track(energy)
+
+    def finish(self):
+        """末尾の短いフレームを処理し、残りの無音区間を返す"""
+        total_samples = self._buffer_start + len(self._buffer)
+        sections = []
+        if self._next_frame_start < total_samples:
+            starts = np.arange(self._next_frame_start, total_samples, self.hop_length)
+            ends = np.minimum(starts + self.frame_length, total_samples)
+            sections = self._track(self._energy(starts, ends))
+            self._next_frame_start = total_samples
+
+        if self._open_start is not None:
+            duration = (self._frame_index - self._open_start) * self.hop_length / self.sr
+            if duration >= self.min_silence_duration:
+                sections.append(self._section(self._open_start * self.hop_length / self.sr, total_samples / self.sr))
+            self._open_start = None
+        self._buffer = np.zeros(0, dtype=np.float64)
+        return sections
+
+    def _energy(self, starts, ends):
+        cumulative = np.concatenate(([0.0], np.cumsum(self._buffer * self._buffer)))
+        return cumulative[ends - self._buffer_start] - cumulative[starts - self._buffer_start]
+
+    def _track(self, energy):
+        silence_frames = 10 * np.log10(energy + 1e-6) < self.silence_threshold
+        offset = self._frame_index
+        self._frame_index += len(silence_frames)
+
+        starts, ends = find_silent_runs(silence_frames)
+        starts = starts + offset
+        ends = ends + offset
+        sections = []
+        if self._open_start is not None:
+            if len(starts) and starts[0] == offset:
+                starts[0] = self._open_start
+            else:
+                sections.extend(self._close(self._open_start, offset))
+            self._open_start = None
+
+        if len(ends) and ends[-1] == self._frame_index:
+            self._open_start = int(starts[-1])
+            starts, ends = starts[:-1], ends[:-1]
+
+        for start, end in zip(starts, ends):
+            sections.extend(self._close(start, end))
+        return sections
+
+    def _close(self, start_frame, end_frame):
+        if (end_frame - start_frame) * self.hop_length / self.sr < self.min_silence_duration:
+            return []
+        return [self._section(start_frame * self.hop_length / self.sr, end_frame * self.hop_length / self.sr)]
+
+    def _section(self, silence_start, silence_end):
+        print(f"Detected silence from {silence_start:.2f}s to {silence_end:.2f}s")
+        return [float(silence_start), float(silence_end)]
@@ -0,0 +1,147 @@
+###デコード済みステムのキャッシュ（ファイルハッシュ・サンプルレート・チャンネル構成ごとに.npyで保存）
+
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックなしで動かす
+    fcntl = None
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../music/cache/stems')
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3  # キャッシュ全体の上限サイズ（10GB）
+INDEX_FILE = 'index.json'  # 元ファイルのパス → (サイズ, 更新時刻, ハッシュ) の対応表
+LOCK_FILE = 'index.lock'  # index.jsonの読み込み〜書き込みをプロセス間で直列化するためのロックファイル
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """ファイル内容のSHA-1ハッシュ"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index(cache_dir, index):
+    path = os.path.join(cache_dir, INDEX_FILE)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(temp_path, path)
+
+
+@contextmanager
+def _index_lock(cache_dir):
+    """index.jsonを読んで書き戻すまでの間、他のプロセスの更新を待たせる"""
+    with open(os.path.join(cache_dir, LOCK_FILE), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def source_digest(path, cache_dir=CACHE_DIR):
+    """
+    元ファイルのハッシュを返す。サイズと更新時刻が変わっていなければ記録済みのハッシュを使う
+    ファイルが変更されていた場合、古いハッシュを参照する元ファイルが他になければそのキャッシュを削除する
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with _index_lock(cache_dir):
+        entry = _read_index(cache_dir).get(path)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["digest"]
+
+    digest = file_digest(path)  # ハッシュ計算は時間がかかるのでロックの外で行う
+    with _index_lock(cache_dir):
+        index = _read_index(cache_dir)  # ハッシュ計算中に他のプロセスが更新した分を取り込む
+        old_entry = index.get(path)
+        index[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest}
+        _write_index(cache_dir, index)
+        if old_entry and old_entry["digest"] != digest:
+            # 同じ内容のファイル（別の曲の同一ステムなど）がまだ参照しているハッシュは残す
+            if not any(other["digest"] == old_entry["digest"] for other in index.values()):
+                remove_entries(old_entry["digest"], cache_dir)
+    return digest
+
+
+def cache_key(digest, sr, mono):
+    return f"{digest}_{sr}_{'mono' if mono else 'multi'}"
+
+
+def _is_cache_file(file_name):
+    return file_name.endswith('.npy') and '.tmp' not in file_name
+
+
+def remove_entries(digest, cache_dir=CACHE_DIR):
+    """指定したハッシュのキャッシュを全て削除"""
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(f"{digest}_") and _is_cache_file(file_name):
+            os.remove(os.path.join(cache_dir, file_name))
+            logging.info(f"元ファイルが変更されたためキャッシュを削除しました: {file_name}")
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, keep=None):
+    """最終アクセスが古い順にキャッシュを削除し、合計サイズを上限以下にする"""
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if _is_cache_file(file_name):
+            path = os.path.join(cache_dir, file_name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total -= size
+        logging.info(f"キャッシュの上限を超えたため削除しました: {os.path.basename(path)}")
+
+
+def load_stem(path, sr=None, mono=True, cache_dir=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    ステムをデコード済みのfloat32配列として返す（sr=Noneの場合は元のサンプルレート）
+    キャッシュがあればメモリマップで開くためデコードは発生せず、区間の切り出しもコピーなしで行える
+    戻り値は (波形, サンプルレート)
+    """
+    from ..separate.stems import read_stem, stem_samplerate
+
+    os.makedirs(cache_dir, exist_ok=True)
+    target_sr = sr or stem_samplerate(path)
+    key = cache_key(source_digest(path, cache_dir), target_sr, mono)
+    cache_path = os.path.join(cache_dir, f"{key}.npy")
+
+    if os.path.exists(cache_path):
+        os.utime(cache_path)  # LRU判定用に最終アクセス時刻を更新
+        return np.load(cache_path, mmap_mode='r'), target_sr
+
+    logging.info(f"ステムをデコードしてキャッシュします: {path} (sr={target_sr}, mono={mono})")
+    if mono:
+        waveform, _ = read_stem(path, sr=target_sr)
+    else:
+        import librosa
+        waveform, _ = librosa.load(path, sr=target_sr, mono=False)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+    np.save(temp_path, np.asarray(waveform, dtype=np.float32))
+    os.replace(temp_path, cache_path)
+    evict(cache_dir, max_bytes, keep=cache_path)
+    return np.load(cache_path, mmap_mode='r'), target_sr
@@ -0,0 +1,206 @@
+###YAMNetを常駐させ、Unixソケット経由でギタースコアの推論を受け付けるデーモン
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import numpy as np
+
+DEFAULT_SOCKET_PATH = os.environ.get("YAMNET_DAEMON_SOCKET", "/tmp/music-analizer-yamnet.sock")
+CONNECT_TIMEOUT = 1.0  # ヘルスチェック時のタイムアウト（秒）
+REQUEST_TIMEOUT = 300.0  # 推論リクエストのタイムアウト（秒）
+_HEADER_SIZE = struct.Struct(">I")
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise ConnectionError("ソケットが途中で閉じられました")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, header, arrays=None):
+    """
+    メッセージを送信する
+    形式: [ヘッダ長(4バイト)][JSONヘッダ][配列のバイト列...]
+    """
+    arrays = arrays or {}
+    header = dict(header, arrays=[
+        {"name": name, "dtype": str(array.dtype), "shape": list(array.shape)}
+        for name, array in arrays.items()
+    ])
+    encoded = json.dumps(header).encode("utf-8")
+    sock.sendall(_HEADER_SIZE.pack(len(encoded)) + encoded)
+    for array in arrays.values():
+        sock.sendall(np.ascontiguousarray(array).tobytes())
+
+
+def recv_message(sock):
+    """メッセージを受信し、(ヘッダ, 配列の辞書)を返す"""
+    (header_size,) = _HEADER_SIZE.unpack(_recv_exact(sock, _HEADER_SIZE.size))
+    header = json.loads(_recv_exact(sock, header_size).decode("utf-8"))
+    arrays = {}
+    for spec in header.pop("arrays", []):
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"], dtype=np.int64))
+        data = _recv_exact(sock, count * dtype.itemsize)
+        arrays[spec["name"]] = np.frombuffer(data, dtype=dtype).reshape(spec["shape"])
+    return header, arrays
+
+
+class YamnetDaemonClient:
+    """推論デーモンのクライアント。通信エラーはOSErrorとして呼び出し元に返す"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=REQUEST_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _request(self, header, arrays=None, timeout=None):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout or self.timeout)
+            sock.connect(self.socket_path)
+            send_message(sock, header, arrays)
+            response, result = recv_message(sock)
+        if response.get("status") != "ok":
+            raise ConnectionError(f"デーモンがエラーを返しました: {response.get('error')}")
+        return response, result
+
+    def ping(self):
+        """ヘルスチェック。デーモンの状態を辞書で返す"""
+        response, _ = self._request({"op": "ping"}, timeout=CONNECT_TIMEOUT)
+        return response
+
+    def score_batch(self, batch, patch_counts):
+        """ゼロ埋め済みセグメントのバッチからセグメントごとのギタースコア最大値を求める"""
+        _, result = self._request({"op": "score_batch"}, {
+            "batch": np.asarray(batch, dtype=np.float32),
+            "patch_counts": np.asarray(patch_counts, dtype=np.int32),
+        })
+        return result["scores"]
+
+    def timeline(self, waveform):
+        """曲全体の波形からフレームごとのギタースコアの時系列を求める"""
+        _, result = self._request({"op": "timeline"}, {
+            "waveform": np.asarray(waveform, dtype=np.float32),
+        })
+        return result["timeline"]
+
+
+def connect_daemon(socket_path=DEFAULT_SOCKET_PATH):
+    """デーモンが応答すればクライアントを、起動していなければNoneを返す"""
+    if not os.path.exists(socket_path):
+        return None
+    client = YamnetDaemonClient(socket_path)
+    try:
+        client.ping()
+        return client
+    except OSError as e:
+        logging.info(f"YAMNet推論デーモンに接続できませんでした ({socket_path}): {e}")
+        return None
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        try:
+            header, arrays = recv_message(self.request)
+            op = header.get("op")
+            if op == "ping":
+                send_message(self.request, {
+                    "status": "ok",
+                    "pid": os.getpid(),
+                    "uptime": time.time() - server.started_at,
+                    "requests": server.request_count,
+                })
+                return
+
+            # DBの接続情報がなくても起動できるよう、分析スクリプトではなくモデルのモジュールだけを使う
+            from . import yamnet_model
+            with server.inference_lock:
+                server.request_count += 1
+                if op == "score_batch":
+                    batch = arrays["batch"]
+                    scorer = yamnet_model.get_batch_scorer(batch.shape[1])
+                    scores = scorer(batch, arrays["patch_counts"]).numpy().astype(np.float32)
+                    result = {"scores": scores}
+                elif op == "timeline":
+                    timeline = yamnet_model.guitar_score_timeline_local(arrays["waveform"])
+                    result = {"timeline": np.asarray(timeline, dtype=np.float32)}
+                else:
+                    raise ValueError(f"不明なリクエストです: {op}")
+            send_message(self.request, {"status": "ok"}, result)
+        except Exception as e:
+            logging.error(f"推論リクエストの処理中にエラーが発生しました: {e}")
+            try:
+                send_message(self.request, {"status": "error", "error": str(e)})
+            except OSError:
+                pass
+
+
+class YamnetDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        self.started_at = time.time()
+        self.request_count = 0
+        self.inference_lock = threading.Lock()
+        super().__init__(socket_path, _RequestHandler)
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH):
+    """YAMNetをロードしてデーモンを起動する"""
+    if connect_daemon(socket_path) is not None:
+        logging.error(f"デーモンは既に起動しています: {socket_path}")
+        return 1
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # 前回異常終了時のソケットファイルを削除
+
+    from . import yamnet_model
+    yamnet_model.init_yamnet()
+
+    with YamnetDaemon(socket_path) as server:
+        logging.info(f"YAMNet推論デーモンを起動しました: {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("YAMNet推論デーモンを停止します")
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="YAMNet推論デーモン")
+    parser.add_argument("command", choices=["serve", "status"], help="serve: 起動 / status: ヘルスチェック")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Unixソケットのパス")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        return serve(args.socket)
+
+    client = connect_daemon(args.socket)
+    if client is None:
+        print(f"デーモンは起動していません: {args.socket}")
+        return 1
+    print(json.dumps(client.ping(), ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    sys.exit(main())
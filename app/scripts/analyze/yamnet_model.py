@@ -0,0 +1,122 @@
+###YAMNetのロードとギター関連スコアの推論（DBに依存しないため推論デーモンだけのホストでも使える）
+
+import os
+import logging
+import numpy as np
+
+# モデルを保存するローカルパス
+LOCAL_YAMNET_PATH = 'app/models/yamnet'
+YAMNET_MODEL_HANDLE = 'https://tfhub.dev/google/yamnet/1'
+YAMNET_PATCH_SAMPLES = 15600  # YAMNetの1フレームに必要なサンプル数（0.96秒 + STFT窓）
+YAMNET_PATCH_HOP_SAMPLES = 7680  # YAMNetのフレーム間隔（0.48秒）
+
+def load_yamnet_model(model_handle, local_path=LOCAL_YAMNET_PATH):
+    """YAMNetモデルをロード（ローカルに存在しない場合はダウンロード）"""
+    import tensorflow as tf
+    import tensorflow_hub as hub
+
+    # ディレクトリが存在しない場合は作成
+    os.makedirs(local_path, exist_ok=True)
+
+    # `saved_model.pb` の存在をチェック
+    if not os.path.exists(os.path.join(local_path, "saved_model.pb")):
+        logging.info("YAMNetモデルをダウンロード中...")
+        try:
+            yamnet = hub.load(model_handle)
+            # モデルを保存（saved_model.pb を含む形式）
+            tf.saved_model.save(yamnet, local_path)
+            logging.info(f"モデルをローカルに保存しました: {local_path}")
+        except Exception as e:
+            logging.error(f"モデルのダウンロードまたは保存に失敗しました: {e}")
+            raise
+    else:
+        logging.info(f"ローカルからYAMNetモデルをロードします: {local_path}")
+        try:
+            yamnet = tf.saved_model.load(local_path)
+        except Exception as e:
+            logging.error(f"ローカルモデルのロードに失敗しました: {e}")
+            raise
+
+    return yamnet
+
+# YAMNetはimport時ではなく最初の推論時にロードする
+yamnet = None
+class_names = []
+guitar_related_indices = []
+
+def init_yamnet():
+    """
+    YAMNetモデル・クラスマップ・ギター関連カテゴリのインデックスを準備する。
+    ロード済みの場合は何もしない（プロセスプールのワーカー初期化からも呼ばれる）
+    """
+    global yamnet, class_names, guitar_related_indices
+    if yamnet is not None:
+        return yamnet
+    import pandas as pd
+
+    # YAMNetモデルのロード
+    model = load_yamnet_model(YAMNET_MODEL_HANDLE)
+    # クラスマップのロード
+    class_map_path = model.class_map_path().numpy().decode('utf-8')
+    class_names = list(pd.read_csv(class_map_path)['display_name'])
+
+    # ギター関連カテゴリのインデックスを特定
+    try:
+        guitar_related_indices = [
+            class_names.index('Electric guitar'),
+            class_names.index('Guitar'),
+            class_names.index('Plucked string instrument')
+        ]
+        logging.info(f"Guitar-related indices: {guitar_related_indices}")
+    except ValueError as e:
+        logging.error(f"ギター関連カテゴリがクラスマップに存在しません: {e}")
+        raise
+
+    yamnet = model
+    return yamnet
+
+def yamnet_patch_count(num_samples):
+    """長さnum_samplesの波形に対してYAMNetが出力するフレーム数"""
+    extra_samples = max(0, num_samples - YAMNET_PATCH_SAMPLES)
+    return 1 + int(np.ceil(extra_samples / YAMNET_PATCH_HOP_SAMPLES))
+
+_batch_scorers = {}
+
+def get_batch_scorer(segment_samples):
+    """
+    固定長セグメントのバッチを推論するtf.functionを返す（セグメント長ごとに1回だけトレース）
+    短いセグメントはゼロ埋めされているため、元の長さで出力されるフレームだけを最大値の対象にする
+    """
+    if segment_samples in _batch_scorers:
+        return _batch_scorers[segment_samples]
+    import tensorflow as tf
+
+    model = init_yamnet()
+    num_patches = yamnet_patch_count(segment_samples)
+    num_classes = len(class_names)
+    indices = tf.constant(guitar_related_indices, dtype=tf.int32)
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=[None, segment_samples], dtype=tf.float32),
+        tf.TensorSpec(shape=[None], dtype=tf.int32),
+    ])
+    def score_batch(batch, patch_counts):
+        scores = tf.map_fn(
+            lambda segment: model(segment)[0],
+            batch,
+            fn_output_signature=tf.TensorSpec(shape=[num_patches, num_classes], dtype=tf.float32)
+        )
+        combined_score = tf.reduce_sum(tf.gather(scores, indices, axis=2), axis=2)
+        valid = tf.sequence_mask(patch_counts, num_patches)
+        masked_score = tf.where(valid, combined_score, tf.fill(tf.shape(combined_score), float('-inf')))
+        return tf.reduce_max(masked_score, axis=1)
+
+    _batch_scorers[segment_samples] = score_batch
+    return score_batch
+
+def guitar_score_timeline_local(waveform):
+    """プロセス内のYAMNetで曲全体のギター関連スコアの時系列を計算"""
+    import tensorflow as tf
+    model = init_yamnet()
+    scores, embeddings, spectrogram = model(waveform)
+    return tf.reduce_sum(tf.gather(scores, guitar_related_indices, axis=1), axis=1).numpy()
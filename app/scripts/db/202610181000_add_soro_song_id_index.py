@@ -0,0 +1,35 @@
+import psycopg2
+from config import DB_CONFIG
+from export_table import export_current_tables
+
+def add_soro_song_id_index():
+    try:
+        # データベース接続
+        conn = psycopg2.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+
+        # 一括挿入時の重複判定（song_idごとの区間検索）用のインデックスを追加
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS soro_song_id_idx
+            ON "Soro" (song_id, start_time, end_time);
+        """)
+
+        # 変更をコミット
+        conn.commit()
+        print("Soro(song_id, start_time, end_time)にインデックスを追加しました")
+
+        # テーブル情報をエクスポート
+        export_current_tables()
+
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        conn.rollback()
+    finally:
+        # 接続を閉じる
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    add_soro_song_id_index()
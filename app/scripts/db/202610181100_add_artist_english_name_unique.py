@@ -0,0 +1,57 @@
+import psycopg2
+from config import DB_CONFIG
+from export_table import export_current_tables
+
+def add_artist_english_name_unique():
+    try:
+        # データベース接続
+        conn = psycopg2.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+
+        # 同時登録などで重複したアーティストは、最も古いartist_idに曲を付け替えてから削除する
+        cursor.execute("""
+            WITH canonical AS (
+                SELECT english_name, MIN(artist_id) AS artist_id
+                FROM "Artist"
+                GROUP BY english_name
+                HAVING COUNT(*) > 1
+            )
+            UPDATE "Song" AS song
+            SET artist_id = canonical.artist_id
+            FROM "Artist" AS artist
+            JOIN canonical ON canonical.english_name = artist.english_name
+            WHERE song.artist_id = artist.artist_id
+              AND artist.artist_id <> canonical.artist_id;
+        """)
+        cursor.execute("""
+            DELETE FROM "Artist" AS artist
+            USING "Artist" AS canonical
+            WHERE canonical.english_name = artist.english_name
+              AND canonical.artist_id < artist.artist_id;
+        """)
+
+        # INSERT ... ON CONFLICT (english_name) で使う一意インデックスを追加
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS "Artist_english_name_key"
+            ON "Artist" (english_name);
+        """)
+
+        # 変更をコミット
+        conn.commit()
+        print("Artist(english_name)に一意インデックスを追加しました")
+
+        # テーブル情報をエクスポート
+        export_current_tables()
+
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        conn.rollback()
+    finally:
+        # 接続を閉じる
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    add_artist_english_name_unique()
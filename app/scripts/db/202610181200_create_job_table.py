@@ -0,0 +1,63 @@
+import psycopg2
+from config import DB_CONFIG
+from export_table import export_current_tables
+
+# SQLスクリプト：ジョブキューのテーブル作成
+# 曲(song_id)とステージ(stage)ごとに1行。ワーカーはSELECT ... FOR UPDATE SKIP LOCKEDで取得し、
+# lease_expires_atまでにハートビートがなければ他のワーカーが取り直す
+CREATE_JOB_TABLE = """
+CREATE TABLE IF NOT EXISTS "Job" (
+    song_id INTEGER NOT NULL,                         -- Songテーブルの外部キー
+    stage VARCHAR(32) NOT NULL,                       -- 処理ステージ（separate, duration, guitar）
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',    -- pending / running / done / failed
+    path TEXT NOT NULL,                               -- 処理対象のパス（共有ストレージのルートからの相対パス）
+    attempts INTEGER NOT NULL DEFAULT 0,              -- 取得された回数
+    worker_id VARCHAR(255),                           -- 処理中のワーカー
+    lease_expires_at TIMESTAMPTZ,                     -- この時刻までにハートビートがなければ取り直せる
+    heartbeat_at TIMESTAMPTZ,                         -- 最後のハートビート
+    last_error TEXT,                                  -- 最後に失敗したときのエラー
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (song_id, stage),
+    CHECK (status IN ('pending', 'running', 'done', 'failed')),
+    FOREIGN KEY (song_id) REFERENCES "Song"(song_id) ON DELETE CASCADE
+);
+"""
+
+# 取得待ちのジョブと、リースの切れたジョブを探すためのインデックス
+CREATE_JOB_INDEXES = """
+CREATE INDEX IF NOT EXISTS job_pending_idx
+ON "Job" (stage, created_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS job_lease_idx
+ON "Job" (stage, lease_expires_at) WHERE status = 'running';
+"""
+
+def create_job_table():
+    try:
+        # データベース接続
+        conn = psycopg2.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+
+        # テーブル・インデックス作成
+        cursor.execute(CREATE_JOB_TABLE)
+        cursor.execute(CREATE_JOB_INDEXES)
+
+        # 変更をコミット
+        conn.commit()
+        print("Jobテーブルを作成しました")
+
+        # テーブル情報をエクスポート
+        export_current_tables()
+
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        conn.rollback()
+    finally:
+        # 接続を閉じる
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    create_job_table()
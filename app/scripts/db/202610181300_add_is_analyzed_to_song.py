@@ -0,0 +1,36 @@
+import psycopg2
+from config import DB_CONFIG
+from export_table import export_current_tables
+
+def add_is_analyzed():
+    try:
+        # データベース接続
+        conn = psycopg2.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+
+        # is_analyzedカラムを追加（デフォルトはFalse）
+        # ステムを書き出さずに分析まで行う融合パイプラインでは、is_separatedの代わりにこのカラムで処理済みを判定する
+        cursor.execute("""
+            ALTER TABLE "Song"
+            ADD COLUMN IF NOT EXISTS is_analyzed BOOLEAN DEFAULT FALSE NOT NULL;
+        """)
+
+        # 変更をコミット
+        conn.commit()
+        print("is_analyzedカラムを追加しました")
+
+        # テーブル情報をエクスポート
+        export_current_tables()
+
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        conn.rollback()
+    finally:
+        # 接続を閉じる
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    add_is_analyzed()
@@ -9,14 +9,14 @@ def check_db_state():
         print("データベースに接続しました。")
 
         # Songsテーブルの内容を取得
-        cursor.execute("SELECT * FROM Songs")
+        cursor.execute('SELECT * FROM "Song"')
         songs = cursor.fetchall()
         print("Songsテーブルの内容:")
         for song in songs:
             print(song)
 
         # Artistsテーブルの内容を取得
-        cursor.execute("SELECT * FROM Artists")
+        cursor.execute('SELECT * FROM "Artist"')
         artists = cursor.fetchall()
         print("Artistsテーブルの内容:")
         for artist in artists:
@@ -11,8 +11,9 @@ DB_CONFIG = {
     "dbname": os.environ["POSTGRES_DB"],
     "user": os.environ["POSTGRES_USER"], 
     "password": os.environ["POSTGRES_PASSWORD"],
-    "host": "localhost",
-    "port": 5432
+    # 複数のマシンからワーカーを動かす場合はPOSTGRES_HOSTで共有のDBを指定する
+    "host": os.environ.get("POSTGRES_HOST", "localhost"),
+    "port": int(os.environ.get("POSTGRES_PORT", "5432"))
 } 
 
 def export_schema_to_file():
@@ -0,0 +1,123 @@
+###全ステージで共有するDB接続プールとよく使うクエリのプリペアドステートメント
+
+import os
+import re
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from .config import DB_CONFIG
+
+# prismaで管理しているテーブル名（マイグレーションスクリプトの小文字のテーブル名は旧スキーマのもの）
+SONG_TABLE = '"Song"'
+ARTIST_TABLE = '"Artist"'
+SORO_TABLE = '"Soro"'
+JOB_TABLE = '"Job"'
+
+MIN_CONNECTIONS = 1
+MAX_CONNECTIONS = int(os.environ.get("DB_POOL_MAX_CONNECTIONS", "8"))
+# 全ての接続が使用中の場合に空きを待つ上限（秒）。同じスレッドで入れ子に借りて待ち続けるのを防ぐ
+CONNECTION_WAIT_TIMEOUT = float(os.environ.get("DB_POOL_WAIT_TIMEOUT", "300"))
+
+# 曲ごとに実行されるクエリ（接続ごとに1回だけPREPAREし、以降はEXECUTEで実行する）
+PREPARED_STATEMENTS = {
+    "mark_song_separated": f"UPDATE {SONG_TABLE} SET is_separated = TRUE WHERE song_id = $1",
+    "select_soro_intervals": f"SELECT soro_id, start_time, end_time FROM {SORO_TABLE} WHERE song_id = $1",
+    "heartbeat_job": (
+        f"UPDATE {JOB_TABLE} SET lease_expires_at = now() + make_interval(secs => $4), heartbeat_at = now() "
+        "WHERE song_id = $1 AND stage = $2 AND worker_id = $3 AND status = 'running'"
+    ),
+}
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """PREPARE済みのステートメント名を接続ごとに覚えておく接続クラス"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def get_pool():
+    """
+    プロセスごとに1つの接続プールを返す（初回呼び出し時に作成）
+    fork後の子プロセスでは親の接続を共有しないよう作り直す
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadedConnectionPool(MIN_CONNECTIONS, MAX_CONNECTIONS,
+                                           connection_factory=PooledConnection, **DB_CONFIG)
+            # getconnは空きがないとPoolErrorを送出するため、借りられる数をセマフォで数えて待たせる
+            _pool.slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@contextmanager
+def get_connection():
+    """
+    プールから接続を借りる。全ての接続が使用中の場合は返却されるまで待つ
+    例外が発生した場合はロールバックし、返却時に終了していないトランザクションもロールバックしてから戻す
+    """
+    pool = get_pool()
+    if not pool.slots.acquire(timeout=CONNECTION_WAIT_TIMEOUT):
+        raise PoolError(f"{CONNECTION_WAIT_TIMEOUT:.0f}秒待ってもDB接続が空きませんでした（上限 {MAX_CONNECTIONS}接続）")
+    try:
+        conn = pool.getconn()
+    except Exception:
+        pool.slots.release()
+        raise
+    try:
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        try:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            pool.slots.release()
+
+
+def close_pool():
+    """プールの全ての接続を閉じる"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_pid = None
+
+
+def execute_prepared(cursor, name, params=()):
+    """PREPARED_STATEMENTSのクエリを、その接続で初めて使う場合だけPREPAREしてから実行する"""
+    conn = cursor.connection
+    prepared = getattr(conn, "prepared", None)
+    if prepared is None:
+        # プール以外の接続ではプリペアドステートメントを使わずに実行する
+        # $nの出現順にパラメータを並べ直す（$nがクエリ内で番号順に並んでいるとは限らない）
+        ordered = []
+
+        def placeholder(match):
+            ordered.append(params[int(match.group(1)) - 1])
+            return "%s"
+
+        query = re.sub(r"\$(\d+)", placeholder, PREPARED_STATEMENTS[name])
+        cursor.execute(query, ordered)
+        return
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        prepared.add(name)
+    if params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
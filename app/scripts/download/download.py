@@ -2,23 +2,66 @@ import subprocess
 import sys
 import os
 import re
-import yt_dlp
+import shutil
+import tempfile
+import argparse
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse, parse_qs
 from datetime import datetime
 import json
-import psycopg2  # PostgreSQL接続用のライブラリをインポート
 import csv  # CSV読み込み用モジュールを追加
+from psycopg2.extras import execute_values
 
-from ..db.config import DB_CONFIG  # データベース設定をインポート
+from ..db.pool import ARTIST_TABLE, SONG_TABLE, get_connection  # 共有の接続プール
+
+
+DEFAULT_CONCURRENCY = 1  # 同時にダウンロード・WAV変換する曲数
+REGISTER_BATCH_SIZE = 50  # まとめてDBに登録する曲数
+REGISTER_INTERVAL = 30.0  # 曲数がたまらなくても、最初の未登録の曲の完了からこの秒数で登録する
+
+
+def default_ydl_factory(options):
+    import yt_dlp
+    return yt_dlp.YoutubeDL(options)
+
+
+def downloaded_file_path(info_dict, temp_dir):
+    """
+    extract_infoの戻り値から変換後のWAVファイルのパスを求める
+    （ディレクトリを走査しないため、他の曲のファイルを取り違えない）
+    """
+    downloads = info_dict.get('requested_downloads') or []
+    if downloads and downloads[0].get('filepath'):
+        return downloads[0]['filepath']
+    # 古いyt-dlpでは後処理後のパスが記録されないため、出力テンプレートの拡張子をwavに置き換える
+    file_path = info_dict.get('filepath') or info_dict.get('_filename')
+    if not file_path:
+        raise ValueError(f"ダウンロードしたファイルのパスを取得できませんでした: {info_dict.get('id')}")
+    if not os.path.isabs(file_path):
+        file_path = os.path.join(temp_dir, file_path)
+    return f"{os.path.splitext(file_path)[0]}.wav"
 
 
 class YTDLPDownloader:
-    def __init__(self, download_path, ffmpeg_path='/opt/homebrew/bin/ffmpeg', cookies_file='../../../music.youtube.com_cookies.txt'):
+    def __init__(self, download_path, ffmpeg_path='/opt/homebrew/bin/ffmpeg', cookies_file='../../../music.youtube.com_cookies.txt',
+                 ydl_factory=default_ydl_factory):
+        """
+        ydl_factoryはオプションの辞書からyt_dlp.YoutubeDL互換のオブジェクトを作る関数
+        （テストではネットワークに接続しない代替クラスを渡せる）
+        """
         self.download_path = download_path
         self.ffmpeg_path = ffmpeg_path
         self.cookies_file = cookies_file
-        self.ydl_opts = {
+        self.ydl_factory = ydl_factory
+        self.artist_cache = ArtistCache()
+        self.ydl_opts = self.build_options(os.path.join(self.download_path, 'temp'))
+
+    def build_options(self, temp_dir):
+        return {
             'format': 'bestaudio',  # 音声の品質はデフォルト
-            'outtmpl': f"{self.download_path}/temp/%(title)s.%(ext)s",
+            'outtmpl': f"{temp_dir}/%(title)s.%(ext)s",
             'postprocessors': [{
                 'key': 'FFmpegExtractAudio',
                 'preferredcodec': 'wav',
@@ -27,16 +70,50 @@ class YTDLPDownloader:
             'quiet': True,  # 詳細なログを出力するためにquietをFalseに設定
             'cookiefile': self.cookies_file,  # クッキーファイルを指定
         }
-        self.ydl = yt_dlp.YoutubeDL(self.ydl_opts)
 
     def download_audio(self, url):
         if not os.path.exists(self.cookies_file):
             print(f"クッキーファイルが存在しません: {self.cookies_file}")
             return None
-        info_dict = self.ydl.extract_info(url, download=True)
-        sanitized_info = self.ydl.sanitize_info(info_dict)
+        ydl = self.ydl_factory(self.ydl_opts)
+        info_dict = ydl.extract_info(url, download=True)
+        sanitized_info = ydl.sanitize_info(info_dict)
         return sanitized_info
 
+    def download_isolated(self, url):
+        """
+        曲ごとに専用の一時ディレクトリとYoutubeDLインスタンスを使ってダウンロード・WAV変換する
+        複数スレッドから同時に呼び出せる。戻り値は (メタデータ, WAVファイルのパス, 一時ディレクトリ)
+        """
+        if not os.path.exists(self.cookies_file):
+            print(f"クッキーファイルが存在しません: {self.cookies_file}")
+            return None, None, None
+        temp_root = os.path.join(self.download_path, 'temp')
+        os.makedirs(temp_root, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='item_', dir=temp_root)
+        try:
+            ydl = self.ydl_factory(self.build_options(temp_dir))
+            info_dict = ydl.extract_info(url, download=True)
+            file_path = downloaded_file_path(info_dict, temp_dir)
+            return ydl.sanitize_info(info_dict), file_path, temp_dir
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+    def organize_file(self, song_id, file_path, temp_dir=None):
+        """ダウンロードしたWAVをsong_id付きの名前で日付フォルダに移動し、一時ディレクトリを削除する"""
+        today = datetime.now().strftime("%Y%m%d")
+        final_dir = os.path.join(self.download_path, today)
+        os.makedirs(final_dir, exist_ok=True)
+
+        base, _ = os.path.splitext(os.path.basename(file_path))
+        new_path = os.path.join(final_dir, f"{song_id}__{base}.wav")
+        shutil.move(file_path, new_path)
+        print(f"ファイルをリネームしました: {file_path} → {new_path}")
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return new_path
+
     def organize_files(self, song_id):
         temp_dir = os.path.join(self.download_path, 'temp')
         today = datetime.now().strftime("%Y%m%d")
@@ -52,110 +129,313 @@ class YTDLPDownloader:
             print(f"ファイルをリネームしました: {old_path} → {new_path}")
 
     def insert_metadata_into_db(self, metadata, csv_title, csv_artist, csv_url):
-        # 必要な項目を取得
-        youtube_music_id = metadata.get('id')
-        title = csv_title
-        english_name = metadata.get('artist')
-        japanese_name = csv_artist
-        duration = metadata.get('duration')
-        url = csv_url
-        release_date_str = metadata.get('release_date')
-        release_date = datetime.strptime(release_date_str, '%Y%m%d').date() if release_date_str else None
-            
+        """1曲分のメタデータを登録してsong_idを返す（失敗した場合はNone）"""
+        return self.insert_metadata_batch([(metadata, csv_title, csv_artist, csv_url)])[0]
+
+    def insert_metadata_batch(self, items):
+        """
+        (メタデータ, CSVのタイトル, CSVのアーティスト, URL) のリストをまとめて登録し、
+        入力順のsong_idのリストを返す（失敗した場合は全てNone）
+        アーティストはキャッシュから解決し、曲は1つのINSERT文で挿入する
+        """
+        if not items:
+            return []
+        songs = {}
+        artists = {}
+        for metadata, csv_title, csv_artist, csv_url in items:
+            # メタデータにアーティストがない曲はCSVのアーティスト名で登録する
+            english_name = metadata.get('artist') or csv_artist
+            title = csv_title or metadata.get('title')
+            if not metadata.get('id') or not english_name or not title:
+                # 1曲の不備でまとめて登録する他の曲が失敗しないよう、この曲だけ登録しない
+                print(f"曲名・アーティスト・IDのいずれかが取得できないため登録をスキップします: {csv_url}")
+                continue
+            release_date_str = metadata.get('release_date')
+            release_date = datetime.strptime(release_date_str, '%Y%m%d').date() if release_date_str else None
+            artists.setdefault(english_name, csv_artist)
+            songs.setdefault(metadata.get('id'), (title, metadata.get('duration'), english_name, csv_url, release_date))
+        if not songs:
+            return [None] * len(items)
+
         try:
-            # データベースに接続
-            conn = psycopg2.connect(**DB_CONFIG)
-            cursor = conn.cursor()
-            print(f"データベースに接続しました: {conn}")
-
-            # Artistsテーブルにアーティストを挿入または存在確認
-            cursor.execute('SELECT artist_id FROM "Artist" WHERE english_name = %s', (english_name,))
-            artist = cursor.fetchone()
-            print(f"アーティストの取得: {artist}")
-            if artist:
-                artist_id = artist[0]
-            else:
-                cursor.execute('INSERT INTO "Artist" (english_name, japanese_name) VALUES (%s, %s) RETURNING artist_id', (english_name, japanese_name,))
-
-                artist_id = cursor.fetchone()[0]
-            print(f"アーティストの挿入: {artist_id}")
-            
-            # Songsテーブルに曲を挿入
-            cursor.execute("""
-                INSERT INTO "Song" (title, duration, youtube_music_id, artist_id, url, release_date)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (youtube_music_id) DO NOTHING
-                RETURNING song_id
-            """, (title, duration, youtube_music_id, artist_id, url, release_date))
-
-            song = cursor.fetchone()
-            if song:
-                song_id = song[0]
-                print(f"曲が挿入されました。song_id: {song_id}")
-            else:
-                # 既に存在する場合、song_idを取得
-                cursor.execute('SELECT song_id FROM "Song" WHERE youtube_music_id = %s', (youtube_music_id,))
-                song = cursor.fetchone()
-                song_id = song[0] if song else None
-                print(f"既存の曲のsong_id: {song_id}")
-
-            # コミットして接続を閉じる
-            conn.commit()
-            cursor.close()
-            conn.close()
-
-            return song_id  # song_idを返す
+            # プールからデータベース接続を借りる
+            with get_connection() as conn:
+                artist_ids, new_artist_ids = self.artist_cache.resolve(artists, conn)
+                rows = [
+                    (title, duration, youtube_music_id, artist_ids[english_name], url, release_date)
+                    for youtube_music_id, (title, duration, english_name, url, release_date) in songs.items()
+                ]
+                with conn.cursor() as cursor:
+                    inserted = dict(execute_values(cursor, f"""
+                        INSERT INTO {SONG_TABLE} (title, duration, youtube_music_id, artist_id, url, release_date)
+                        VALUES %s
+                        ON CONFLICT (youtube_music_id) DO NOTHING
+                        RETURNING youtube_music_id, song_id
+                    """, rows, page_size=len(rows), fetch=True))
+                    # 既に存在する曲はsong_idだけを取得
+                    existing = [youtube_music_id for youtube_music_id in songs if youtube_music_id not in inserted]
+                    song_ids = dict(inserted)
+                    if existing:
+                        cursor.execute(
+                            f'SELECT youtube_music_id, song_id FROM {SONG_TABLE} WHERE youtube_music_id = ANY(%s)',
+                            (existing,)
+                        )
+                        song_ids.update(cursor.fetchall())
+                conn.commit()
+            # コミットできた場合だけ新しいアーティストをキャッシュに加える（ロールバックされたIDを残さない）
+            self.artist_cache.remember(new_artist_ids)
+            print(f"曲を登録しました: 新規 {len(inserted)}曲, 既存 {len(songs) - len(inserted)}曲")
+            return [song_ids.get(metadata.get('id')) for metadata, _, _, _ in items]
 
         except Exception as e:
+            # ロールバックはget_connectionで行われる
             print(f"データベース操作中にエラーが発生しました: {e}")
-            if conn:
-                conn.rollback()
-                print("ロールバックが完了しました。")
-            return None
+            if len(items) > 1:
+                # どの曲が原因か分からないため、1曲ずつ登録し直して他の曲を失わないようにする
+                print(f"{len(items)}曲を1曲ずつ登録し直します")
+                return [self.insert_metadata_batch([item])[0] for item in items]
+            return [None]
+
+
+class ArtistCache:
+    """
+    english_name → artist_id のプロセス内キャッシュ
+    初回に全アーティストを一括で読み込み、未登録のアーティストは1つのupsert文で登録する
+    """
+
+    def __init__(self):
+        self.artist_ids = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def preload(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(f'SELECT english_name, artist_id FROM {ARTIST_TABLE}')
+            self.artist_ids.update(cursor.fetchall())
+        self.loaded = True
+        print(f"アーティストを{len(self.artist_ids)}件読み込みました")
+
+    def resolve(self, artists, conn):
+        """
+        {english_name: japanese_name} のアーティストのartist_idを {english_name: artist_id} で返す
+        2つ目の戻り値はこのトランザクションで新しく取得したartist_id。
+        トランザクションがロールバックされると無効になるため、コミット後にremember()でキャッシュに加える
+        """
+        with self.lock:
+            if not self.loaded:
+                self.preload(conn)
+            known = dict(self.artist_ids)
+        new_artist_ids = {}
+        missing = [(english_name, japanese_name) for english_name, japanese_name in artists.items()
+                   if english_name not in known]
+        if missing:
+            # 同時に登録された場合も既存の行のartist_idが返る（日本語名は未設定の場合だけ補う）
+            with conn.cursor() as cursor:
+                new_artist_ids.update(execute_values(cursor, f"""
+                    INSERT INTO {ARTIST_TABLE} (english_name, japanese_name)
+                    VALUES %s
+                    ON CONFLICT (english_name) DO UPDATE
+                    SET japanese_name = COALESCE({ARTIST_TABLE}.japanese_name, EXCLUDED.japanese_name)
+                    RETURNING english_name, artist_id
+                """, missing, page_size=len(missing), fetch=True))
+            print(f"アーティストを登録しました: {[english_name for english_name, _ in missing]}")
+        known.update(new_artist_ids)
+        return {english_name: known[english_name] for english_name in artists}, new_artist_ids
+
+    def remember(self, artist_ids):
+        """コミット済みのartist_idをキャッシュに加える"""
+        with self.lock:
+            self.artist_ids.update(artist_ids)
+
+
+def read_csv_rows(csv_path):
+    """CSVから (タイトル, アーティスト, プレイリストを除いたURL) のリストを読み込む"""
+    rows = []
+    with open(csv_path, 'r', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            url = row.get("url")
+            rows.append((row.get("title"), row.get("artist"), url.split('&list=')[0]))
+    return rows
+
+
+def parse_video_id(url):
+    """URLのv=パラメータから動画IDを取り出す（見つからない場合はNone）"""
+    values = parse_qs(urlparse(url or '').query).get('v')
+    return values[0] if values else None
+
+
+def fetch_known_songs(video_ids):
+    """動画IDのうちSongテーブルに登録済みのものを1回のクエリで取得し、{youtube_music_id: song_id} を返す"""
+    if not video_ids:
+        return {}
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f'SELECT youtube_music_id, song_id FROM {SONG_TABLE} WHERE youtube_music_id = ANY(%s)',
+                (list(video_ids),)
+            )
+            return dict(cursor.fetchall())
+
+
+def existing_wav_song_ids(download_path):
+    """全ての日付フォルダからダウンロード済みWAVのsong_idを集める"""
+    song_ids = set()
+    if not os.path.isdir(download_path):
+        return song_ids
+    for date_folder in os.listdir(download_path):
+        date_path = os.path.join(download_path, date_folder)
+        if not date_folder.isdigit() or not os.path.isdir(date_path):
+            continue
+        for file_name in os.listdir(date_path):
+            song_id = file_name.split('__')[0]
+            if file_name.endswith('.wav') and song_id.isdigit():
+                song_ids.add(int(song_id))
+    return song_ids
+
+
+def filter_new_rows(rows, download_path):
+    """
+    Songテーブルに登録済みで、WAVもディスク上にある曲を除外する
+    登録済みでもWAVがない曲はダウンロードし直す。CSV内の重複も除外する
+    """
+    video_ids = {parse_video_id(csv_url) for _, _, csv_url in rows} - {None}
+    known = fetch_known_songs(video_ids)
+    on_disk = existing_wav_song_ids(download_path)
+
+    new_rows = []
+    seen = set()
+    skipped_existing = 0
+    skipped_duplicate = 0
+    for row in rows:
+        video_id = parse_video_id(row[2])
+        if video_id is not None and video_id in seen:
+            skipped_duplicate += 1
+            continue
+        seen.add(video_id)
+        if video_id in known and known[video_id] in on_disk:
+            skipped_existing += 1
+            continue
+        new_rows.append(row)
+    print(f"ダウンロード対象: {len(new_rows)}曲 / スキップ: {skipped_existing + skipped_duplicate}曲 "
+          f"(登録済み・WAVあり: {skipped_existing}曲, CSV内の重複: {skipped_duplicate}曲)")
+    return new_rows
+
+
+def register_downloads(downloader, completed):
+    """
+    ダウンロード済みの曲をまとめてDBに登録し、song_id付きの名前で日付フォルダに移動する
+    戻り値は登録できた曲の (タイトル, アーティスト, URL, song_id, WAVファイルのパス) のリスト
+    """
+    song_ids = downloader.insert_metadata_batch([
+        (metadata, title_csv, artist_csv, csv_url)
+        for metadata, title_csv, artist_csv, csv_url, _, _ in completed
+    ])
+    registered = []
+    for song_id, (_, title_csv, artist_csv, csv_url, file_path, temp_dir) in zip(song_ids, completed):
+        if song_id:
+            wav_path = downloader.organize_file(song_id, file_path, temp_dir)  # song_idを付けてファイルを移動
+            registered.append((title_csv, artist_csv, csv_url, song_id, wav_path))
+        else:
+            print(f"song_idの取得に失敗しました。ファイルの整理をスキップします: {title_csv}")
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    completed.clear()
+    return registered
+
+
+def download_concurrently(downloader, rows, concurrency=DEFAULT_CONCURRENCY, register_batch_size=REGISTER_BATCH_SIZE,
+                          register_interval=REGISTER_INTERVAL):
+    """
+    最大concurrency曲を並列にダウンロード・WAV変換し、完了した曲をregister_batch_size曲ごと、
+    またはregister_interval秒ごとにまとめてDB登録・ファイル整理する（中断しても一時ディレクトリに残る曲を抑える）
+    DB登録とファイル移動はメインスレッドだけで行う
+    戻り値は登録できた曲の (タイトル, アーティスト, URL, song_id, WAVファイルのパス) のリスト
+    """
+    succeeded = []
+    completed = []
+    oldest_completed_at = None  # 未登録の曲のうち最初に完了した時刻
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for title_csv, artist_csv, csv_url in rows:
+            print(f"ダウンロード開始: {title_csv} by {artist_csv}")
+            futures[executor.submit(downloader.download_isolated, csv_url)] = (title_csv, artist_csv, csv_url)
+
+        not_done = set(futures)
+        while not_done:
+            timeout = None
+            if oldest_completed_at is not None:
+                timeout = max(0.0, oldest_completed_at + register_interval - time.monotonic())
+            done, not_done = wait(not_done, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                title_csv, artist_csv, csv_url = futures[future]
+                try:
+                    metadata, file_path, temp_dir = future.result()
+                except Exception as e:
+                    print(f"ダウンロードに失敗しました: {title_csv} ({csv_url}): {e}")
+                    continue
+                if not metadata:
+                    print("metadataの取得に失敗しました。")
+                    continue
+                completed.append((metadata, title_csv, artist_csv, csv_url, file_path, temp_dir))
+                if oldest_completed_at is None:
+                    oldest_completed_at = time.monotonic()
+
+            if completed and (len(completed) >= register_batch_size
+                              or time.monotonic() - oldest_completed_at >= register_interval):
+                succeeded.extend(register_downloads(downloader, completed))
+                oldest_completed_at = None
+    succeeded.extend(register_downloads(downloader, completed))
+    print(f"ダウンロード完了: {len(succeeded)}/{len(rows)}曲")
+    return succeeded
+
+
+def daily_csv_path():
+    """実行日のCSVファイルのパス"""
+    csv_filename = f"{datetime.now().strftime('%Y%m%d')}_videos.csv"
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), f"../../csv/{csv_filename}"))
+
+
+def default_download_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../music/downloaded')
+
+
+def create_downloader(download_path=None):
+    return YTDLPDownloader(
+        download_path or default_download_path(),
+        cookies_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../music.youtube.com_cookies.txt')
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CSVの曲をダウンロードしてWAVに変換する")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="同時にダウンロード・WAV変換する曲数")
+    parser.add_argument("--no-dedupe", action="store_true",
+                        help="登録済み・ダウンロード済みの曲もダウンロードし直す")
+    parser.add_argument("--register-batch-size", type=int, default=REGISTER_BATCH_SIZE,
+                        help="まとめてDBに登録する曲数")
+    parser.add_argument("--register-interval", type=float, default=REGISTER_INTERVAL,
+                        help="曲数がたまらなくても、ダウンロード完了からこの秒数で登録する")
+    return parser.parse_args(argv)
 
 
 # メイン処理（CSVからURLリストを取得して各動画を処理）
-def main():
+def main(argv=None):
+    args = parse_args(argv)
     try:
-        # CSVファイルのパスを指定
-        from datetime import datetime
-
-        # 実行日のYYYYMMDDを計算
-        today_str = datetime.now().strftime("%Y%m%d")
-        csv_filename = f"{today_str}_videos.csv"
-        csv_path = os.path.abspath(os.path.join(os.path.dirname(__file__), f"../../csv/{csv_filename}"))
+        # CSVファイルのパスを指定（実行日のYYYYMMDD）
+        csv_path = daily_csv_path()
         print(f"CSVファイルのパス: {csv_path}")
         
-        base_output_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../music/downloaded')
-        downloader = YTDLPDownloader(
-            base_output_path, 
-            cookies_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../music.youtube.com_cookies.txt')
-        )
+        base_output_path = default_download_path()
+        downloader = create_downloader(base_output_path)
         
-        # CSVファイルを読み込み、各行ごとにダウンロード処理を実行
-        with open(csv_path, 'r', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                title_csv = row.get("title")
-                artist_csv = row.get("artist")
-                url = row.get("url")
-                csv_url = url.split('&list=')[0]
-                print(f"ダウンロード開始: {title_csv} by {artist_csv}")
-                
-                metadata = downloader.download_audio(csv_url)
-                if metadata:
-                    
-                    csv_title = title_csv
-                    csv_artist = artist_csv
-                    
-                    
-                    song_id = downloader.insert_metadata_into_db(metadata, csv_title, csv_artist, csv_url)  # メタデータをデータベースに挿入しsong_idを取得
-                    if song_id:
-                        downloader.organize_files(song_id)  # song_idを渡してファイルを整理・リネーム
-                    else:
-                        print("song_idの取得に失敗しました。ファイルの整理をスキップします。")
-                else:
-                    print("metadataの取得に失敗しました。")
+        # CSVファイルを読み込み、曲ごとに専用の一時ディレクトリでダウンロード処理を実行
+        rows = read_csv_rows(csv_path)
+        if not args.no_dedupe:
+            rows = filter_new_rows(rows, base_output_path)
+        download_concurrently(downloader, rows, args.concurrency, args.register_batch_size,
+                              args.register_interval)
 
         return 0  # 正常終了
     except Exception as e:
@@ -1,7 +1,15 @@
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import StaleElementReferenceException
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import StaleElementReferenceException, TimeoutException, WebDriverException
+from html.parser import HTMLParser
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import json
+import queue
+import threading
+import re
 import time
 import traceback
 import csv
@@ -14,6 +22,30 @@ CSV_FILE = f"app/csv/{time.strftime('%Y%m%d')}_videos.csv"
 # PLAYLIST_URL = "https://music.youtube.com/watch?v=R2nhllG6SKs&list=RDTMAK5uy_mZtXeU08kxXJOUhL0ETdAuZTh1z7aAFAo"
 PLAYLIST_URL = "https://music.youtube.com/watch?v=W5g3V0T-BTg&list=RDCLAK5uy_m1h6RaRmM8e_3k7ec4ZVJzfo2pXdLrY_k"
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
+WAIT_TIMEOUT = 20  # 明示的な待機の上限（秒）
+QUEUE_POLL_INTERVAL = 0.5  # キューの読み込み完了を確認する間隔（秒）
+DEFAULT_DRIVER_POOL_SIZE = 2  # 複数プレイリストを取得するときに使い回すChromeの台数
+WATCH_URL = "https://music.youtube.com/watch?v={video_id}"
+
+# キューの全アイテムからタイトル・アーティスト・動画IDを1回のDOM走査で取り出すスクリプト
+EXTRACT_QUEUE_SCRIPT = """
+return Array.from(document.querySelectorAll('ytmusic-player-queue-item')).map(function (item) {
+    var title = item.querySelector('.song-title');
+    var byline = item.querySelector('.byline');
+    var videoId = item.data && item.data.videoId ? item.data.videoId : null;
+    if (!videoId) {
+        var anchor = item.querySelector('a[href*="watch?v="]');
+        if (anchor) {
+            videoId = new URL(anchor.getAttribute('href'), location.href).searchParams.get('v');
+        }
+    }
+    return {
+        title: title ? (title.getAttribute('title') || title.textContent.trim()) : null,
+        artist: byline ? (byline.getAttribute('title') || byline.textContent.trim()) : null,
+        videoId: videoId
+    };
+});
+"""
 
 
 def load_cookies(driver, cookie_file):
@@ -41,6 +73,392 @@ def load_cookies(driver, cookie_file):
 
 
 
+def video_url(video_id, playlist_url=None):
+    """動画IDからURLを作る（プレイリストのURLにlist=があれば付ける）"""
+    url = WATCH_URL.format(video_id=video_id)
+    list_id = parse_qs(urlparse(playlist_url or "").query).get("list")
+    return f"{url}&list={list_id[0]}" if list_id else url
+
+
+def to_video_data(items, playlist_url=None):
+    """{title, artist, videoId} のリストをCSVの行にする（動画IDがないアイテムは除外）"""
+    video_data = []
+    for item in items:
+        if not item.get("videoId"):
+            print(f"⚠ 動画IDを取得できなかったためスキップします: {item.get('title')}")
+            continue
+        video_data.append({
+            "title": item.get("title"),
+            "artist": item.get("artist"),
+            "url": video_url(item["videoId"], playlist_url),
+        })
+    return video_data
+
+
+def create_driver():
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless=True")
+    options.add_argument(f"user-agent={USER_AGENT}")
+    return webdriver.Chrome(options=options)
+
+
+def wait_for_page_load(driver, timeout=WAIT_TIMEOUT):
+    WebDriverWait(driver, timeout).until(
+        lambda d: d.execute_script("return document.readyState") == "complete"
+    )
+
+
+def prime_driver(driver, cookie_file=COOKIE_FILE, timeout=WAIT_TIMEOUT):
+    """YouTube Musicを開いてクッキーを適用する（固定時間のsleepではなくページの読み込み完了を待つ）"""
+    print("🔄 YouTube Music にアクセス中...")
+    driver.get("https://music.youtube.com")
+    wait_for_page_load(driver, timeout)
+    load_cookies(driver, cookie_file)
+    driver.refresh()
+    wait_for_page_load(driver, timeout)
+
+
+def wait_for_queue(driver, timeout=WAIT_TIMEOUT, poll_interval=QUEUE_POLL_INTERVAL):
+    """
+    キューのアイテムが表示され、アイテム数が増えなくなるまで待つ
+    戻り値はアイテム数（タイムアウトした場合はその時点の数）
+    """
+    selector = "ytmusic-player-queue-item"
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=poll_interval).until(
+            lambda d: d.find_elements(By.CSS_SELECTOR, selector)
+        )
+    except TimeoutException:
+        print("❌ キューのアイテムが見つかりませんでした")
+        return 0
+
+    state = {"count": -1}
+
+    def settled(d):
+        count = len(d.find_elements(By.CSS_SELECTOR, selector))
+        stable = count == state["count"]
+        state["count"] = count
+        return stable
+
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=poll_interval).until(settled)
+    except TimeoutException:
+        print("⚠ キューの読み込みが終わらないため、現在のアイテムで続行します")
+    return state["count"]
+
+
+def extract_playlist(driver, playlist_url, timeout=WAIT_TIMEOUT):
+    """プレイリストを開き、キューの全アイテムを1回のDOM走査で取り出す"""
+    print(f"📌 プレイリストに移動: {playlist_url}")
+    driver.get(playlist_url)
+    count = wait_for_queue(driver, timeout)
+    print(f"🎵 キューのアイテム数: {count}")
+    video_data = to_video_data(driver.execute_script(EXTRACT_QUEUE_SCRIPT), playlist_url)
+    if len(video_data) < count:
+        # DOMから動画IDが取れない場合はページの初期データから補う
+        from_html = parse_playlist_html(driver.page_source, playlist_url)
+        if len(from_html) > len(video_data):
+            video_data = from_html
+    for video in video_data:
+        print(f"✅ 曲: {video['title']}, アーティスト: {video['artist']}, URL: {video['url']}")
+    return video_data
+
+
+def get_playlist_videos_bulk(playlist_url):
+    """クリックせずにキューの全アイテムをまとめて取得する"""
+    driver = create_driver()
+    try:
+        prime_driver(driver)
+        return extract_playlist(driver, playlist_url)
+    finally:
+        driver.quit()
+
+
+class DriverPool:
+    """
+    クッキー適用済みのヘッドレスChromeを最大size台まで作って使い回すプール
+    file:// のページだけを読む場合はprime=Falseでクッキーの適用を省略できる
+    """
+
+    def __init__(self, size=DEFAULT_DRIVER_POOL_SIZE, prime=True, driver_factory=create_driver,
+                 cookie_file=COOKIE_FILE):
+        self.size = size
+        self.prime = prime
+        self.driver_factory = driver_factory
+        self.cookie_file = cookie_file
+        self.idle = queue.Queue()
+        self.drivers = []
+        self.lock = threading.Lock()
+        self.created = 0
+        self.startup_seconds = 0.0
+
+    def acquire(self):
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                driver = self._create_or_wait()
+            if driver is not None:
+                return driver
+            # Noneは破棄されたドライバーの枠が空いた合図なので、作り直しを試す
+
+    def _create_or_wait(self):
+        with self.lock:
+            create = len(self.drivers) < self.size
+            if create:
+                self.drivers.append(None)  # 作成中の枠を確保
+        if not create:
+            return self.idle.get()
+
+        started = time.perf_counter()
+        try:
+            driver = self.driver_factory()
+            if self.prime:
+                prime_driver(driver, self.cookie_file)
+        except Exception:
+            with self.lock:
+                self.drivers.remove(None)
+            self.idle.put(None)  # 空きを待っているスレッドに作り直しを任せる
+            raise
+        with self.lock:
+            self.drivers[self.drivers.index(None)] = driver
+            self.created += 1
+            self.startup_seconds += time.perf_counter() - started
+        return driver
+
+    def release(self, driver):
+        self.idle.put(driver)
+
+    def discard(self, driver):
+        """
+        クラッシュしたドライバーを終了してプールから外す
+        空いた枠には次のacquireで新しいドライバーが作られる
+        """
+        with self.lock:
+            if driver in self.drivers:
+                self.drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        self.idle.put(None)
+
+    def close(self):
+        for driver in self.drivers:
+            if driver is None:
+                continue
+            try:
+                driver.quit()
+            except Exception as e:
+                # 落ちたドライバーの終了に失敗しても残りのドライバーは終了する
+                print(f"⚠ ドライバーの終了に失敗しました: {e}")
+        self.drivers = []
+
+
+def read_playlists(path):
+    """1行に1つのプレイリストURLを書いたファイルを読み込む（空行と#で始まる行は無視）"""
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+def scrape_playlists(playlist_urls, pool_size=DEFAULT_DRIVER_POOL_SIZE, prime=None, driver_factory=create_driver):
+    """
+    複数のプレイリストをドライバーのプールで並列に取得し、入力順に結合した曲のリストを返す
+    プレイリストごとの所要時間と曲数を出力する
+    """
+    if prime is None:
+        prime = not all(url.startswith("file://") for url in playlist_urls)
+    pool = DriverPool(min(pool_size, max(1, len(playlist_urls))), prime=prime, driver_factory=driver_factory)
+
+    def scrape(playlist_url):
+        driver = pool.acquire()
+        started = time.perf_counter()
+        try:
+            result = extract_playlist(driver, playlist_url)
+        except WebDriverException:
+            # ブラウザが落ちた・応答しないドライバーは使い回さない
+            pool.discard(driver)
+            raise
+        except Exception:
+            pool.release(driver)
+            raise
+        pool.release(driver)
+        return result, time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            futures = [executor.submit(scrape, playlist_url) for playlist_url in playlist_urls]
+            for playlist_url, future in zip(playlist_urls, futures):
+                try:
+                    videos, seconds = future.result()
+                except Exception as e:
+                    print(f"❌ プレイリストの取得に失敗しました: {playlist_url}: {e}")
+                    results.append((playlist_url, [], None))
+                    continue
+                results.append((playlist_url, videos, seconds))
+    finally:
+        pool.close()
+
+    print(f"📊 ドライバー {pool.created}台の起動・クッキー適用: {pool.startup_seconds:.1f}秒")
+    for playlist_url, videos, seconds in results:
+        cost = f"{seconds:.1f}秒" if seconds is not None else "失敗"
+        print(f"📊 {playlist_url}: {len(videos)}曲, {cost}")
+    print(f"📊 合計: {len(playlist_urls)}プレイリスト, {time.perf_counter() - started:.1f}秒")
+    return [video for _, videos, _ in results for video in videos]
+
+
+def _runs_text(value):
+    if not isinstance(value, dict):
+        return None
+    if "simpleText" in value:
+        return value["simpleText"]
+    runs = value.get("runs") or []
+    return "".join(run.get("text", "") for run in runs) or None
+
+
+def _find_renderers(node, key):
+    """JSONを再帰的にたどり、指定したキーのオブジェクトを出現順に返す"""
+    if isinstance(node, dict):
+        for name, value in node.items():
+            if name == key and isinstance(value, dict):
+                yield value
+            else:
+                yield from _find_renderers(value, key)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _find_renderers(value, key)
+
+
+JS_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "v": "\v", "0": "\0"}
+
+
+def _decode_js_string(value):
+    """'...'で囲まれたJavaScript文字列の中身のエスケープ（\\xNN, \\uNNNN, \\' など）を戻す"""
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] in "xu" and len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        return JS_ESCAPES.get(escape, escape)
+    decoded = re.sub(r"\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|.)", replace, value, flags=re.DOTALL)
+    # \\uD83D\\uDE00のようなサロゲートペアを1文字に戻す
+    return decoded.encode("utf-16", "surrogatepass").decode("utf-16")
+
+
+def extract_initial_data(html):
+    """
+    ページに埋め込まれた初期データ（JSON）を全て取り出す
+    YouTube: var ytInitialData = {...};  YouTube Music: initialData.push({... data: '...'})
+    """
+    documents = []
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"ytInitialData\s*=\s*", html):
+        try:
+            documents.append(decoder.raw_decode(html, match.end())[0])
+        except ValueError:
+            continue
+    for match in re.finditer(r"data:\s*'((?:[^'\\]|\\.)*)'", html):
+        try:
+            documents.append(json.loads(_decode_js_string(match.group(1))))
+        except ValueError:
+            continue
+    return documents
+
+
+def parse_initial_data(html, playlist_url=None):
+    """初期データのplaylistPanelVideoRendererからキューのアイテムを取り出す"""
+    items = []
+    seen = set()
+    for document in extract_initial_data(html):
+        for renderer in _find_renderers(document, "playlistPanelVideoRenderer"):
+            video_id = renderer.get("videoId")
+            if not video_id or video_id in seen:
+                continue
+            seen.add(video_id)
+            items.append({
+                "title": _runs_text(renderer.get("title")),
+                "artist": _runs_text(renderer.get("shortBylineText")) or _runs_text(renderer.get("longBylineText")),
+                "videoId": video_id,
+            })
+    return to_video_data(items, playlist_url)
+
+
+class QueueItemParser(HTMLParser):
+    """保存したページのytmusic-player-queue-itemからタイトル・アーティスト・動画IDを取り出す"""
+
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+    def __init__(self):
+        super().__init__()
+        self.items = []
+        self.current = None
+        self.capture = None  # テキストを取り出し中の (項目名, タグの深さ)
+        self.depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag not in self.VOID_TAGS:
+            self.depth += 1
+        if tag == "ytmusic-player-queue-item":
+            self.current = {"title": None, "artist": None, "videoId": None}
+            return
+        if self.current is None:
+            return
+        classes = (attrs.get("class") or "").split()
+        for field, class_name in (("title", "song-title"), ("artist", "byline")):
+            if class_name in classes and self.current[field] is None:
+                if attrs.get("title"):
+                    self.current[field] = attrs["title"]
+                else:
+                    self.current[field] = ""
+                    self.capture = (field, self.depth)
+        href = attrs.get("href") or ""
+        if tag == "a" and "watch?v=" in href and self.current["videoId"] is None:
+            self.current["videoId"] = (parse_qs(urlparse(href).query).get("v") or [None])[0]
+
+    def handle_endtag(self, tag):
+        if tag in self.VOID_TAGS:
+            return
+        if self.capture and self.capture[1] == self.depth:
+            field = self.capture[0]
+            self.current[field] = self.current[field].strip() or None
+            self.capture = None
+        self.depth -= 1
+        if tag == "ytmusic-player-queue-item" and self.current is not None:
+            self.items.append(self.current)
+            self.current = None
+
+    def handle_data(self, data):
+        if self.capture:
+            self.current[self.capture[0]] += data
+
+
+def parse_playlist_html(html, playlist_url=None):
+    """
+    保存したHTMLからキューのアイテムを取り出す（ブラウザ不要）
+    初期データがあればそれを使い、なければDOMのアンカーのhrefから動画IDを取る
+    """
+    video_data = parse_initial_data(html, playlist_url)
+    if video_data:
+        return video_data
+    parser = QueueItemParser()
+    parser.feed(html)
+    parser.close()
+    return to_video_data(parser.items, playlist_url)
+
+
+def load_html_snapshots(paths, playlist_url=None):
+    video_data = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            videos = parse_playlist_html(f.read(), playlist_url)
+        print(f"📄 {path}: {len(videos)}曲")
+        video_data.extend(videos)
+    return video_data
+
+
+
 def get_playlist_videos(playlist_url):
     options = webdriver.ChromeOptions()
     options.add_argument("--headless=True")
@@ -138,11 +556,57 @@ def save_to_csv(video_data, filename=CSV_FILE):
     except Exception as e:
         print(f"❌ CSV ファイルへの保存中にエラーが発生しました: {e}")
 
-def main():
+def video_id_of(url):
+    return (parse_qs(urlparse(url or "").query).get("v") or [None])[0]
+
+
+def merge_into_csv(video_data, filename=CSV_FILE):
+    """
+    当日のCSVに、まだ含まれていない動画IDの曲だけを追記する
+    戻り値は追記した曲数
+    """
+    known = set()
+    if os.path.exists(filename):
+        with open(filename, mode="r", newline="", encoding="utf-8") as file:
+            known = {video_id_of(row.get("url")) for row in csv.DictReader(file)}
+    new_videos = []
+    for video in video_data:
+        video_id = video_id_of(video["url"])
+        if video_id in known:
+            continue
+        known.add(video_id)
+        new_videos.append(video)
+    print(f"🧹 重複を除外しました: {len(video_data) - len(new_videos)}曲 / 追加: {len(new_videos)}曲")
+    if new_videos:
+        save_to_csv(new_videos, filename)
+    return len(new_videos)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="YouTube Musicのプレイリストから曲の一覧を取得してCSVに保存する")
+    parser.add_argument("--mode", choices=["bulk", "click"], default="bulk",
+                        help="bulk: キューの全アイテムを1回で取得 / click: 1曲ずつ再生してURLを取得（従来の方法）")
+    parser.add_argument("--playlist", default=PLAYLIST_URL, help="取得するプレイリストのURL")
+    parser.add_argument("--from-html", nargs="+", default=None, metavar="HTML",
+                        help="ブラウザを使わず、保存したHTMLファイルから取得する")
+    parser.add_argument("--playlists", default=None, metavar="FILE",
+                        help="1行に1つのプレイリストURLを書いたファイル。ドライバーのプールで並列に取得する")
+    parser.add_argument("--drivers", type=int, default=DEFAULT_DRIVER_POOL_SIZE,
+                        help="--playlistsで同時に使うヘッドレスChromeの台数")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
     try:
-        videos = get_playlist_videos(PLAYLIST_URL)
+        if args.from_html:
+            videos = load_html_snapshots(args.from_html, args.playlist)
+        elif args.playlists:
+            videos = scrape_playlists(read_playlists(args.playlists), args.drivers)
+        elif args.mode == "bulk":
+            videos = get_playlist_videos_bulk(args.playlist)
+        else:
+            videos = get_playlist_videos(args.playlist)
         if videos:
-            save_to_csv(videos)
+            merge_into_csv(videos)
         else:
             print("❌ 動画データが取得できませんでした。")
         return 0  # 正常終了
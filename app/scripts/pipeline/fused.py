@@ -0,0 +1,247 @@
+###分離から間奏区間分析・ギター判定までを、ステムをディスクに書き出さずにメモリ上で行うパイプライン
+
+import argparse
+import logging
+import os
+import sys
+import time
+import numpy as np
+from ..db.pool import SONG_TABLE, get_connection
+from ..analyze.duration_analyze import detect_silent_sections_from_waveform, insert_soro_records_bulk
+from ..analyze import is_guitar_analyze_duration as guitar
+from ..analyze.yamnet_daemon import DEFAULT_SOCKET_PATH
+from ..separate.engine import DemucsEngine
+from ..separate.prescreen import ACTIVITY_THRESHOLD, overlaps_windows, separate_prescreened
+from ..separate.stems import ANALYSIS_SAMPLE_RATE, STEM_FORMATS, stem_to_numpy, write_stems
+from ..separate.scheduler import PRESETS, preset_options
+from ..separate.separate import (
+    REQUIRED_STEMS, downloaded_base_dir, extract_song_id, find_downloaded_files,
+    find_pending_files, separated_base_dir, update_separation_status
+)
+
+SILENCE_THRESHOLD = 0  # duration_analyze.pyと同じ判定基準
+MIN_SILENCE_DURATION = 5
+GUITAR_SCORE_THRESHOLD = 0.5  # is_guitar_analyze_duration.pyと同じ判定基準
+
+
+def stem_to_mono(source):
+    """
+    分離結果のステムをモノラルのfloat32波形にする
+    書き出したWAVをlibrosa.loadで読み直した場合と同じく、rescale後にチャンネル平均をとる
+    """
+    wav = stem_to_numpy(source)
+    return wav.mean(axis=0) if wav.ndim > 1 else wav
+
+
+def written_bytes(track_dir, manifest):
+    return sum(os.path.getsize(os.path.join(track_dir, file_name)) for file_name in manifest["stems"].values())
+
+
+def process_song(engine, wav_path, connection, update_buffer, write_format=None, stems_to_write=None,
+                 batch_size=guitar.INFERENCE_BATCH_SIZE, prescreen=False, activity_threshold=ACTIVITY_THRESHOLD):
+    """
+    1曲を分離し、ボーカルの無音区間検出・soroテーブルへの挿入・ギター判定までを行う
+    write_formatを指定した場合だけステムをディスクに書き出す
+    prescreen=Trueの場合はボーカルがなさそうな区間だけを分離し、ギター判定も分離した区間と重なる区間だけ行う
+    is_separatedは分析に必要なステムを全長で書き出した場合だけ更新する（分析済みかどうかはis_analyzedで管理する）
+    戻り値は処理時間と入出力量の統計情報
+    """
+    import librosa
+
+    song_id = extract_song_id(wav_path)
+    if song_id is None:
+        raise ValueError(f"ファイル名からsong_idを抽出できませんでした: {wav_path}")
+    stats = {"song_id": song_id, "read_bytes": os.path.getsize(wav_path), "written_bytes": 0,
+             "separated_fraction": 1.0}
+
+    started = time.perf_counter()
+    windows = None
+    if prescreen:
+        stems, windows, stats["separated_fraction"] = separate_prescreened(
+            engine, engine.load_track(wav_path), activity_threshold
+        )
+    else:
+        stems = engine.separate_tensor(engine.load_track(wav_path))
+    stats["separate_seconds"] = time.perf_counter() - started
+
+    stems_complete = False
+    if write_format:
+        track_name = os.path.splitext(os.path.basename(wav_path))[0]
+        track_dir = os.path.join(separated_base_dir(), engine.model_name, track_name)
+        manifest = write_stems(stems, track_dir, engine.samplerate, stems_to_write, write_format,
+                               prescreened=prescreen)
+        stats["written_bytes"] = written_bytes(track_dir, manifest)
+        # 事前絞り込みしたステムは候補区間の外が分離されていないため、分離済みとはみなさない
+        # （マニフェストにも記録し、後で separate --incremental が完了済みと誤認しないようにする）
+        stems_complete = not prescreen and all(stem in manifest["stems"] for stem in REQUIRED_STEMS)
+
+    # 間奏区間（ボーカルの無音区間）の検出と挿入
+    analyze_started = time.perf_counter()
+    silent_sections = detect_silent_sections_from_waveform(
+        stem_to_mono(stems["vocals"]), engine.samplerate,
+        silence_threshold=SILENCE_THRESHOLD, min_silence_duration=MIN_SILENCE_DURATION
+    )
+    insert_soro_records_bulk({song_id: silent_sections}, connection=connection)
+
+    # ギター判定（ギターステムは1回だけ16000Hzにリサンプリングする）
+    intervals = guitar.get_guitar_intervals(song_id, connection)
+    connection.commit()  # 区間の読み込みトランザクションを終了
+    if windows is not None:
+        # 分離していない区間のギターステムは無音なので、判定すると以前の結果をスコア0で上書きしてしまう
+        intervals = [(soro_id, start_time, end_time) for soro_id, start_time, end_time in intervals
+                     if overlaps_windows(float(start_time), float(end_time), windows, engine.samplerate)]
+    segment_count = 0
+    if intervals:
+        waveform = librosa.resample(stem_to_mono(stems["guitar"]), orig_sr=engine.samplerate,
+                                    target_sr=ANALYSIS_SAMPLE_RATE)
+        interval_scores, segment_count = guitar.score_intervals_batched(
+            wav_path, waveform, ANALYSIS_SAMPLE_RATE, intervals, guitar.SEGMENT_DURATION, batch_size
+        )
+        for (soro_id, start_time, end_time), segment_scores in zip(intervals, interval_scores):
+            max_score = max(segment_scores)
+            is_guitar_detected = max_score > GUITAR_SCORE_THRESHOLD
+            logging.info(f"song_id {song_id} ({start_time}-{end_time}s): "
+                         f"{'ギター検出' if is_guitar_detected else 'ギターなし'} (最大スコア: {max_score:.2f})")
+            update_buffer.add(soro_id, is_guitar_detected, max_score, song_id)
+    stats["analyze_seconds"] = time.perf_counter() - analyze_started
+    stats["segments"] = segment_count
+    stats["intervals"] = len(intervals)
+
+    if stems_complete:
+        update_separation_status(song_id)
+    engine.processed += 1
+    stats["latency_seconds"] = time.perf_counter() - started
+    return stats
+
+
+def find_today_files():
+    from datetime import datetime
+    date_path = os.path.join(downloaded_base_dir(), datetime.now().strftime("%Y%m%d"))
+    if not os.path.isdir(date_path):
+        logging.error(f"{date_path} が存在しません。")
+        return []
+    return sorted(os.path.join(date_path, file) for file in os.listdir(date_path) if file.endswith('.wav'))
+
+
+def find_unanalyzed_files():
+    """ステムを書き出さない場合は分離済みフォルダを確認せず、is_analyzed = false の曲だけを返す"""
+    wav_files = find_downloaded_files()
+    if not wav_files:
+        return []
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT song_id, is_analyzed FROM {SONG_TABLE} WHERE song_id = ANY(%s)",
+                           (list(wav_files),))
+            status = dict(cursor.fetchall())
+    return [wav_path for song_id, wav_path in sorted(wav_files.items()) if status.get(song_id) is False]
+
+
+def mark_analyzed(connection, pending, update_buffer):
+    """
+    ギター判定の結果まで書き込めた曲のis_analyzedを更新し、pendingから取り除く
+    pendingは (song_id, ギター区間数) のリスト（区間がない曲は書き込む結果がないため、そのまま完了とする）
+    途中の自動フラッシュで一部の区間だけ書き込まれた曲は、全区間の書き込みが終わるまで完了としない
+    """
+    done = [song_id for song_id, intervals in pending
+            if update_buffer.written_songs.get(song_id, 0) >= intervals]
+    if not done:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE {SONG_TABLE} SET is_analyzed = TRUE WHERE song_id = ANY(%s)", (done,))
+    connection.commit()
+    pending[:] = [entry for entry in pending if entry[0] not in done]
+
+
+def run(wav_paths, write_format=None, stems_to_write=None, preset="balanced", segment=None,
+        batch_size=guitar.INFERENCE_BATCH_SIZE, socket_path=DEFAULT_SOCKET_PATH, flush_size=guitar.UPDATE_FLUSH_SIZE,
+        prescreen=False, activity_threshold=ACTIVITY_THRESHOLD):
+    """全曲を順に処理し、曲ごとのレイテンシとディスク入出力量を出力する"""
+    if not wav_paths:
+        logging.info("処理するWAVファイルがありません。")
+        return
+    engine = DemucsEngine(**preset_options(preset, segment))
+    guitar.init_worker(socket_path)
+    latencies = []
+    read_total = 0
+    written_total = 0
+    with get_connection() as connection:
+        connection.autocommit = False  # 更新はSoroUpdateBufferでまとめてコミットする
+        update_buffer = guitar.SoroUpdateBuffer(connection, flush_size=flush_size)
+        pending = []  # 判定結果の書き込み待ちでis_analyzedを更新していない曲
+        for wav_path in wav_paths:
+            logging.info(f"Processing: {wav_path}")
+            try:
+                stats = process_song(engine, wav_path, connection, update_buffer,
+                                     write_format, stems_to_write, batch_size, prescreen, activity_threshold)
+            except Exception as e:
+                connection.rollback()
+                logging.error(f"{wav_path} の処理に失敗しました: {e}")
+                engine.record_failure(wav_path, e)
+                continue
+            pending.append((stats["song_id"], stats["intervals"]))
+            mark_analyzed(connection, pending, update_buffer)
+            latencies.append(stats["latency_seconds"])
+            read_total += stats["read_bytes"]
+            written_total += stats["written_bytes"]
+            logging.info(f"完了: {os.path.basename(wav_path)} レイテンシ {stats['latency_seconds']:.1f}秒 "
+                         f"(分離 {stats['separate_seconds']:.1f}秒, 分離した長さ {stats['separated_fraction']:.0%} / 分析 {stats['analyze_seconds']:.1f}秒, "
+                         f"{stats['segments']}セグメント), 書き出し {stats['written_bytes'] / 1024 ** 2:.1f}MB")
+        update_buffer.flush()
+        mark_analyzed(connection, pending, update_buffer)
+
+    engine.report()
+    if latencies:
+        logging.info(f"曲ごとのレイテンシ: 平均 {np.mean(latencies):.1f}秒 / 最大 {np.max(latencies):.1f}秒")
+    logging.info(f"ディスク入出力: 読み込み {read_total / 1024 ** 2:.1f}MB / 書き出し {written_total / 1024 ** 2:.1f}MB")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="分離・間奏区間分析・ギター判定をメモリ上で続けて行う")
+    parser.add_argument("--write-stems", dest="write_format", choices=STEM_FORMATS, default=None,
+                        help="分離したステムを指定した形式でディスクにも書き出す（省略時は書き出さない）")
+    parser.add_argument("--stems", default=None,
+                        help="書き出すステムをカンマ区切りで指定（例: vocals,guitar）。省略時は全ステム")
+    parser.add_argument("--prescreen", action="store_true",
+                        help="ミックスからボーカルがなさそうな区間を事前に絞り込み、その区間だけを分離する")
+    parser.add_argument("--activity-threshold", type=float, default=ACTIVITY_THRESHOLD,
+                        help="--prescreen: ボーカル帯域の比率がこの値以下のフレームを候補にする（0〜1）")
+    parser.add_argument("--incremental", action="store_true",
+                        help="全ての日付フォルダから未処理の曲だけを処理する（ステムを書き出す場合は未分離、書き出さない場合は未分析の曲）")
+    parser.add_argument("--preset", choices=list(PRESETS), default="balanced",
+                        help="速度と品質のプリセット（shifts / overlap）")
+    parser.add_argument("--segment", type=float, default=None,
+                        help="Demucsのsegment長（秒）。プリセットの値を上書きする")
+    parser.add_argument("--batch-size", type=int, default=guitar.INFERENCE_BATCH_SIZE,
+                        help="1回の推論でまとめるセグメント数")
+    parser.add_argument("--daemon-socket", default=DEFAULT_SOCKET_PATH,
+                        help="YAMNet推論デーモンのソケット（起動していなければプロセス内で推論）")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="推論デーモンを使わずにプロセス内で推論する")
+    parser.add_argument("--flush-size", type=int, default=guitar.UPDATE_FLUSH_SIZE,
+                        help="soroテーブルへまとめて書き込む行数")
+    args = parser.parse_args(argv)
+    args.stems = [stem.strip() for stem in args.stems.split(",") if stem.strip()] if args.stems else None
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        if args.incremental:
+            if args.write_format:
+                wav_paths = find_pending_files(args.stems or REQUIRED_STEMS)
+            else:
+                wav_paths = find_unanalyzed_files()
+        else:
+            wav_paths = find_today_files()
+        run(wav_paths, args.write_format, args.stems, args.preset, args.segment, args.batch_size,
+            None if args.no_daemon else args.daemon_socket, args.flush_size, args.prescreen,
+            args.activity_threshold)
+        return 0  # 正常終了
+    except Exception as e:
+        logging.error(f"パイプラインの処理でエラーが発生しました: {e}")
+        return 1  # エラー終了
+
+
+if __name__ == "__main__":
+    sys.exit(main())
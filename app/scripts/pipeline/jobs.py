@@ -0,0 +1,429 @@
+###PostgreSQLのJobテーブルを使った複数マシン向けのジョブキュー
+# 曲とステージごとのジョブをSELECT ... FOR UPDATE SKIP LOCKEDで取得し、リース（期限）を付けて処理する
+# 処理中はハートビートでリースを延長し、ワーカーが落ちてリースが切れたジョブは他のワーカーが取り直す
+# パスは共有ストレージのルート（MUSIC_STORAGE_ROOT）からの相対パスで保存し、どのマシンからでも同じ曲を参照できる
+
+import argparse
+import os
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+from ..db.pool import JOB_TABLE, SONG_TABLE, execute_prepared, get_connection
+
+JOB_STAGES = ("separate", "duration", "guitar")
+NEXT_STAGE = {"separate": "duration", "duration": "guitar", "guitar": None}
+
+LEASE_SECONDS = 600  # ハートビートがないまま、この秒数が経ったジョブは他のワーカーが取り直せる
+MAX_ATTEMPTS = 3  # この回数失敗したジョブはfailedにして取得しない
+POLL_INTERVAL = 5.0  # ジョブがないときに次の取得まで待つ秒数
+
+# 共有ストレージのルート（省略時はこのリポジトリのapp/music）
+STORAGE_ROOT = os.environ.get(
+    "MUSIC_STORAGE_ROOT",
+    os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../music'))
+)
+
+ENQUEUE_QUERY = f"""
+    INSERT INTO {JOB_TABLE} (song_id, stage, path)
+    VALUES %s
+    ON CONFLICT (song_id, stage) DO NOTHING
+"""
+
+# 取得待ちのジョブか、リースの切れたジョブを1件ロックして取得する
+# 他のワーカーがロック中の行は飛ばすので、複数のワーカーが同時に取得しても同じジョブを取らない
+CLAIM_QUERY = f"""
+    WITH candidate AS (
+        SELECT song_id, stage
+        FROM {JOB_TABLE}
+        WHERE stage = %(stage)s
+          AND attempts < %(max_attempts)s
+          AND (status = 'pending' OR (status = 'running' AND lease_expires_at < now()))
+        ORDER BY created_at, song_id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE {JOB_TABLE} AS job
+    SET status = 'running',
+        worker_id = %(worker_id)s,
+        attempts = job.attempts + 1,
+        lease_expires_at = now() + make_interval(secs => %(lease_seconds)s),
+        heartbeat_at = now(),
+        updated_at = now()
+    FROM candidate
+    WHERE job.song_id = candidate.song_id AND job.stage = candidate.stage
+    RETURNING job.song_id, job.stage, job.path, job.attempts
+"""
+
+COMPLETE_QUERY = f"""
+    UPDATE {JOB_TABLE}
+    SET status = 'done', lease_expires_at = NULL, last_error = NULL, updated_at = now()
+    WHERE song_id = %s AND stage = %s AND worker_id = %s AND status = 'running'
+"""
+
+# 失敗回数がmax_attemptsに達したジョブはfailedにし、それ以外は取得待ちに戻す
+FAIL_QUERY = f"""
+    UPDATE {JOB_TABLE}
+    SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+        lease_expires_at = NULL, last_error = %s, updated_at = now()
+    WHERE song_id = %s AND stage = %s AND worker_id = %s AND status = 'running'
+"""
+
+# リースが切れたまま最大回数に達したジョブ（処理中にワーカーが落ち続けた曲）をfailedにする
+EXPIRE_QUERY = f"""
+    UPDATE {JOB_TABLE}
+    SET status = 'failed', last_error = 'lease expired', updated_at = now()
+    WHERE status = 'running' AND lease_expires_at < now() AND attempts >= %s
+"""
+
+
+@dataclass
+class Job:
+    """取得したジョブ（pathは共有ストレージのルートからの相対パス）"""
+    song_id: int
+    stage: str
+    path: str
+    attempts: int
+
+
+class LostLease(Exception):
+    """ハートビートの時点で、他のワーカーにジョブを取り直されていた"""
+
+
+def to_storage_path(path, root=None):
+    """絶対パスを共有ストレージのルートからの相対パスにする"""
+    relative = os.path.relpath(os.path.abspath(path), root or STORAGE_ROOT)
+    if relative.startswith(os.pardir):
+        raise ValueError(f"共有ストレージの外のパスです: {path}")
+    return relative.replace(os.sep, "/")
+
+
+def from_storage_path(path, root=None):
+    """共有ストレージのルートからの相対パスを、このマシンの絶対パスにする"""
+    return os.path.join(root or STORAGE_ROOT, *path.split("/"))
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_jobs(jobs, conn):
+    """(song_id, stage, 相対パス) のリストをジョブとして登録する（登録済みのジョブはそのまま）"""
+    if not jobs:
+        return
+    with conn.cursor() as cursor:
+        execute_values(cursor, ENQUEUE_QUERY, jobs)
+
+
+def claim_job(stage, worker_id, conn, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """stageのジョブを1件取得してリースを付ける。取得できるジョブがない場合はNone"""
+    with conn.cursor() as cursor:
+        cursor.execute(CLAIM_QUERY, {
+            "stage": stage,
+            "worker_id": worker_id,
+            "lease_seconds": lease_seconds,
+            "max_attempts": max_attempts,
+        })
+        row = cursor.fetchone()
+    conn.commit()  # ロックはすぐに離し、以降はリースで他のワーカーから守る
+    return Job(*row) if row else None
+
+
+def heartbeat(job, worker_id, conn, lease_seconds=LEASE_SECONDS):
+    """リースを延長する。他のワーカーに取り直されていた場合はFalse"""
+    with conn.cursor() as cursor:
+        execute_prepared(cursor, "heartbeat_job", (job.song_id, job.stage, worker_id, lease_seconds))
+        extended = cursor.rowcount == 1
+    conn.commit()
+    return extended
+
+
+def complete_job(job, worker_id, conn, next_path=None):
+    """
+    ジョブを完了にし、次のステージのジョブを同じトランザクションで登録する
+    リースを失っていた場合は何もせずFalseを返す
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(COMPLETE_QUERY, (job.song_id, job.stage, worker_id))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return False
+    next_stage = NEXT_STAGE[job.stage]
+    if next_stage:
+        enqueue_jobs([(job.song_id, next_stage, next_path or job.path)], conn)
+    conn.commit()
+    return True
+
+
+def fail_job(job, worker_id, error, conn, max_attempts=MAX_ATTEMPTS):
+    """ジョブの失敗を記録する（max_attempts回に達するまでは取得待ちに戻す）"""
+    with conn.cursor() as cursor:
+        cursor.execute(FAIL_QUERY, (max_attempts, str(error)[:1000], job.song_id, job.stage, worker_id))
+    conn.commit()
+
+
+def expire_jobs(conn, max_attempts=MAX_ATTEMPTS):
+    """リースが切れたまま再取得できなくなったジョブをfailedにし、件数を返す"""
+    with conn.cursor() as cursor:
+        cursor.execute(EXPIRE_QUERY, (max_attempts,))
+        expired = cursor.rowcount
+    conn.commit()
+    return expired
+
+
+class LeaseKeeper:
+    """ジョブの処理中に、別スレッドから定期的にリースを延長する"""
+
+    def __init__(self, job, worker_id, lease_seconds=LEASE_SECONDS, interval=None):
+        self.job = job
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.interval = interval or lease_seconds / 3
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{job.song_id}-{job.stage}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with get_connection() as conn:
+                    if not heartbeat(self.job, self.worker_id, conn, self.lease_seconds):
+                        print(f"リースを失いました: song_id {self.job.song_id} ({self.job.stage})")
+                        self.lost = True
+                        return
+            except Exception as e:
+                # 一時的なDBエラーでは止めず、次の間隔で再試行する
+                print(f"ハートビートに失敗しました: song_id {self.job.song_id} ({self.job.stage}): {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+class StageRunner:
+    """ステージごとの処理。分離モデルはワーカーで1度だけロードして使い回す"""
+
+    def __init__(self, preset="balanced", stems=None, stem_format="wav"):
+        self.preset = preset
+        self.stems = stems
+        self.stem_format = stem_format
+        self._engine = None
+
+    def run(self, job):
+        """ジョブを処理し、次のステージに渡す相対パスを返す（失敗した場合は例外）"""
+        return getattr(self, f"run_{job.stage}")(job, from_storage_path(job.path))
+
+    def run_separate(self, job, wav_path):
+        from ..separate.engine import DemucsEngine
+        from ..separate.scheduler import preset_options
+        from ..separate.separate import update_separation_status
+
+        if self._engine is None:
+            self._engine = DemucsEngine(**preset_options(self.preset))
+        # 分離結果も共有ストレージに書き出し、次のステージは別のマシンでも処理できるようにする
+        base_dir = os.path.join(STORAGE_ROOT, "separated", datetime.now().strftime("%Y%m%d"))
+        os.makedirs(base_dir, exist_ok=True)
+        track_dir = self._engine.separate_file(wav_path, base_dir, self.stems, self.stem_format)
+        update_separation_status(job.song_id)
+        return to_storage_path(track_dir)
+
+    def run_duration(self, job, track_dir):
+        from ..analyze.duration_analyze import analyze_vocal_folders
+
+        # 検出やsoroテーブルへの挿入に失敗した曲は戻り値に含まれない
+        if job.song_id not in analyze_vocal_folders([track_dir]):
+            raise RuntimeError(f"無音区間の検出・登録に失敗しました: {track_dir}")
+        return job.path
+
+    def run_guitar(self, job, track_dir):
+        from ..analyze.is_guitar_analyze_duration import analyze_guitar_files
+        from ..separate.stems import find_stem
+
+        guitar_file = find_stem(track_dir, 'guitar')
+        if guitar_file is None:
+            raise RuntimeError(f"ギターステムが見つかりません: {track_dir}")
+        # 全区間の判定結果を書き込めた曲だけが戻り値に含まれる（一部の区間だけ書き込めた曲は失敗として扱う）
+        if job.song_id not in analyze_guitar_files([guitar_file]):
+            raise RuntimeError(f"ギター判定の結果を書き込めませんでした: {guitar_file}")
+        return job.path
+
+
+def process_job(job, runner, worker_id, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """リースを延長しながらジョブを処理し、結果をJobテーブルに記録する。成功した場合はTrue"""
+    print(f"ジョブ開始: song_id {job.song_id} ({job.stage}, {job.attempts}回目) {job.path}")
+    started = time.perf_counter()
+    try:
+        with LeaseKeeper(job, worker_id, lease_seconds) as keeper:
+            next_path = runner.run(job)
+        if keeper.lost:
+            raise LostLease(f"song_id {job.song_id} ({job.stage}) は他のワーカーに取り直されました")
+    except LostLease as e:
+        print(f"ジョブの結果を破棄します: {e}")
+        return False
+    except Exception as e:
+        print(f"ジョブ失敗: song_id {job.song_id} ({job.stage}): {e}")
+        with get_connection() as conn:
+            fail_job(job, worker_id, e, conn, max_attempts)
+        return False
+
+    with get_connection() as conn:
+        if not complete_job(job, worker_id, conn, next_path):
+            print(f"ジョブの完了を記録できませんでした（リース切れ）: song_id {job.song_id} ({job.stage})")
+            return False
+    print(f"ジョブ完了: song_id {job.song_id} ({job.stage}, {time.perf_counter() - started:.1f}秒)")
+    return True
+
+
+def run_worker(stages=JOB_STAGES, worker_id=None, runner=None, lease_seconds=LEASE_SECONDS,
+               max_attempts=MAX_ATTEMPTS, poll_interval=POLL_INTERVAL, drain=False):
+    """
+    stagesのジョブを取得して処理し続ける
+    後ろのステージから優先して取得し、処理中の曲を先に最後まで進める
+    drain=Trueの場合は取得できるジョブがなくなった時点で終了する
+    戻り値は (成功したジョブ数, 失敗したジョブ数)
+    """
+    worker_id = worker_id or default_worker_id()
+    runner = runner or StageRunner()
+    stages = [stage for stage in reversed(JOB_STAGES) if stage in stages]
+    succeeded = failed = 0
+    print(f"ワーカー開始: {worker_id} (ステージ: {', '.join(stages)}, 共有ストレージ: {STORAGE_ROOT})")
+    try:
+        while True:
+            job = None
+            with get_connection() as conn:
+                expire_jobs(conn, max_attempts)
+                for stage in stages:
+                    job = claim_job(stage, worker_id, conn, lease_seconds, max_attempts)
+                    if job:
+                        break
+            if job is None:
+                if drain:
+                    break
+                time.sleep(poll_interval)
+                continue
+            if process_job(job, runner, worker_id, lease_seconds, max_attempts):
+                succeeded += 1
+            else:
+                failed += 1
+    except KeyboardInterrupt:
+        # 処理中だったジョブはリースが切れた後に他のワーカーが取り直す
+        print("ワーカーを停止します")
+    print(f"ワーカー終了: {worker_id} ({succeeded}件成功, {failed}件失敗)")
+    return succeeded, failed
+
+
+def find_storage_wavs(base_dir=None):
+    """
+    共有ストレージのダウンロード済みWAVを探し、{song_id: パス} を返す
+    base_dirを省略した場合は全ての日付フォルダ（downloaded/<YYYYMMDD>）を探す
+    """
+    from ..separate.separate import extract_song_id
+
+    if base_dir is None:
+        downloaded_dir = os.path.join(STORAGE_ROOT, "downloaded")
+        folders = [
+            os.path.join(downloaded_dir, folder) for folder in sorted(os.listdir(downloaded_dir))
+            if folder.isdigit() and os.path.isdir(os.path.join(downloaded_dir, folder))
+        ] if os.path.isdir(downloaded_dir) else []
+    else:
+        folders = [base_dir]
+    wav_files = {}
+    for folder in folders:
+        for file in os.listdir(folder):
+            if file.endswith('.wav'):
+                song_id = extract_song_id(file)
+                if song_id is not None:
+                    wav_files[song_id] = os.path.join(folder, file)
+    return wav_files
+
+
+def enqueue_downloaded(base_dir=None):
+    """
+    ダウンロード済みのWAVのうち、まだ分離していない曲の分離ジョブを登録する
+    戻り値は登録を試みたジョブ数（登録済みのジョブは変更しない）
+    """
+    wav_files = find_storage_wavs(base_dir)
+    if not wav_files:
+        print("ダウンロード済みのWAVファイルがありません。")
+        return 0
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT song_id FROM {SONG_TABLE} WHERE song_id = ANY(%s) AND is_separated = FALSE",
+                (list(wav_files),)
+            )
+            song_ids = [row[0] for row in cursor.fetchall()]
+        jobs = [(song_id, "separate", to_storage_path(wav_files[song_id])) for song_id in sorted(song_ids)]
+        enqueue_jobs(jobs, conn)
+        conn.commit()
+    print(f"分離ジョブを登録しました: {len(jobs)}曲")
+    return len(jobs)
+
+
+def job_counts():
+    """ステージ・状態ごとのジョブ数を {(stage, status): 件数} で返す"""
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT stage, status, COUNT(*) FROM {JOB_TABLE} GROUP BY stage, status")
+            counts = {(stage, status): count for stage, status, count in cursor.fetchall()}
+        conn.commit()
+    return counts
+
+
+def print_status():
+    counts = job_counts()
+    for stage in JOB_STAGES:
+        summary = ", ".join(
+            f"{status} {counts.get((stage, status), 0)}" for status in ("pending", "running", "done", "failed")
+        )
+        print(f"{stage}: {summary}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Jobテーブルを使ったジョブキュー")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = subparsers.add_parser("enqueue", help="ダウンロード済みで未分離の曲の分離ジョブを登録する")
+    enqueue.add_argument("--dir", default=None, help="WAVファイルのフォルダ（省略時は全ての日付フォルダ）")
+
+    worker = subparsers.add_parser("worker", help="ジョブを取得して処理する")
+    worker.add_argument("--stages", default=",".join(JOB_STAGES),
+                        help="処理するステージをカンマ区切りで指定（separate,duration,guitar）")
+    worker.add_argument("--worker-id", default=None, help="ワーカーの名前（省略時は ホスト名:PID）")
+    worker.add_argument("--lease", type=float, default=LEASE_SECONDS, help="ジョブのリースの長さ（秒）")
+    worker.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS, help="ジョブを失敗にするまでの試行回数")
+    worker.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="ジョブがないときの待ち時間（秒）")
+    worker.add_argument("--drain", action="store_true", help="取得できるジョブがなくなったら終了する")
+    worker.add_argument("--preset", default="balanced", help="separate: 速度と品質のプリセット")
+
+    subparsers.add_parser("status", help="ステージ・状態ごとのジョブ数を表示する")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "enqueue":
+        enqueue_downloaded(args.dir)
+    elif args.command == "worker":
+        stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+        unknown = [stage for stage in stages if stage not in JOB_STAGES]
+        if unknown:
+            print(f"エラー: 不明なステージです: {', '.join(unknown)}")
+            raise SystemExit(2)
+        run_worker(stages, args.worker_id, StageRunner(preset=args.preset), args.lease,
+                   args.max_attempts, args.poll_interval, args.drain)
+    elif args.command == "status":
+        print_status()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+###パイプラインの各ステージを同じプロセス内で順に実行するためのステージAPI
+# 各ステージはWorkItemのリストを受け取り、次のステージに渡すWorkItemのリストを返す
+# 受け取るリストがNoneの場合（最初のステージ、または前のステージの処理対象がなかった場合）は、
+# 当日のCSV・日付フォルダやDBの分離状態から処理対象を探す
+
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+STAGE_NAMES = ("getpass", "download", "separate", "duration", "guitar")
+
+# --isolate で1ステージずつ別プロセスとして実行する場合のモジュール
+STAGE_MODULES = {
+    "getpass": "app.scripts.download.getpass",
+    "download": "app.scripts.download.download",
+    "separate": "app.scripts.separate.separate",
+    "duration": "app.scripts.analyze.duration_analyze",
+    "guitar": "app.scripts.analyze.is_guitar_analyze_duration",
+}
+
+DEFAULT_OPTIONS = {
+    "playlist": None,  # getpass: 取得するプレイリストのURL（Noneの場合はgetpass.PLAYLIST_URL）
+    "playlists_file": None,  # getpass: 複数のプレイリストを書いたファイル
+    "download_concurrency": 1,  # download: 同時にダウンロードする曲数
+    "separate_jobs": 1,  # separate: 並列に実行する分離ジョブ数（0で自動決定）
+    "preset": "balanced",  # separate: 速度と品質のプリセット
+    "stems": None,  # separate: 書き出すステム（Noneの場合は全ステム）
+    "stem_format": "wav",  # separate: ステムの出力形式
+    "analyze_workers": 1,  # duration / guitar: 並列に分析するプロセス数
+}
+
+
+@dataclass
+class WorkItem:
+    """ステージ間で受け渡す1曲分の処理対象"""
+    title: Optional[str] = None
+    artist: Optional[str] = None
+    url: Optional[str] = None
+    song_id: Optional[int] = None
+    wav_path: Optional[str] = None
+    track_dir: Optional[str] = None
+
+
+def run_getpass(items, options):
+    """プレイリストから曲の一覧を取得して当日のCSVに追記する"""
+    from ..download import getpass
+
+    if options["playlists_file"]:
+        videos = getpass.scrape_playlists(getpass.read_playlists(options["playlists_file"]))
+    else:
+        videos = getpass.get_playlist_videos_bulk(options["playlist"] or getpass.PLAYLIST_URL)
+    if videos:
+        getpass.merge_into_csv(videos)
+    return [WorkItem(title=video["title"], artist=video["artist"], url=video["url"]) for video in videos]
+
+
+def run_download(items, options):
+    """曲をダウンロードしてDBに登録する（登録済みでWAVもある曲はスキップ）"""
+    from ..download import download
+
+    if items is None:
+        rows = download.read_csv_rows(download.daily_csv_path())
+    else:
+        rows = [(item.title, item.artist, item.url.split('&list=')[0]) for item in items if item.url]
+    downloader = download.create_downloader()
+    rows = download.filter_new_rows(rows, downloader.download_path)
+    registered = download.download_concurrently(downloader, rows, options["download_concurrency"])
+    return [
+        WorkItem(title=title, artist=artist, url=url, song_id=song_id, wav_path=wav_path)
+        for title, artist, url, song_id, wav_path in registered
+    ]
+
+
+def run_separate(items, options):
+    """
+    ダウンロードしたWAVを分離する（失敗した曲は次のステージに渡さない）
+    処理対象がない場合は、全ての日付フォルダから前回までに分離できなかった曲を探して分離する
+    """
+    from ..separate import separate
+
+    if items is None:
+        track_dirs = separate.process_all_audio_files(
+            stems_to_write=options["stems"], stem_format=options["stem_format"],
+            jobs=options["separate_jobs"], preset=options["preset"], incremental=True
+        ) or {}
+        items = [WorkItem(song_id=separate.extract_song_id(wav_path), wav_path=wav_path) for wav_path in track_dirs]
+    else:
+        # 前回までにダウンロードだけ済んで分離できなかった曲も一緒に分離する
+        song_ids = {item.song_id for item in items}
+        items = items + [
+            WorkItem(song_id=separate.extract_song_id(wav_path), wav_path=wav_path)
+            for wav_path in separate.find_pending_files(options["stems"] or separate.REQUIRED_STEMS)
+            if separate.extract_song_id(wav_path) not in song_ids
+        ]
+        track_dirs = separate.separate_files(
+            [item.wav_path for item in items], stems_to_write=options["stems"], stem_format=options["stem_format"],
+            jobs=options["separate_jobs"], preset=options["preset"]
+        )
+    separated = []
+    for item in items:
+        item.track_dir = track_dirs.get(item.wav_path)
+        if item.track_dir:
+            separated.append(item)
+    return separated
+
+
+def _separated_items():
+    from ..analyze.is_guitar_analyze_duration import separated_base_dir
+    base_dir = separated_base_dir()
+    if not os.path.isdir(base_dir):
+        print(f"分離結果のディレクトリが存在しません: {base_dir}")
+        return []
+    return [
+        WorkItem(track_dir=os.path.join(base_dir, folder))
+        for folder in sorted(os.listdir(base_dir)) if os.path.isdir(os.path.join(base_dir, folder))
+    ]
+
+
+def run_duration(items, options):
+    """ボーカルの無音区間（間奏）を検出してsoroテーブルに挿入する"""
+    from ..analyze import duration_analyze
+
+    if items is None:
+        items = _separated_items()
+    analyzed = set(duration_analyze.analyze_vocal_folders(
+        [item.track_dir for item in items], workers=options["analyze_workers"]
+    ))
+    return [item for item in items
+            if duration_analyze.extract_song_id(os.path.basename(item.track_dir)) in analyzed]
+
+
+def run_guitar(items, options):
+    """間奏区間のギターの有無をYAMNetで判定する"""
+    from ..analyze import is_guitar_analyze_duration as guitar
+    from ..separate.stems import find_stem
+
+    if items is None:
+        items = _separated_items()
+    audio_files = [path for path in (find_stem(item.track_dir, 'guitar') for item in items) if path]
+    if audio_files:
+        guitar.analyze_guitar_files(audio_files, workers=options["analyze_workers"])
+    return items
+
+
+STAGES = {
+    "getpass": run_getpass,
+    "download": run_download,
+    "separate": run_separate,
+    "duration": run_duration,
+    "guitar": run_guitar,
+}
+
+
+def parse_stages(value):
+    """カンマ区切りのステージ名を実行順に並べて返す"""
+    names = [name.strip() for name in value.split(",") if name.strip()] if value else list(STAGE_NAMES)
+    unknown = [name for name in names if name not in STAGES]
+    if unknown:
+        raise ValueError(f"不明なステージです: {', '.join(unknown)} (指定できるステージ: {', '.join(STAGE_NAMES)})")
+    return [name for name in STAGE_NAMES if name in names]
+
+
+def run_stages(names, options=None):
+    """
+    指定したステージを同じプロセス内で順に実行し、最後のステージが返したWorkItemのリストを返す
+    前のステージが何も返さなかった場合（新しい曲がない・全て失敗した場合など）は、
+    次のステージは自分で処理対象を探す（前回の実行で途中まで処理した曲を再実行するため）
+    """
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    items = None
+    for name in names:
+        print(f"実行中: {name} ({'自動検出' if items is None else f'{len(items)}曲'})")
+        started = time.perf_counter()
+        items = STAGES[name](items, options)
+        print(f"完了: {name} ({len(items)}曲, {time.perf_counter() - started:.1f}秒)")
+        if not items:
+            print(f"{name} から渡す曲がないため、次のステージは未処理の曲を探して処理します")
+            items = None
+    return items or []
@@ -0,0 +1,305 @@
+###ダウンロード・分離・分析を重ねて実行するストリーミングパイプライン
+# ステージごとにスレッドを1つ用意し、ステージ間を上限付きのキューでつなぐ
+# 曲N+1をダウンロードしている間に曲Nを分離し、曲N-1を分析する
+# キューが満杯になると前のステージは空きができるまで待つ（バックプレッシャー）
+
+import argparse
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .stages import WorkItem
+
+SEPARATE_QUEUE_SIZE = 2  # ダウンロード済みで分離待ちにできる曲数
+ANALYZE_QUEUE_SIZE = 2  # 分離済みで分析待ちにできる曲数
+MONITOR_INTERVAL = 10.0  # キューの長さを表示する間隔（秒）
+
+_DONE = object()  # 前のステージが終了したことを次のステージに伝える目印
+
+
+class StageStats:
+    """ステージごとの処理件数・失敗件数・処理時間を集計する"""
+
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.active = None  # 処理中の曲（キューの状態表示用）
+
+    def summary(self, elapsed):
+        utilization = self.busy_seconds / elapsed * 100 if elapsed > 0 else 0
+        return (f"{self.name}: {self.processed}曲成功, {self.failed}曲失敗, "
+                f"処理時間 {self.busy_seconds:.1f}秒 (稼働率 {utilization:.0f}%)")
+
+
+def _put(target_queue, item, stop_event):
+    """キューに空きができるまで待って入れる。停止要求があった場合はFalseを返す"""
+    while not stop_event.is_set():
+        try:
+            target_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(source_queue, stop_event):
+    """キューから1曲取り出す。停止要求があった場合は_DONEを返す"""
+    while not stop_event.is_set():
+        try:
+            return source_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def download_stage(rows, downloader, separate_queue, stats, stop_event, concurrency=1):
+    """
+    CSVの行を最大concurrency曲ずつダウンロードし、DBに登録した曲を分離キューに入れる
+    分離キューが満杯の間は新しいダウンロードを始めない
+    """
+    from ..download.download import register_downloads
+
+    pending_rows = list(rows)
+    busy_since = None  # 1曲以上ダウンロードしている状態になった時刻
+    futures = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while (pending_rows or futures) and not stop_event.is_set():
+                # 同時にダウンロードするのはconcurrency曲まで
+                while pending_rows and len(futures) < concurrency:
+                    title_csv, artist_csv, csv_url = pending_rows.pop(0)
+                    print(f"ダウンロード開始: {title_csv} by {artist_csv}")
+                    if not futures:
+                        busy_since = time.perf_counter()
+                    future = executor.submit(downloader.download_isolated, csv_url)
+                    futures[future] = (title_csv, artist_csv, csv_url)
+
+                done, _ = wait(futures, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    title_csv, artist_csv, csv_url = futures.pop(future)
+                    if not futures:
+                        # 稼働時間は1曲以上ダウンロードしている時間（並列数で重複して数えない）
+                        stats.busy_seconds += time.perf_counter() - busy_since
+                    try:
+                        metadata, file_path, temp_dir = future.result()
+                    except Exception as e:
+                        print(f"ダウンロードに失敗しました: {title_csv} ({csv_url}): {e}")
+                        stats.failed += 1
+                        continue
+                    if not metadata:
+                        print("metadataの取得に失敗しました。")
+                        stats.failed += 1
+                        continue
+
+                    # 次のステージがすぐに始められるよう、1曲ずつ登録してキューに入れる
+                    registered = register_downloads(
+                        downloader, [(metadata, title_csv, artist_csv, csv_url, file_path, temp_dir)]
+                    )
+                    if not registered:
+                        stats.failed += 1
+                        continue
+                    title, artist, url, song_id, wav_path = registered[0]
+                    stats.processed += 1
+                    item = WorkItem(title=title, artist=artist, url=url, song_id=song_id, wav_path=wav_path)
+                    if not _put(separate_queue, item, stop_event):
+                        break
+    except Exception as e:
+        # 後続のステージが待ち続けないよう、パイプライン全体を止める
+        print(f"ダウンロードステージが異常終了しました: {e}")
+        stop_event.set()
+    finally:
+        if futures:
+            # 停止要求で抜けた場合も、完了を待ったダウンロードの時間を数える
+            stats.busy_seconds += time.perf_counter() - busy_since
+        _put(separate_queue, _DONE, stop_event)
+
+
+def separate_stage(separate_queue, analyze_queue, stats, stop_event, options):
+    """分離キューの曲をロード済みのDemucsモデルで1曲ずつ分離し、分析キューに入れる"""
+    from ..separate.engine import DemucsEngine
+    from ..separate.scheduler import preset_options
+    from ..separate.separate import run_demucs_inprocess
+
+    try:
+        engine = DemucsEngine(**preset_options(options["preset"], options.get("segment")))
+        while True:
+            item = _get(separate_queue, stop_event)
+            if item is _DONE:
+                break
+            stats.active = item.song_id
+            started = time.perf_counter()
+            item.track_dir = run_demucs_inprocess(engine, item.wav_path, options["stems"], options["stem_format"])
+            stats.busy_seconds += time.perf_counter() - started
+            stats.active = None
+            if not item.track_dir:
+                stats.failed += 1
+                continue
+            stats.processed += 1
+            if not _put(analyze_queue, item, stop_event):
+                break
+        engine.report()
+    except Exception as e:
+        print(f"分離ステージが異常終了しました: {e}")
+        stop_event.set()
+    finally:
+        _put(analyze_queue, _DONE, stop_event)
+
+
+def analyze_stage(analyze_queue, stats, stop_event, options):
+    """分析キューの曲について、無音区間の検出とギター判定を1曲ずつ行う"""
+    try:
+        from ..analyze.duration_analyze import analyze_vocal_folders
+        from ..analyze.is_guitar_analyze_duration import analyze_guitar_files
+        from ..separate.stems import find_stem
+
+        while True:
+            item = _get(analyze_queue, stop_event)
+            if item is _DONE:
+                break
+            stats.active = item.song_id
+            started = time.perf_counter()
+            try:
+                if not analyze_vocal_folders([item.track_dir]):
+                    stats.failed += 1
+                    continue
+                guitar_file = find_stem(item.track_dir, 'guitar')
+                if guitar_file is None:
+                    print(f"ギターステムが見つかりません: {item.track_dir}")
+                    stats.failed += 1
+                    continue
+                if item.song_id not in analyze_guitar_files([guitar_file]):
+                    stats.failed += 1
+                    continue
+                stats.processed += 1
+            except Exception as e:
+                print(f"分析に失敗しました: {item.track_dir}: {e}")
+                stats.failed += 1
+            finally:
+                stats.busy_seconds += time.perf_counter() - started
+                stats.active = None
+    except Exception as e:
+        # 分析が止まると分離ステージがキューの空きを待ち続けるため、パイプライン全体を止める
+        print(f"分析ステージが異常終了しました: {e}")
+        stop_event.set()
+
+
+def format_queue_depths(separate_queue, analyze_queue, stage_stats):
+    """各キューに溜まっている曲数と、各ステージで処理中の曲を1行にまとめる"""
+    download, separate, analyze = stage_stats
+    return (f"[キュー] 分離待ち {separate_queue.qsize()}/{separate_queue.maxsize}, "
+            f"分析待ち {analyze_queue.qsize()}/{analyze_queue.maxsize} | "
+            f"ダウンロード済み {download.processed}, "
+            f"分離中 {separate.active or '-'} (済 {separate.processed}), "
+            f"分析中 {analyze.active or '-'} (済 {analyze.processed})")
+
+
+def monitor_queues(separate_queue, analyze_queue, stage_stats, finished, interval=MONITOR_INTERVAL):
+    """interval秒ごとにキューの長さを表示する（パイプラインが終わるまで）"""
+    while not finished.wait(interval):
+        print(format_queue_depths(separate_queue, analyze_queue, stage_stats))
+
+
+def run_streaming(rows, options=None, separate_queue_size=SEPARATE_QUEUE_SIZE,
+                  analyze_queue_size=ANALYZE_QUEUE_SIZE, monitor_interval=MONITOR_INTERVAL, downloader=None):
+    """
+    CSVの行（タイトル, アーティスト, URL）をダウンロード・分離・分析まで流す
+    キューの上限（separate_queue_size, analyze_queue_size）で、先行してダウンロード・分離する曲数を制限する
+    戻り値は各ステージのStageStats
+    """
+    from ..download import download
+    from .stages import DEFAULT_OPTIONS
+
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    if separate_queue_size < 1 or analyze_queue_size < 1:
+        raise ValueError("キューの上限は1以上を指定してください")
+
+    downloader = downloader or download.create_downloader()
+    rows = download.filter_new_rows(rows, downloader.download_path)
+    if not rows:
+        print("ダウンロードする曲がありません。")
+        return None
+
+    separate_queue = queue.Queue(maxsize=separate_queue_size)
+    analyze_queue = queue.Queue(maxsize=analyze_queue_size)
+    stage_stats = (StageStats("download"), StageStats("separate"), StageStats("analyze"))
+    stop_event = threading.Event()
+    finished = threading.Event()
+
+    threads = [
+        threading.Thread(target=download_stage, name="download", daemon=True,
+                         args=(rows, downloader, separate_queue, stage_stats[0], stop_event,
+                               max(1, options["download_concurrency"]))),
+        threading.Thread(target=separate_stage, name="separate", daemon=True,
+                         args=(separate_queue, analyze_queue, stage_stats[1], stop_event, options)),
+        threading.Thread(target=analyze_stage, name="analyze", daemon=True,
+                         args=(analyze_queue, stage_stats[2], stop_event, options)),
+    ]
+    monitor = threading.Thread(target=monitor_queues, name="monitor", daemon=True,
+                               args=(separate_queue, analyze_queue, stage_stats, finished, monitor_interval))
+
+    print(f"ストリーミング実行: {len(rows)}曲 (分離待ち上限 {separate_queue_size}曲, 分析待ち上限 {analyze_queue_size}曲)")
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    monitor.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=0.5)
+    except KeyboardInterrupt:
+        # 処理中の曲が終わったところで各ステージを止める
+        print("中断要求を受け付けました。処理中の曲が終わり次第停止します")
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        finished.set()
+        monitor.join()
+
+    elapsed = time.perf_counter() - started
+    print(f"ストリーミング実行完了 ({elapsed:.1f}秒)")
+    for stats in stage_stats:
+        print(stats.summary(elapsed))
+    return stage_stats
+
+
+def parse_args(argv=None):
+    from .stages import DEFAULT_OPTIONS
+
+    parser = argparse.ArgumentParser(description="ダウンロード・分離・分析を重ねて実行する")
+    parser.add_argument("--csv", default=None, help="ダウンロードする曲のCSV（省略時は当日のCSV）")
+    parser.add_argument("--separate-queue-size", type=int, default=SEPARATE_QUEUE_SIZE,
+                        help="ダウンロード済みで分離待ちにできる曲数")
+    parser.add_argument("--analyze-queue-size", type=int, default=ANALYZE_QUEUE_SIZE,
+                        help="分離済みで分析待ちにできる曲数")
+    parser.add_argument("--monitor-interval", type=float, default=MONITOR_INTERVAL,
+                        help="キューの長さを表示する間隔（秒）")
+    parser.add_argument("--download-concurrency", type=int, default=DEFAULT_OPTIONS["download_concurrency"],
+                        help="同時にダウンロードする曲数")
+    parser.add_argument("--preset", default=DEFAULT_OPTIONS["preset"], help="分離の速度と品質のプリセット")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from ..download import download
+
+    args = parse_args(argv)
+    csv_path = args.csv or download.daily_csv_path()
+    if not os.path.exists(csv_path):
+        print(f"CSVファイルが見つかりません: {csv_path}")
+        return
+    run_streaming(
+        download.read_csv_rows(csv_path),
+        {"download_concurrency": args.download_concurrency, "preset": args.preset},
+        separate_queue_size=args.separate_queue_size,
+        analyze_queue_size=args.analyze_queue_size,
+        monitor_interval=args.monitor_interval,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+###Demucsのモデルを1度だけロードし、プロセス内で複数曲を分離するエンジン
+
+import os
+import time
+from .stems import write_stems
+
+
+class DemucsEngine:
+    """
+    Demucs Python APIを使った分離エンジン
+    モデルの読み込み（起動時間）と分離処理（計算時間）を分けて計測する
+    """
+
+    def __init__(self, model_name="htdemucs_6s", device=None, shifts=1, overlap=0.25, segment=None):
+        started = time.perf_counter()
+        import torch
+        from demucs.pretrained import get_model
+
+        self.model_name = model_name
+        self.model = get_model(model_name)
+        self.model.eval()
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.shifts = shifts
+        self.overlap = overlap
+        self.segment = segment
+        self.startup_seconds = time.perf_counter() - started
+        self.compute_seconds = 0.0
+        self.processed = 0
+        self.failures = []
+        print(f"Demucsモデル {model_name} をロードしました ({self.startup_seconds:.1f}秒, device={self.device})")
+
+    @property
+    def samplerate(self):
+        return self.model.samplerate
+
+    @property
+    def sources(self):
+        return list(self.model.sources)
+
+    def load_track(self, input_file):
+        """音声ファイルをモデルのサンプルレート・チャンネル数で読み込む"""
+        from demucs.audio import AudioFile
+        return AudioFile(input_file).read(
+            streams=0, samplerate=self.model.samplerate, channels=self.model.audio_channels
+        )
+
+    def separate_tensor(self, wav):
+        """
+        (チャンネル, サンプル) の波形を分離し、{ステム名: 波形} を返す
+        正規化はdemucsコマンドと同じく、モノラル平均の平均・標準偏差で行う
+        """
+        import torch
+        from demucs.apply import apply_model
+
+        started = time.perf_counter()
+        ref = wav.mean(0)
+        mean, std = ref.mean(), ref.std()
+        with torch.no_grad():
+            sources = apply_model(
+                self.model, ((wav - mean) / std)[None], device=self.device,
+                shifts=self.shifts, split=True, overlap=self.overlap,
+                segment=self.segment, progress=False
+            )[0]
+        sources = sources * std + mean
+        self.compute_seconds += time.perf_counter() - started
+        return dict(zip(self.model.sources, sources))
+
+    def separate_file(self, input_file, out_dir, stems_to_write=None, stem_format="wav"):
+        """
+        1曲を分離し、demucsコマンドと同じ {out_dir}/{モデル名}/{曲名}/ に保存する
+        stems_to_writeを指定した場合はそのステムだけを、stem_format形式で書き出す
+        戻り値は保存先のディレクトリ
+        """
+        stems = self.separate_tensor(self.load_track(input_file))
+        track_name = os.path.splitext(os.path.basename(input_file))[0]
+        track_dir = os.path.join(out_dir, self.model_name, track_name)
+        write_stems(stems, track_dir, self.model.samplerate, stems_to_write, stem_format)
+        self.processed += 1
+        return track_dir
+
+    def record_failure(self, input_file, error):
+        self.failures.append((input_file, str(error)))
+
+    def report(self):
+        """起動時間と計算時間の内訳を出力"""
+        print(f"Demucs起動時間: {self.startup_seconds:.1f}秒 / 分離計算時間: {self.compute_seconds:.1f}秒 "
+              f"({self.processed}曲成功, {len(self.failures)}曲失敗)")
+        for input_file, error in self.failures:
+            print(f"  失敗: {input_file}: {error}")
@@ -0,0 +1,169 @@
+###元のミックスを軽量な判定で事前に絞り込み、ボーカルがなさそうな区間だけをDemucsで分離する
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from ..analyze.silence import FRAME_LENGTH, HOP_LENGTH, compute_frame_energy, find_silent_runs
+
+VOCAL_BAND_HZ = (300.0, 3400.0)  # ボーカルの主な帯域
+# ボーカル帯域の比率がこの値以下のフレームを候補にする（曲ごとの分位点ではなく絶対値なので、
+# ボーカルが鳴り続ける曲では候補がほとんど出ず、分離する長さが曲の構成に応じて決まる）
+ACTIVITY_THRESHOLD = 0.35
+QUIET_THRESHOLD_DB = 0.0  # これより静かなフレームは帯域に関係なく候補にする（無音区間検出と同じ基準）
+SMOOTHING_SECONDS = 1.0  # ボーカル活動度を平滑化する長さ
+MIN_CANDIDATE_SECONDS = 3.0  # 候補とする区間の最短の長さ（間奏判定の5秒より短くして取りこぼしを防ぐ）
+WINDOW_PADDING_SECONDS = 4.0  # 候補区間の前後に付け足す長さ
+RECALL_MIN_OVERLAP = 0.9  # 全体分離の区間をこの割合以上覆っていれば検出できたとみなす
+
+
+def vocal_activity(y, sr, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH):
+    """
+    フレームごとの簡易ボーカル活動度（全体のエネルギーに占めるボーカル帯域の比率を平滑化したもの）
+    フレームの位置は無音区間検出（compute_frame_energy）と揃える
+    """
+    y = np.asarray(y, dtype=np.float32)
+    if len(y) < frame_length:
+        # center=Falseのstftは1フレームに満たない入力を扱えない
+        return np.zeros(0, dtype=np.float32)
+    import librosa
+
+    power = np.abs(librosa.stft(y, n_fft=frame_length, hop_length=hop_length, center=False)) ** 2
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=frame_length)
+    band = (freqs >= VOCAL_BAND_HZ[0]) & (freqs <= VOCAL_BAND_HZ[1])
+    ratio = power[band].sum(axis=0) / (power.sum(axis=0) + 1e-10)
+
+    width = max(1, int(SMOOTHING_SECONDS * sr / hop_length))
+    return np.convolve(ratio, np.ones(width) / width, mode="same")
+
+
+def propose_windows(y, sr, activity_threshold=ACTIVITY_THRESHOLD, min_candidate_seconds=MIN_CANDIDATE_SECONDS,
+                    padding_seconds=WINDOW_PADDING_SECONDS, hop_length=HOP_LENGTH):
+    """
+    モノラルのミックスからボーカルがなさそうな区間を探し、前後に余白を付けて重なりを結合した
+    [(開始サンプル, 終了サンプル)] のリストを返す
+    """
+    if len(y) < FRAME_LENGTH:
+        # 1フレームに満たない短い入力は判定できないため全体を分離する
+        return [(0, len(y))] if len(y) else []
+    energy_db = 10 * np.log10(compute_frame_energy(y, hop_length=hop_length) + 1e-6)
+    activity = vocal_activity(y, sr, hop_length=hop_length)
+    candidates = energy_db < QUIET_THRESHOLD_DB
+    if len(activity):
+        candidates[:len(activity)] |= activity <= activity_threshold
+
+    starts, ends = find_silent_runs(candidates)
+    keep = (ends - starts) * hop_length / sr >= min_candidate_seconds
+    padding = int(padding_seconds * sr)
+    windows = []
+    for start, end in zip(starts[keep], ends[keep]):
+        window_start = max(0, int(start) * hop_length - padding)
+        window_end = min(len(y), int(end) * hop_length + padding)
+        if windows and window_start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], window_end))
+        else:
+            windows.append((window_start, window_end))
+    return windows
+
+
+def separate_windows(engine, wav, windows):
+    """
+    (チャンネル, サンプル) のミックスのうちwindowsの区間だけを分離し、曲全体の長さの {ステム名: 波形} にする
+    区間外のボーカルはミックスで、その他のステムは無音で埋める（区間外が間奏と判定されないようにするため）
+    """
+    mix = wav.detach().cpu().numpy() if hasattr(wav, "detach") else np.asarray(wav)
+    stems = {
+        name: (mix.astype(np.float32) if name == "vocals" else np.zeros(mix.shape, dtype=np.float32))
+        for name in engine.sources
+    }
+    for start, end in windows:
+        for name, source in engine.separate_tensor(wav[:, start:end]).items():
+            stems[name][:, start:end] = source.detach().cpu().numpy() if hasattr(source, "detach") else source
+    return stems
+
+
+def separate_prescreened(engine, wav, activity_threshold=ACTIVITY_THRESHOLD):
+    """
+    ミックスを事前に絞り込んでから分離する
+    戻り値は ({ステム名: 波形}, 分離した区間のリスト, 分離した長さの割合)
+    """
+    mix = wav.detach().cpu().numpy() if hasattr(wav, "detach") else np.asarray(wav)
+    windows = propose_windows(mix.mean(axis=0), engine.samplerate, activity_threshold)
+    separated_fraction = sum(end - start for start, end in windows) / max(1, mix.shape[-1])
+    return separate_windows(engine, wav, windows), windows, separated_fraction
+
+
+def overlaps_windows(start_time, end_time, windows, sr):
+    """秒単位の区間 [start_time, end_time] が、分離したサンプル単位の区間のいずれかと重なるか"""
+    return any(start_time < end / sr and start / sr < end_time for start, end in windows)
+
+
+def section_recall(reference_sections, candidate_sections, min_overlap=RECALL_MIN_OVERLAP):
+    """全体分離で検出された区間のうち、事前絞り込みでもmin_overlap以上の割合が検出された区間の割合"""
+    if not reference_sections:
+        return 1.0
+    recalled = 0
+    for ref_start, ref_end in reference_sections:
+        covered = sum(max(0.0, min(ref_end, end) - max(ref_start, start)) for start, end in candidate_sections)
+        if covered >= min_overlap * (ref_end - ref_start):
+            recalled += 1
+    return recalled / len(reference_sections)
+
+
+def check(wav_paths, preset="balanced", activity_threshold=ACTIVITY_THRESHOLD):
+    """
+    全体分離と事前絞り込みの両方で間奏区間を検出し、検出率と削減できた分離時間を出力する
+    """
+    from ..analyze.duration_analyze import detect_silent_sections_from_waveform
+    from .engine import DemucsEngine
+    from .scheduler import preset_options
+    from .stems import stem_to_numpy
+
+    def vocal_sections(stems, sr):
+        vocals = stem_to_numpy(stems["vocals"]).mean(axis=0)
+        return detect_silent_sections_from_waveform(vocals, sr, silence_threshold=0, min_silence_duration=5)
+
+    engine = DemucsEngine(**preset_options(preset))
+    full_total = 0.0
+    prescreen_total = 0.0
+    recalls = []
+    for wav_path in wav_paths:
+        wav = engine.load_track(wav_path)
+
+        started = time.perf_counter()
+        reference = vocal_sections(engine.separate_tensor(wav), engine.samplerate)
+        full_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        stems, windows, fraction = separate_prescreened(engine, wav, activity_threshold)
+        prescreen_seconds = time.perf_counter() - started
+        candidate = vocal_sections(stems, engine.samplerate)
+
+        recall = section_recall(reference, candidate)
+        recalls.append(recall)
+        full_total += full_seconds
+        prescreen_total += prescreen_seconds
+        print(f"{os.path.basename(wav_path)}: 検出率 {recall:.0%} ({len(reference)}区間中), "
+              f"分離した長さ {fraction:.0%} ({len(windows)}区間), "
+              f"分離時間 {full_seconds:.1f}秒 → {prescreen_seconds:.1f}秒")
+
+    if recalls:
+        saved = 1 - prescreen_total / full_total if full_total > 0 else 0.0
+        print(f"平均検出率: {np.mean(recalls):.0%} / 最低検出率: {np.min(recalls):.0%}")
+        print(f"分離時間: {full_total:.1f}秒 → {prescreen_total:.1f}秒 ({saved:.0%}削減)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="事前絞り込みの検出率と削減できる分離時間を全体分離と比較する")
+    parser.add_argument("files", nargs="+", help="比較に使うWAVファイル")
+    parser.add_argument("--preset", default="balanced", help="Demucsのプリセット")
+    parser.add_argument("--activity-threshold", type=float, default=ACTIVITY_THRESHOLD,
+                        help="ボーカル帯域の比率がこの値以下のフレームを候補にする（0〜1）")
+    args = parser.parse_args(argv)
+    check(args.files, args.preset, args.activity_threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+###CPUコア数とメモリから同時実行数とジョブごとのスレッド数を決めてDemucsを並列実行するスケジューラ
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from ..analyze.parallel import run_ordered
+
+# 速度と品質のプリセット（demucsの --shifts / --overlap / --segment に対応）
+PRESETS = {
+    "fast": {"shifts": 0, "overlap": 0.1, "segment": None},
+    "balanced": {"shifts": 1, "overlap": 0.25, "segment": None},  # demucsコマンドの既定値
+    "quality": {"shifts": 2, "overlap": 0.5, "segment": None},
+}
+MEMORY_PER_JOB_BYTES = 3 * 1024 ** 3  # htdemucs_6sを1ジョブ動かすのに必要なメモリの目安
+MIN_THREADS_PER_JOB = 2
+MEMINFO_PATH = "/proc/meminfo"
+
+# ワーカープロセスごとに1つだけ持つ分離エンジン
+_engine = None
+
+
+def available_memory_bytes(meminfo_path=MEMINFO_PATH):
+    """
+    利用可能なメモリ量（取得できない環境ではNone）
+    Linuxでは解放できるページキャッシュも含むMemAvailableを使う（SC_AVPHYS_PAGESは空きメモリだけで少なく出る）
+    """
+    try:
+        with open(meminfo_path, "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024  # kB単位
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def plan_jobs(cpu_count=None, available_memory=None, memory_per_job=MEMORY_PER_JOB_BYTES,
+              min_threads_per_job=MIN_THREADS_PER_JOB):
+    """
+    コア数とメモリ量から (同時実行するジョブ数, ジョブごとのスレッド数) を決める
+    ジョブ数 × スレッド数 がコア数を超えないようにする
+    """
+    cpus = cpu_count or os.cpu_count() or 1
+    jobs = max(1, cpus // min_threads_per_job)
+    if available_memory is None:
+        available_memory = available_memory_bytes()
+    if available_memory is not None:
+        jobs = min(jobs, max(1, available_memory // memory_per_job))
+    return jobs, max(1, cpus // jobs)
+
+
+def preset_options(preset, segment=None):
+    options = dict(PRESETS[preset])
+    if segment is not None:
+        options["segment"] = segment
+    return options
+
+
+def _init_worker(threads, engine_options):
+    """ワーカーのスレッド数を制限してからDemucsモデルをロードする"""
+    global _engine
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    from .engine import DemucsEngine
+    _engine = DemucsEngine(**engine_options)
+
+
+def _separate(job):
+    input_file, out_dir, stems_to_write, stem_format = job
+    compute_before = _engine.compute_seconds
+    track_dir = _engine.separate_file(input_file, out_dir, stems_to_write, stem_format)
+    return track_dir, _engine.compute_seconds - compute_before
+
+
+def run_scheduled(input_files, out_dir, jobs, threads, engine_options, stems_to_write=None, stem_format="wav"):
+    """
+    jobs個のワーカープロセスでDemucsを並列実行し、(入力ファイル, 出力先, 例外) を入力順に返す
+    jobs=1でも新しいプロセスで実行する（スレッド数の設定はtorchのimport前に、プロセスごとに1回しかできないため）
+    """
+    work = [(input_file, out_dir, stems_to_write, stem_format) for input_file in input_files]
+    for job, result, error in run_ordered(_separate, work, workers=jobs, spawn=True,
+                                          initializer=_init_worker, initargs=(threads, engine_options)):
+        yield job[0], (result[0] if result else None), error
+
+
+def thread_splits(cpus, jobs):
+    """同時実行数jobsで試すジョブごとのスレッド数（コアを使い切る数と、その半分）"""
+    full = max(1, cpus // jobs)
+    return sorted({full, max(1, full // 2)}, reverse=True)
+
+
+def measure_throughput(inputs, out_dir, jobs, threads, engine_options):
+    """
+    inputsを分離し、最初のjobs曲（モデルのロードと初回の推論を含むウォームアップ）を除いた
+    1時間あたりの処理曲数と、失敗した曲の例外のリストを返す
+    """
+    errors = []
+    finished = 0
+    warmed_up_at = None
+    for _, _, error in run_scheduled(inputs, out_dir, jobs, threads, engine_options):
+        finished += 1
+        if error is not None:
+            errors.append(error)
+        if finished == jobs:
+            warmed_up_at = time.perf_counter()
+    if errors:
+        return 0.0, errors
+    elapsed = time.perf_counter() - warmed_up_at
+    return (len(inputs) - jobs) / elapsed * 3600 if elapsed > 0 else 0.0, errors
+
+
+def calibrate(sample_file, presets=("balanced",), max_jobs=None):
+    """
+    サンプル曲を使って同時実行数とスレッド数の組み合わせを試し、1時間あたりの処理曲数が最も多いものを返す
+    同時実行数ごとにスレッド数を2通り試し、モデルのロードを除いた処理時間で比較する
+    """
+    cpus = os.cpu_count() or 1
+    memory = available_memory_bytes()
+    memory_jobs = max(1, memory // MEMORY_PER_JOB_BYTES) if memory else cpus
+    candidates = []
+    jobs = 1
+    while jobs <= min(cpus, memory_jobs, max_jobs or cpus):
+        candidates.extend((jobs, threads) for threads in thread_splits(cpus, jobs))
+        jobs *= 2
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="demucs_calibrate_")
+    try:
+        for preset in presets:
+            for jobs, threads in candidates:
+                # ウォームアップ用と計測用に、同時実行数の2倍のサンプル曲を用意する
+                inputs = []
+                for i in range(2 * jobs):
+                    path = os.path.join(work_dir, f"{i}__calibrate.wav")
+                    shutil.copyfile(sample_file, path)
+                    inputs.append(path)
+                songs_per_hour, errors = measure_throughput(
+                    inputs, os.path.join(work_dir, "out"), jobs, threads, preset_options(preset)
+                )
+                results.append((songs_per_hour, preset, jobs, threads))
+                print(f"preset={preset} jobs={jobs} threads={threads}: {songs_per_hour:.1f}曲/時"
+                      + (f" (失敗: {errors[0]})" if errors else ""))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    best = max(results)
+    print(f"最適な設定: preset={best[1]} --jobs {best[2]} --threads {best[3]} ({best[0]:.1f}曲/時)")
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Demucs並列実行のキャリブレーション")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = subparsers.add_parser("calibrate", help="最適な同時実行数とスレッド数を計測する")
+    calibrate_parser.add_argument("--sample", required=True, help="計測に使うWAVファイル")
+    calibrate_parser.add_argument("--presets", default="balanced",
+                                  help=f"試すプリセット（カンマ区切り, {'/'.join(PRESETS)}）")
+    calibrate_parser.add_argument("--max-jobs", type=int, default=None, help="試す同時実行数の上限")
+    subparsers.add_parser("plan", help="現在のマシンでの既定の同時実行数とスレッド数を表示する")
+    args = parser.parse_args(argv)
+
+    if args.command == "plan":
+        jobs, threads = plan_jobs()
+        print(f"--jobs {jobs} --threads {threads}")
+        return 0
+    calibrate(args.sample, tuple(p.strip() for p in args.presets.split(",")), args.max_jobs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,15 @@
 import subprocess
 import os
-import psycopg2
-from ..db.config import DB_CONFIG
+from ..db.pool import SONG_TABLE, execute_prepared, get_connection
 import time  # リトライ間隔のために time をインポート
 import sys
+import argparse
+from .engine import DemucsEngine
+from .stems import STEM_FORMATS, find_stem, read_manifest, stem_duration
+from .scheduler import PRESETS, plan_jobs, preset_options, run_scheduled
+
+REQUIRED_STEMS = ("vocals", "guitar")  # 分析で使うため、分離済みと判定するのに必要なステム
+STEM_DURATION_TOLERANCE = 1.0  # 元の曲より短くても途中で切れていないとみなす長さ（秒）
 
 def update_separation_status(song_id):
     """
@@ -13,29 +19,41 @@ def update_separation_status(song_id):
         song_id (int): 更新する曲のID
     """
     try:
-
-
-        conn = psycopg2.connect(**DB_CONFIG)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE "Song" 
-            SET is_separated = TRUE 
-            WHERE song_id = %s
-        """, (song_id,))
-        
-        conn.commit()
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                execute_prepared(cursor, "mark_song_separated", (song_id,))
+            conn.commit()
         print(f"Song ID {song_id}の分離状態を更新しました")
         
     except Exception as e:
         print(f"データベース更新エラー: {e}")
-        if conn:
-            conn.rollback()
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+
+def separated_base_dir():
+    """当日の分離結果の出力先ディレクトリ"""
+    from datetime import datetime
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        f'../../music/separated/{datetime.now().strftime("%Y%m%d")}')
+
+def run_demucs_inprocess(engine, input_file, stems_to_write=None, stem_format="wav"):
+    """
+    ロード済みのDemucsEngineで音声ファイルを分離する。
+    失敗した場合はエンジンに記録し、プロセスを止めずに次の曲へ進む
+    """
+    try:
+        base_dir = separated_base_dir()
+        os.makedirs(base_dir, exist_ok=True)
+        song_id = extract_song_id(input_file)
+
+        track_dir = engine.separate_file(input_file, base_dir, stems_to_write, stem_format)
+        print(f"Demucs processing completed successfully: {track_dir}")
+
+        # 分離処理が成功したらデータベースを更新
+        update_separation_status(song_id)
+        return track_dir
+    except Exception as e:
+        print(f"Error: {input_file} の分離に失敗しました: {e}")
+        engine.record_failure(input_file, e)
+        return None
 
 def run_demucs(input_file, output_name="htdemucs_6s"):
     """
@@ -49,9 +67,7 @@ def run_demucs(input_file, output_name="htdemucs_6s"):
 
     try:
         # 出力先ディレクトリを作成
-        from datetime import datetime
-        base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                f'../../music/separated/{datetime.now().strftime("%Y%m%d")}')
+        base_dir = separated_base_dir()
         os.makedirs(base_dir, exist_ok=True)
 
         # Demucs コマンドの構築
@@ -71,7 +87,8 @@ def run_demucs(input_file, output_name="htdemucs_6s"):
         
         # 分離処理が成功したらデータベースを更新
         update_separation_status(song_id)
-        # 成功したらループを抜ける
+        # 成功したら出力先のディレクトリを返す
+        return os.path.join(base_dir, output_name, os.path.splitext(os.path.basename(input_file))[0])
 
     
     except subprocess.CalledProcessError as e:
@@ -97,29 +114,240 @@ def extract_song_id(folder_name):
         print(f"フォルダ名 '{folder_name}' からsong_idを抽出できませんでした: {e}")
         return None
 
-def process_all_audio_files():
+def downloaded_base_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../music/downloaded')
+
+def find_downloaded_files():
     """
-    Process all WAV files in the downloaded music directory
+    全ての日付フォルダからダウンロード済みのWAVを探し、{song_id: パス} を返す
+    同じsong_idが複数ある場合は新しい日付フォルダのものを使う
     """
-    base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../music/downloaded')
-    
-    # 日付フォルダを走査
-    from datetime import datetime
-    today = datetime.now().strftime("%Y%m%d")
-    date_path = os.path.join(base_dir, today)
-    if os.path.isdir(date_path):
-        # 当日の日付フォルダ内のWAVファイルを探す
+    base_dir = downloaded_base_dir()
+    wav_files = {}
+    if not os.path.isdir(base_dir):
+        return wav_files
+    for date_folder in sorted(os.listdir(base_dir)):
+        date_path = os.path.join(base_dir, date_folder)
+        if not date_folder.isdigit() or not os.path.isdir(date_path):
+            continue
         for file in os.listdir(date_path):
             if file.endswith('.wav'):
-                wav_path = os.path.join(date_path, file)
-                print(f"Processing: {wav_path}")
-                run_demucs(wav_path)
+                song_id = extract_song_id(file)
+                if song_id is not None:
+                    wav_files[song_id] = os.path.join(date_path, file)
+    return wav_files
+
+def find_separated_dirs(model_name="htdemucs_6s"):
+    """全ての日付フォルダから分離済みの曲フォルダを探し、{song_id: [フォルダ]} を返す"""
+    base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../music/separated')
+    track_dirs = {}
+    if not os.path.isdir(base_dir):
+        return track_dirs
+    for date_folder in sorted(os.listdir(base_dir)):
+        model_path = os.path.join(base_dir, date_folder, model_name)
+        if not os.path.isdir(model_path):
+            continue
+        for folder in os.listdir(model_path):
+            song_id = extract_song_id(folder)
+            if song_id is not None:
+                track_dirs.setdefault(song_id, []).append(os.path.join(model_path, folder))
+    return track_dirs
+
+def stems_complete(track_dir, source_duration, required_stems=REQUIRED_STEMS, tolerance=STEM_DURATION_TOLERANCE):
+    """必要なステムが全て存在し、元の曲と同じ長さまで書き出されているか（事前絞り込みで一部だけ分離したステムは不可）"""
+    manifest = read_manifest(track_dir)
+    if manifest and manifest.get("prescreened"):
+        return False
+    for stem in required_stems:
+        path = find_stem(track_dir, stem)
+        if path is None:
+            return False
+        try:
+            if stem_duration(path) < source_duration - tolerance:
+                return False
+        except Exception:
+            return False  # 書き込み途中でヘッダが壊れている場合
+    return True
+
+def fetch_separation_status(song_ids):
+    """曲ごとのis_separatedを1回のクエリで取得し、{song_id: bool} を返す"""
+    if not song_ids:
+        return {}
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT song_id, is_separated FROM {SONG_TABLE} WHERE song_id = ANY(%s)
+            """, (list(song_ids),))
+            return dict(cursor.fetchall())
+
+def set_separation_status(song_ids, is_separated):
+    """複数曲のis_separatedをまとめて更新する"""
+    if not song_ids:
+        return
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {SONG_TABLE} SET is_separated = %s WHERE song_id = ANY(%s)
+            """, (is_separated, list(song_ids)))
+        conn.commit()
+
+def find_pending_files(required_stems=REQUIRED_STEMS):
+    """
+    全ての日付フォルダのWAVから、分離が必要な曲だけを返す
+    - is_separated = false の曲（ステムが揃っていればフラグだけ更新してスキップ）
+    - is_separated = true でもステムが欠けている・途中で切れている曲は再分離する
+    """
+    wav_files = find_downloaded_files()
+    status = fetch_separation_status(wav_files.keys())
+    track_dirs = find_separated_dirs()
+
+    pending = []
+    requeued = []
+    recovered = []
+    skipped = 0
+    for song_id, wav_path in sorted(wav_files.items()):
+        if song_id not in status:
+            print(f"Song ID {song_id} はデータベースに存在しないためスキップします: {wav_path}")
+            continue
+        try:
+            source_duration = stem_duration(wav_path)
+        except Exception as e:
+            print(f"{wav_path} を読み込めないためスキップします: {e}")
+            continue
+        complete = any(stems_complete(track_dir, source_duration, required_stems)
+                       for track_dir in track_dirs.get(song_id, []))
+        if complete:
+            if not status[song_id]:
+                recovered.append(song_id)
+            skipped += 1
+            continue
+        if status[song_id]:
+            requeued.append(song_id)
+        pending.append(wav_path)
+
+    # ステムは揃っているがフラグが更新されていない曲（DB更新前に中断した曲）
+    set_separation_status(recovered, True)
+    # ステムが欠けている曲は分離が終わるまで未分離に戻す
+    set_separation_status(requeued, False)
+    print(f"分離対象: {len(pending)}曲 (再分離: {len(requeued)}曲), "
+          f"分離済みのためスキップ: {skipped}曲 (フラグのみ更新: {len(recovered)}曲)")
+    return pending
+
+def process_all_audio_files(engine="inprocess", stems_to_write=None, stem_format="wav",
+                            jobs=1, threads=None, preset="balanced", segment=None, incremental=False):
+    """
+    Process all WAV files in the downloaded music directory
+    incremental=Trueの場合は全ての日付フォルダから未分離・ステム欠損の曲だけを処理する
+    """
+    if incremental:
+        wav_paths = find_pending_files(stems_to_write or REQUIRED_STEMS)
     else:
-        print(f"Error: {date_path} is not found.")
+        # 日付フォルダを走査
+        from datetime import datetime
+        today = datetime.now().strftime("%Y%m%d")
+        date_path = os.path.join(downloaded_base_dir(), today)
+        if not os.path.isdir(date_path):
+            print(f"Error: {date_path} is not found.")
+            return {}
+        # 当日の日付フォルダ内のWAVファイルを探す
+        wav_paths = [os.path.join(date_path, file) for file in os.listdir(date_path) if file.endswith('.wav')]
+
+    return separate_files(wav_paths, engine, stems_to_write, stem_format, jobs, threads, preset, segment)
+
+def separate_files(wav_paths, engine="inprocess", stems_to_write=None, stem_format="wav",
+                   jobs=1, threads=None, preset="balanced", segment=None):
+    """
+    WAVファイルのリストを分離する
+    engine="inprocess"の場合はDemucsモデルを1度だけロードして全曲を分離する
+    engine="cli"の場合は曲ごとにdemucsコマンドを実行する（全ステムをwavで出力）
+    stems_to_write・stem_formatで書き出すステムと形式を指定できる（inprocessのみ）
+    jobs > 1 の場合はjobs個のプロセスで並列に分離する（jobs=0でコア数とメモリから自動決定）
+    戻り値は {WAVファイル: 分離結果のディレクトリ（失敗した場合はNone）}
+    """
+    if engine == "cli":
+        if stems_to_write or stem_format != "wav":
+            print("Warning: cliエンジンではステムの選択・出力形式の指定は無視されます")
+        track_dirs = {}
+        for wav_path in wav_paths:
+            print(f"Processing: {wav_path}")
+            track_dirs[wav_path] = run_demucs(wav_path)
+        return track_dirs
+
+    if not wav_paths:
+        print("分離するWAVファイルがありません。")
+        return {}
+    engine_options = preset_options(preset, segment)
+    if jobs == 0:
+        jobs, planned_threads = plan_jobs()
+        threads = threads or planned_threads
+    if jobs > 1:
+        threads = threads or max(1, (os.cpu_count() or 1) // jobs)
+        return separate_scheduled(wav_paths, jobs, threads, engine_options, stems_to_write, stem_format)
+
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    demucs_engine = DemucsEngine(**engine_options)
+    track_dirs = {}
+    for wav_path in wav_paths:
+        print(f"Processing: {wav_path}")
+        track_dirs[wav_path] = run_demucs_inprocess(demucs_engine, wav_path, stems_to_write, stem_format)
+    demucs_engine.report()
+    return track_dirs
+
+def separate_scheduled(wav_paths, jobs, threads, engine_options, stems_to_write=None, stem_format="wav"):
+    """複数のワーカープロセスで並列に分離し、成功した曲の分離状態を更新する"""
+    base_dir = separated_base_dir()
+    os.makedirs(base_dir, exist_ok=True)
+    print(f"{jobs}ジョブ × {threads}スレッドで分離します ({len(wav_paths)}曲)")
+    started = time.perf_counter()
+    failures = []
+    track_dirs = {}
+    for wav_path, track_dir, error in run_scheduled(wav_paths, base_dir, jobs, threads, engine_options,
+                                                    stems_to_write, stem_format):
+        track_dirs[wav_path] = track_dir
+        if error is not None:
+            print(f"Error: {wav_path} の分離に失敗しました: {error}")
+            failures.append(wav_path)
+            continue
+        print(f"Demucs processing completed successfully: {track_dir}")
+        update_separation_status(extract_song_id(wav_path))
+    elapsed = time.perf_counter() - started
+    succeeded = len(wav_paths) - len(failures)
+    print(f"分離完了: {succeeded}曲成功, {len(failures)}曲失敗 ({elapsed:.1f}秒, "
+          f"{succeeded / elapsed * 3600 if elapsed > 0 else 0:.1f}曲/時)")
+    return track_dirs
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Demucsによる音源分離")
+    parser.add_argument("--engine", choices=["inprocess", "cli"], default="inprocess",
+                        help="inprocess: モデルを1度だけロードして分離 / cli: 曲ごとにdemucsコマンドを実行")
+    parser.add_argument("--stems", default=None,
+                        help="書き出すステムをカンマ区切りで指定（例: vocals,guitar）。省略時は全ステム")
+    parser.add_argument("--format", dest="stem_format", choices=STEM_FORMATS, default="wav",
+                        help="ステムの出力形式（wav / flac / npy16: float16の.npy / mono16k: 分析専用のモノラル16kHz）")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="並列に実行する分離ジョブ数（0: コア数とメモリから自動決定）")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="ジョブごとのtorchスレッド数（省略時はコア数をジョブ数で割った値）")
+    parser.add_argument("--preset", choices=list(PRESETS), default="balanced",
+                        help="速度と品質のプリセット（shifts / overlap）")
+    parser.add_argument("--incremental", action="store_true",
+                        help="全ての日付フォルダから未分離・ステム欠損の曲だけを分離する")
+    parser.add_argument("--segment", type=float, default=None,
+                        help="Demucsのsegment長（秒）。プリセットの値を上書きする")
+    args = parser.parse_args(argv)
+    args.stems = [stem.strip() for stem in args.stems.split(",") if stem.strip()] if args.stems else None
+    return args
 
-def main():
+def main(argv=None):
+    args = parse_args(argv)
     try:
-        process_all_audio_files()
+        process_all_audio_files(
+            engine=args.engine, stems_to_write=args.stems, stem_format=args.stem_format,
+            jobs=args.jobs, threads=args.threads, preset=args.preset, segment=args.segment,
+            incremental=args.incremental
+        )
         return 0  # 正常終了
     except Exception as e:
         print(f"分離処理でエラーが発生しました: {e}")
@@ -0,0 +1,143 @@
+###分離したステムの書き出しと読み込み（形式・出力するステムの選択に対応）
+
+import json
+import os
+import numpy as np
+
+STEM_FORMATS = ("wav", "flac", "npy16", "mono16k")
+ANALYSIS_SAMPLE_RATE = 16000  # mono16k形式のサンプルレート
+MANIFEST_FILE = "stems.json"  # 曲フォルダごとに書き出した形式とサンプルレートを記録する
+STEM_EXTENSIONS = (".wav", ".flac", ".npy")  # マニフェストがない場合に探す拡張子（demucsコマンドの出力はwav）
+
+
+def stem_to_numpy(source):
+    """
+    torch.Tensor / ndarray の (チャンネル, サンプル) 波形をfloat32のndarrayに変換する
+    demucsのclip='rescale'と同じく、クリップしないように全体の音量を下げる
+    """
+    if hasattr(source, "detach"):
+        source = source.detach().cpu().numpy()
+    wav = np.asarray(source, dtype=np.float32)
+    peak = np.abs(wav).max() if wav.size else 0.0
+    return wav / max(1.01 * peak, 1.0)
+
+
+def write_stems(stems, track_dir, samplerate, stems_to_write=None, stem_format="wav", prescreened=False):
+    """
+    {ステム名: 波形} のうちstems_to_writeで指定したものだけをstem_format形式で保存する
+      wav     : 16bit PCM（demucsコマンドと同じ）
+      flac    : 16bit FLAC（wavと同じ内容を可逆圧縮）
+      npy16   : float16の.npy（チャンネル, サンプル）
+      mono16k : モノラル・16000Hzの16bit FLAC（分析専用）
+    prescreened=Trueは候補区間だけを分離したステム（区間の外は分離されていない）であることをマニフェストに記録する
+    戻り値は書き出した内容を記録したマニフェスト
+    """
+    import soundfile as sf
+
+    if stem_format not in STEM_FORMATS:
+        raise ValueError(f"未対応の出力形式です: {stem_format}")
+    os.makedirs(track_dir, exist_ok=True)
+
+    manifest = {"format": stem_format, "samplerate": samplerate, "stems": {}}
+    if prescreened:
+        manifest["prescreened"] = True
+    for name, source in stems.items():
+        if stems_to_write and name not in stems_to_write:
+            continue
+        wav = stem_to_numpy(source)
+        if stem_format == "wav":
+            file_name = f"{name}.wav"
+            sf.write(os.path.join(track_dir, file_name), wav.T, samplerate, subtype="PCM_16")
+        elif stem_format == "flac":
+            file_name = f"{name}.flac"
+            sf.write(os.path.join(track_dir, file_name), wav.T, samplerate, format="FLAC", subtype="PCM_16")
+        elif stem_format == "npy16":
+            file_name = f"{name}.npy"
+            np.save(os.path.join(track_dir, file_name), wav.astype(np.float16))
+        else:
+            import librosa
+            file_name = f"{name}.flac"
+            mono = librosa.resample(wav.mean(axis=0), orig_sr=samplerate, target_sr=ANALYSIS_SAMPLE_RATE)
+            sf.write(os.path.join(track_dir, file_name), mono, ANALYSIS_SAMPLE_RATE, format="FLAC", subtype="PCM_16")
+            manifest["samplerate"] = ANALYSIS_SAMPLE_RATE
+        manifest["stems"][name] = file_name
+
+    with open(os.path.join(track_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def read_manifest(track_dir):
+    try:
+        with open(os.path.join(track_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def find_stem(track_dir, stem):
+    """曲フォルダから指定したステムのファイルを探す（見つからない場合はNone）"""
+    manifest = read_manifest(track_dir)
+    if manifest and stem in manifest["stems"]:
+        path = os.path.join(track_dir, manifest["stems"][stem])
+        return path if os.path.isfile(path) else None
+    for extension in STEM_EXTENSIONS:
+        path = os.path.join(track_dir, f"{stem}{extension}")
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def stem_samplerate(path):
+    """ステムのサンプルレート（.npyはマニフェストから取得）"""
+    if path.endswith(".npy"):
+        return read_manifest(os.path.dirname(path))["samplerate"]
+    import soundfile as sf
+    return sf.info(path).samplerate
+
+
+def stem_duration(path):
+    """ステムの長さ（秒）。デコードせずにヘッダから求める"""
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r").shape[-1] / stem_samplerate(path)
+    import soundfile as sf
+    info = sf.info(path)
+    return info.frames / info.samplerate
+
+
+def read_stem(path, sr=None):
+    """
+    ステムをモノラルのfloat32波形として読み込む（sr=Noneの場合は元のサンプルレート）
+    librosa.load(path, sr=sr) と同じ結果になる
+    """
+    import librosa
+
+    if not path.endswith(".npy"):
+        return librosa.load(path, sr=sr)
+    native_sr = stem_samplerate(path)
+    wav = np.load(path).astype(np.float32)
+    y = wav.mean(axis=0) if wav.ndim > 1 else wav
+    if sr and sr != native_sr:
+        y = librosa.resample(y, orig_sr=native_sr, target_sr=sr)
+        return y, sr
+    return y, native_sr
+
+
+def iter_stem_blocks(path, block_size):
+    """ステムをブロックごとにモノラル化して返す。戻り値は (サンプルレート, ブロックのイテレータ)"""
+    if path.endswith(".npy"):
+        wav = np.load(path, mmap_mode="r")
+
+        def blocks():
+            for start in range(0, wav.shape[-1], block_size):
+                block = np.asarray(wav[..., start:start + block_size], dtype=np.float32)
+                yield block.mean(axis=0) if block.ndim > 1 else block
+        return stem_samplerate(path), blocks()
+
+    import soundfile as sf
+
+    def blocks():
+        for block in sf.blocks(path, blocksize=block_size, dtype="float32", always_2d=True):
+            # librosa.loadと同様にチャンネル平均でモノラル化
+            yield block.mean(axis=1)
+    return sf.info(path).samplerate, blocks()
@@ -1,4 +1,5 @@
 import sys
+import argparse
 import subprocess
 
 def run_script(module_name):
@@ -8,25 +9,100 @@ def run_script(module_name):
     except subprocess.CalledProcessError:
         return False
 
-def main():
-    # スクリプトの実行順序を定義
-    scripts = [
-        "app.scripts.download.getpass",
-        "app.scripts.download.download",
-        "app.scripts.separate.separate",
-        "app.scripts.analyze.duration_analyze",
-        "app.scripts.analyze.is_guitar_analyze_duration"
-    ]
-
-    # 各スクリプトを順番に実行
-    for script in scripts:
+def run_isolated(stage_names):
+    """各ステージを従来どおり別プロセス（pipenv run python -m）で順番に実行する"""
+    from app.scripts.pipeline.stages import STAGE_MODULES
+
+    for stage in stage_names:
+        script = STAGE_MODULES[stage]
         print(f"実行中: {script}")
         if not run_script(script):
             print(f"エラー: {script} の実行に失敗しました")
             sys.exit(1)
         print(f"完了: {script}")
 
+def run_streaming_pipeline(stage_names, args):
+    """getpassだけ先に実行し、ダウンロード以降はストリーミングパイプラインで重ねて実行する"""
+    from app.scripts.download.download import daily_csv_path, read_csv_rows
+    from app.scripts.pipeline.stages import STAGE_NAMES, run_stages
+    from app.scripts.pipeline.streaming import run_streaming
+
+    # ストリーミングではダウンロードから分析までを1曲ずつ流すため、途中のステージだけを選ぶことはできない
+    streamed = [stage for stage in STAGE_NAMES if stage != "getpass"]
+    if [stage for stage in stage_names if stage != "getpass"] != streamed:
+        print(f"エラー: --streaming では --stages に全ステージか、getpassを除く全ステージ（{','.join(streamed)}）を指定してください")
+        sys.exit(2)
+    if args.separate_jobs != 1:
+        print("Warning: --streaming では分離を1ジョブで行うため --separate-jobs は無視されます")
+    if args.analyze_workers != 1:
+        print("Warning: --streaming では1曲ずつ分析するため --analyze-workers は無視されます")
+
+    options = {
+        "playlist": args.playlist,
+        "playlists_file": args.playlists,
+        "download_concurrency": args.download_concurrency,
+        "preset": args.preset,
+    }
+    if "getpass" in stage_names:
+        items = run_stages(["getpass"], options) or []
+        rows = [(item.title, item.artist, item.url.split('&list=')[0]) for item in items if item.url]
+    else:
+        rows = read_csv_rows(daily_csv_path())
+    try:
+        run_streaming(rows, options, separate_queue_size=args.separate_queue_size,
+                      analyze_queue_size=args.analyze_queue_size)
+    except Exception as e:
+        print(f"エラー: パイプラインの実行に失敗しました: {e}")
+        sys.exit(1)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="曲の取得から分離・分析までのパイプライン")
+    parser.add_argument("--stages", default=None,
+                        help="実行するステージをカンマ区切りで指定（getpass,download,separate,duration,guitar）。省略時は全ステージ")
+    parser.add_argument("--isolate", action="store_true",
+                        help="ステージごとに別プロセス（pipenv run python -m）で実行する")
+    parser.add_argument("--playlist", default=None, help="getpass: 取得するプレイリストのURL")
+    parser.add_argument("--playlists", default=None, help="getpass: 複数のプレイリストURLを書いたファイル")
+    parser.add_argument("--download-concurrency", type=int, default=1, help="download: 同時にダウンロードする曲数")
+    parser.add_argument("--separate-jobs", type=int, default=1, help="separate: 並列に実行する分離ジョブ数（0で自動決定）")
+    parser.add_argument("--preset", default="balanced", help="separate: 速度と品質のプリセット")
+    parser.add_argument("--analyze-workers", type=int, default=1, help="duration / guitar: 並列に分析するプロセス数")
+    parser.add_argument("--streaming", action="store_true",
+                        help="ダウンロード・分離・分析を上限付きキューでつなぎ、曲ごとに重ねて実行する")
+    parser.add_argument("--separate-queue-size", type=int, default=2, help="streaming: 分離待ちにできる曲数")
+    parser.add_argument("--analyze-queue-size", type=int, default=2, help="streaming: 分析待ちにできる曲数")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    from app.scripts.pipeline.stages import parse_stages, run_stages
+
+    try:
+        stage_names = parse_stages(args.stages)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        sys.exit(2)
+
+    if args.isolate:
+        run_isolated(stage_names)
+    elif args.streaming:
+        run_streaming_pipeline(stage_names, args)
+    else:
+        # 同じプロセス内で実行し、各ステージの処理対象（song_idとパス）を次のステージに渡す
+        try:
+            run_stages(stage_names, {
+                "playlist": args.playlist,
+                "playlists_file": args.playlists,
+                "download_concurrency": args.download_concurrency,
+                "separate_jobs": args.separate_jobs,
+                "preset": args.preset,
+                "analyze_workers": args.analyze_workers,
+            })
+        except Exception as e:
+            print(f"エラー: パイプラインの実行に失敗しました: {e}")
+            sys.exit(1)
+
     print("全てのスクリプトの実行が完了しました")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
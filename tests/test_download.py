@@ -0,0 +1,108 @@
+"""
+曲ごとの一時ディレクトリでのダウンロード（app/scripts/download/download.py）を
+ネットワークに接続しない代替のYoutubeDLで確認するテスト
+
+    python -m unittest tests.test_download
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# DB接続は行わないが、db.configが読み込み時に接続情報を要求するため読み込む間だけダミーの値を入れる
+# （os.environに残すとDBを使うテストがスキップされなくなる）
+with mock.patch.dict(os.environ, {name: os.environ.get(name, "test")
+                                  for name in ("POSTGRES_DB", "POSTGRES_USER", "POSTGRES_PASSWORD")}):
+    from app.scripts.download.download import YTDLPDownloader, download_concurrently, downloaded_file_path
+
+
+class FakeYoutubeDL:
+    """出力テンプレートの一時ディレクトリにWAVを書き出したことにするYoutubeDLの代替"""
+
+    def __init__(self, options):
+        self.temp_dir = os.path.dirname(options["outtmpl"])
+
+    def extract_info(self, url, download=True):
+        video_id = url.rsplit("=", 1)[-1]
+        if video_id.startswith("slow"):
+            time.sleep(0.5)
+        if video_id.startswith("broken"):
+            open(os.path.join(self.temp_dir, f"{video_id}.webm.part"), "wb").close()  # 途中まで書いたファイル
+            raise RuntimeError(f"ダウンロードに失敗しました: {video_id}")
+        file_path = os.path.join(self.temp_dir, f"{video_id}.wav")
+        with open(file_path, "wb") as f:
+            f.write(b"RIFF")
+        return {"id": video_id, "title": video_id, "artist": "artist",
+                "requested_downloads": [{"filepath": file_path}]}
+
+    def sanitize_info(self, info_dict):
+        return dict(info_dict)
+
+
+class FakeDownloader(YTDLPDownloader):
+    """DBに登録せずに連番のsong_idを返す"""
+
+    batch_sizes = None
+
+    def insert_metadata_batch(self, items):
+        self.batch_sizes = (self.batch_sizes or []) + [len(items)]
+        start = getattr(self, "next_song_id", 1)
+        self.next_song_id = start + len(items)
+        return list(range(start, start + len(items)))
+
+
+class DownloadIsolatedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        cookies_file = os.path.join(self.root, "cookies.txt")
+        open(cookies_file, "w").close()
+        self.downloader = FakeDownloader(self.root, cookies_file=cookies_file, ydl_factory=FakeYoutubeDL)
+        self.temp_root = os.path.join(self.root, "temp")
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_uses_requested_download_path(self):
+        metadata, file_path, temp_dir = self.downloader.download_isolated("https://music.youtube.com/watch?v=abc")
+        self.assertEqual(metadata["id"], "abc")
+        self.assertEqual(file_path, os.path.join(temp_dir, "abc.wav"))
+        self.assertEqual(os.path.dirname(temp_dir), self.temp_root)
+        self.assertTrue(os.path.exists(file_path))
+
+    def test_failure_removes_temp_dir(self):
+        with self.assertRaises(RuntimeError):
+            self.downloader.download_isolated("https://music.youtube.com/watch?v=broken")
+        self.assertEqual(os.listdir(self.temp_root), [])
+
+    def test_failed_item_does_not_affect_others(self):
+        rows = [(f"title {video_id}", "artist", f"https://music.youtube.com/watch?v={video_id}")
+                for video_id in ("a", "broken", "b", "c")]
+        registered = download_concurrently(self.downloader, rows, concurrency=2, register_batch_size=2)
+
+        self.assertEqual(sorted(title for title, *_ in registered), ["title a", "title b", "title c"])
+        for _, _, _, song_id, wav_path in registered:
+            self.assertTrue(os.path.basename(wav_path).startswith(f"{song_id}__"))
+            self.assertTrue(os.path.exists(wav_path))
+        # 成功した曲も失敗した曲も一時ディレクトリは残らない
+        self.assertEqual(os.listdir(self.temp_root), [])
+
+    def test_registers_after_interval_without_waiting_for_batch(self):
+        # 1曲ずつダウンロードする場合も、次の曲の完了を待たずに登録する
+        rows = [(video_id, "artist", f"https://music.youtube.com/watch?v={video_id}") for video_id in ("a", "slow")]
+        download_concurrently(self.downloader, rows, concurrency=1, register_batch_size=50, register_interval=0.1)
+        self.assertEqual(self.downloader.batch_sizes, [1, 1])
+
+
+class DownloadedFilePathTest(unittest.TestCase):
+
+    def test_falls_back_to_output_template(self):
+        info_dict = {"id": "abc", "_filename": "abc.webm"}
+        self.assertEqual(downloaded_file_path(info_dict, "/tmp/item"), "/tmp/item/abc.wav")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+保存したプレイリストのページ（tests/fixtures/playlists）から曲を取り出す処理
+（app/scripts/download/getpass.py）をブラウザなしで確認するテスト
+
+    python -m unittest tests.test_getpass
+"""
+
+import os
+import shutil
+import unittest
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from selenium.common.exceptions import WebDriverException
+
+from app.scripts.download.getpass import (
+    EXTRACT_QUEUE_SCRIPT, DriverPool, QueueItemParser, create_driver, parse_playlist_html, scrape_playlists
+)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "playlists")
+PLAYLIST_URL = "https://music.youtube.com/watch?v=Vid00000001&list=RDTEST"
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def watch_url(video_id):
+    return f"https://music.youtube.com/watch?v={video_id}&list=RDTEST"
+
+
+def fixture_url(name):
+    return f"file://{os.path.join(FIXTURE_DIR, name)}?list=RDTEST"
+
+
+class FileDriver:
+    """file:// のページだけを開けるWebDriverの代替（キューのDOMはQueueItemParserで再現する）"""
+
+    def __init__(self):
+        self.html = ""
+        self.opened = []
+        self.quit_called = False
+
+    def get(self, url):
+        path = url2pathname(urlparse(url).path)
+        if not os.path.exists(path):
+            raise WebDriverException(f"net::ERR_FILE_NOT_FOUND ({url})")
+        with open(path, "r", encoding="utf-8") as f:
+            self.html = f.read()
+        self.opened.append(url)
+
+    @property
+    def page_source(self):
+        return self.html
+
+    def queue_items(self):
+        parser = QueueItemParser()
+        parser.feed(self.html)
+        parser.close()
+        return parser.items
+
+    def find_elements(self, by, selector):
+        return self.queue_items() if selector == "ytmusic-player-queue-item" else []
+
+    def execute_script(self, script):
+        if script == EXTRACT_QUEUE_SCRIPT:
+            return self.queue_items()
+        return "complete"
+
+    def quit(self):
+        self.quit_called = True
+
+
+class ParsePlaylistHtmlTest(unittest.TestCase):
+
+    def test_music_initial_data_push(self):
+        # YouTube Music: initialData.push({... data: '\x7b...'}) のエスケープされたJSON
+        videos = parse_playlist_html(read_fixture("music_initial_data.html"), PLAYLIST_URL)
+        self.assertEqual(videos, [
+            {"title": "Guitar Solo 🎸", "artist": "Band A", "url": watch_url("Vid00000001")},
+            {"title": "It's \"Quoted\"", "artist": "Band B", "url": watch_url("Vid00000002")},
+            {"title": "夜に駆ける", "artist": "YOASOBI", "url": watch_url("Vid00000003")},
+        ])  # 重複した動画IDは1回だけ
+
+    def test_youtube_initial_data(self):
+        # YouTube: var ytInitialData = {...}; のsimpleTextとlongBylineText
+        videos = parse_playlist_html(read_fixture("youtube_initial_data.html"), PLAYLIST_URL)
+        self.assertEqual([(video["title"], video["url"]) for video in videos], [
+            ("Instrumental Break", watch_url("Vid00000011")),
+            ("Outro", watch_url("Vid00000012")),
+        ])
+        self.assertTrue(videos[0]["artist"].startswith("Band C"))
+
+    def test_queue_item_dom_fallback(self):
+        # 初期データがない場合はytmusic-player-queue-itemのDOMから取り出す（動画IDのないアイテムは除外）
+        videos = parse_playlist_html(read_fixture("queue_items.html"), PLAYLIST_URL)
+        self.assertEqual(videos, [
+            {"title": "Wind Up", "artist": "Band E", "url": watch_url("Vid00000021")},
+            {"title": "Twin Leads", "artist": "Band F", "url": watch_url("Vid00000022")},
+        ])
+
+    def test_without_playlist_url(self):
+        videos = parse_playlist_html(read_fixture("queue_items.html"))
+        self.assertEqual(videos[0]["url"], "https://music.youtube.com/watch?v=Vid00000021")
+
+    def test_page_without_queue(self):
+        self.assertEqual(parse_playlist_html("<html><body><p>empty</p></body></html>"), [])
+
+
+class ScrapePlaylistsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.drivers = []
+
+    def driver_factory(self):
+        driver = FileDriver()
+        self.drivers.append(driver)
+        return driver
+
+    def test_scrapes_file_pages_in_input_order(self):
+        urls = [fixture_url("queue_items.html"), fixture_url("queue_items.html")]
+        videos = scrape_playlists(urls, pool_size=2, driver_factory=self.driver_factory)
+        self.assertEqual([video["url"] for video in videos],
+                         [watch_url("Vid00000021"), watch_url("Vid00000022")] * 2)
+        self.assertTrue(all(driver.quit_called for driver in self.drivers))
+
+    def test_crashed_driver_is_replaced(self):
+        # 開けなかったページのドライバーは使い回さず、次のプレイリストは新しいドライバーで取得する
+        urls = [fixture_url("missing.html"), fixture_url("queue_items.html")]
+        videos = scrape_playlists(urls, pool_size=1, driver_factory=self.driver_factory)
+        self.assertEqual(len(videos), 2)
+        self.assertEqual(len(self.drivers), 2)
+        crashed, fresh = self.drivers
+        self.assertTrue(crashed.quit_called)
+        self.assertEqual(crashed.opened, [])
+        self.assertEqual(fresh.opened, [urls[1]])
+
+    def test_close_quits_every_driver(self):
+        pool = DriverPool(size=2, prime=False, driver_factory=self.driver_factory)
+        first, second = pool.acquire(), pool.acquire()
+
+        def broken_quit():
+            raise WebDriverException("chrome not reachable")
+        first.quit = broken_quit
+        pool.close()
+        self.assertTrue(second.quit_called)
+        self.assertEqual(pool.drivers, [])
+
+
+@unittest.skipUnless(shutil.which("chromedriver"), "chromedriverがないためスキップ")
+class HeadlessChromeTest(unittest.TestCase):
+
+    def test_scrapes_file_page(self):
+        videos = scrape_playlists([fixture_url("queue_items.html")], pool_size=1, driver_factory=create_driver)
+        self.assertEqual([video["title"] for video in videos], ["Wind Up", "Twin Leads"])
+
+
+if __name__ == "__main__":
+    unittest.main()
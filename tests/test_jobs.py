@@ -0,0 +1,166 @@
+"""
+Jobテーブルのジョブキュー（app/scripts/pipeline/jobs.py）をローカルのPostgreSQLで確認するテスト
+POSTGRES_DB・POSTGRES_USER・POSTGRES_PASSWORD（必要ならPOSTGRES_HOST・POSTGRES_PORT）が
+設定されていない場合はスキップする。テーブルは使い捨てのスキーマに作るため既存のデータには触れない
+
+    python -m unittest tests.test_jobs
+"""
+
+import importlib.util
+import os
+import sys
+import time
+import unittest
+import uuid
+
+DB_ENV = ("POSTGRES_DB", "POSTGRES_USER", "POSTGRES_PASSWORD")
+DB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "scripts", "db")
+
+
+def load_create_job_table():
+    """マイグレーションスクリプトのCREATE文をそのまま使う（ファイル名が数字で始まるためパスから読み込む）"""
+    sys.path.insert(0, DB_DIR)  # マイグレーションは db/ をカレントにして実行する前提で config を import する
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "create_job_table", os.path.join(DB_DIR, "202610181200_create_job_table.py")
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(DB_DIR)
+    return module.CREATE_JOB_TABLE, module.CREATE_JOB_INDEXES
+
+
+@unittest.skipUnless(all(os.environ.get(name) for name in DB_ENV), "POSTGRES_*が設定されていないためスキップ")
+class JobQueueTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        import psycopg2
+        from app.scripts.db.config import DB_CONFIG
+        from app.scripts.pipeline import jobs
+
+        cls.jobs = jobs
+        cls.schema = f"job_test_{uuid.uuid4().hex[:8]}"
+        cls.db_options = dict(DB_CONFIG, options=f"-c search_path={cls.schema}")
+
+        create_job_table, create_job_indexes = load_create_job_table()
+        conn = psycopg2.connect(**DB_CONFIG)
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE SCHEMA {cls.schema}")
+            cursor.execute(f"SET search_path TO {cls.schema}")
+            # 外部キーに必要な列だけのSongテーブル
+            cursor.execute('CREATE TABLE "Song" (song_id INTEGER PRIMARY KEY, is_separated BOOLEAN DEFAULT FALSE)')
+            cursor.execute(create_job_table)
+            cursor.execute(create_job_indexes)
+        conn.commit()
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        import psycopg2
+        from app.scripts.db.config import DB_CONFIG
+
+        conn = psycopg2.connect(**DB_CONFIG)
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA {cls.schema} CASCADE")
+        conn.commit()
+        conn.close()
+
+    def connect(self):
+        import psycopg2
+        return psycopg2.connect(**self.db_options)
+
+    def setUp(self):
+        self.conn = self.connect()
+        self.other = self.connect()
+        with self.conn.cursor() as cursor:
+            cursor.execute('TRUNCATE "Job", "Song"')
+            cursor.execute('INSERT INTO "Song" (song_id) VALUES (1), (2)')
+        self.jobs.enqueue_jobs([(1, "separate", "downloaded/20261018/1_a.wav"),
+                                (2, "separate", "downloaded/20261018/2_b.wav")], self.conn)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        self.other.close()
+
+    def job_row(self, song_id, stage="separate"):
+        with self.conn.cursor() as cursor:
+            cursor.execute('SELECT status, attempts, worker_id, lease_expires_at FROM "Job" '
+                           'WHERE song_id = %s AND stage = %s', (song_id, stage))
+            row = cursor.fetchone()
+        self.conn.commit()
+        return row
+
+    def test_claim_takes_each_job_once(self):
+        first = self.jobs.claim_job("separate", "worker-a", self.conn)
+        second = self.jobs.claim_job("separate", "worker-b", self.other)
+        self.assertEqual((first.song_id, second.song_id), (1, 2))
+        self.assertEqual(first.attempts, 1)
+        self.assertEqual(first.path, "downloaded/20261018/1_a.wav")
+        self.assertIsNone(self.jobs.claim_job("separate", "worker-c", self.conn))
+        self.assertEqual(self.job_row(1)[:3], ("running", 1, "worker-a"))
+
+    def test_claim_skips_locked_rows(self):
+        # 他のワーカーが取得途中（コミット前）の行は待たずに飛ばして次の行を取る
+        with self.other.cursor() as cursor:
+            cursor.execute(self.jobs.CLAIM_QUERY, {"stage": "separate", "worker_id": "worker-b",
+                                                   "lease_seconds": 60, "max_attempts": 3})
+            locked = cursor.fetchone()
+        with self.conn.cursor() as cursor:
+            cursor.execute("SET statement_timeout = 2000")
+        job = self.jobs.claim_job("separate", "worker-a", self.conn)
+        self.other.rollback()
+        self.assertEqual(locked[0], 1)
+        self.assertEqual(job.song_id, 2)
+
+    def test_heartbeat_extends_only_own_lease(self):
+        job = self.jobs.claim_job("separate", "worker-a", self.conn, lease_seconds=60)
+        before = self.job_row(job.song_id)[3]
+        time.sleep(0.05)
+        self.assertTrue(self.jobs.heartbeat(job, "worker-a", self.conn, lease_seconds=120))
+        self.assertGreater(self.job_row(job.song_id)[3], before)
+        self.assertFalse(self.jobs.heartbeat(job, "worker-b", self.conn))
+
+    def test_expired_lease_is_reclaimed(self):
+        job = self.jobs.claim_job("separate", "worker-a", self.conn, lease_seconds=0.1)
+        self.jobs.claim_job("separate", "worker-a", self.conn)  # song 2 を取っておく
+        time.sleep(0.3)
+        reclaimed = self.jobs.claim_job("separate", "worker-b", self.other)
+        self.assertEqual((reclaimed.song_id, reclaimed.attempts), (job.song_id, 2))
+        # リースを失ったワーカーは延長も完了もできない
+        self.assertFalse(self.jobs.heartbeat(job, "worker-a", self.conn))
+        self.assertFalse(self.jobs.complete_job(job, "worker-a", self.conn, "separated/x"))
+        self.assertTrue(self.jobs.complete_job(reclaimed, "worker-b", self.other, "separated/20261018/htdemucs_6s/1_a"))
+        self.assertEqual(self.job_row(job.song_id)[0], "done")
+
+    def test_complete_enqueues_next_stage(self):
+        job = self.jobs.claim_job("separate", "worker-a", self.conn)
+        self.assertTrue(self.jobs.complete_job(job, "worker-a", self.conn, "separated/20261018/htdemucs_6s/1_a"))
+        next_job = self.jobs.claim_job("duration", "worker-a", self.conn)
+        self.assertEqual((next_job.song_id, next_job.path), (1, "separated/20261018/htdemucs_6s/1_a"))
+
+    def test_fail_marks_failed_after_max_attempts(self):
+        job = self.jobs.claim_job("separate", "worker-a", self.conn, max_attempts=2)
+        self.jobs.fail_job(job, "worker-a", "boom", self.conn, max_attempts=2)
+        self.assertEqual(self.job_row(job.song_id)[:2], ("pending", 1))
+
+        job = self.jobs.claim_job("separate", "worker-a", self.conn, max_attempts=2)
+        self.assertEqual((job.song_id, job.attempts), (1, 2))
+        self.jobs.fail_job(job, "worker-a", "boom", self.conn, max_attempts=2)
+        self.assertEqual(self.job_row(job.song_id)[:2], ("failed", 2))
+
+        remaining = self.jobs.claim_job("separate", "worker-a", self.conn, max_attempts=2)
+        self.assertEqual(remaining.song_id, 2)
+        self.assertIsNone(self.jobs.claim_job("separate", "worker-a", self.conn, max_attempts=2))
+
+    def test_expired_job_at_max_attempts_is_failed(self):
+        self.jobs.claim_job("separate", "worker-a", self.conn, lease_seconds=0.1, max_attempts=1)
+        time.sleep(0.3)
+        self.assertEqual(self.jobs.expire_jobs(self.conn, max_attempts=1), 1)
+        self.assertEqual(self.job_row(1)[0], "failed")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+"""
+プロセスプールで入力順に結果を返すrun_ordered（app/scripts/analyze/parallel.py）のテスト
+ワーカーが異常終了した場合に、原因の曲だけを失敗として返すことを確認する
+
+    python -m unittest tests.test_parallel
+"""
+
+import os
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+
+from app.scripts.analyze.parallel import run_ordered
+
+CRASH_ITEM = 4
+ERROR_ITEM = 6
+
+
+def square_or_crash(item):
+    """CRASH_ITEMではワーカープロセスごと終了し、ERROR_ITEMでは通常の例外を送出する"""
+    if item == CRASH_ITEM:
+        os._exit(1)
+    if item == ERROR_ITEM:
+        raise ValueError(f"bad item: {item}")
+    return item * item
+
+
+class RunOrderedTest(unittest.TestCase):
+
+    def check_results(self, results, items):
+        self.assertEqual([item for item, _, _ in results], items)
+        for item, result, error in results:
+            if item == CRASH_ITEM:
+                self.assertIsInstance(error, BrokenProcessPool)
+            elif item == ERROR_ITEM:
+                self.assertIsInstance(error, ValueError)
+            else:
+                self.assertIsNone(error, f"item {item}")
+                self.assertEqual(result, item * item)
+
+    def test_in_process(self):
+        items = [1, 2, ERROR_ITEM, 3]
+        self.check_results(list(run_ordered(square_or_crash, items)), items)
+
+    def test_crash_is_isolated_with_parallel_workers(self):
+        items = list(range(12))
+        self.check_results(list(run_ordered(square_or_crash, items, workers=3)), items)
+
+    def test_crash_is_isolated_with_single_spawned_worker(self):
+        items = list(range(8))
+        self.check_results(list(run_ordered(square_or_crash, items, workers=1, spawn=True)), items)
+
+
+if __name__ == "__main__":
+    unittest.main()